@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import os
+import re
+import struct
+import zlib
+
+CAB_SIGNATURE = b"MSCF"
+CAB_VERSION = (1, 3)
+CAB_HEADER = struct.Struct("<4sIIIIIBBHHHHH")
+CAB_RESERVE = struct.Struct("<HBB")
+CAB_FOLDER = struct.Struct("<IHH")
+CAB_FILE = struct.Struct("<IIHHHH")
+CAB_DATA = struct.Struct("<IHH")
+CAB_FLAG_PREV_CABINET = 0x0001
+CAB_FLAG_NEXT_CABINET = 0x0002
+CAB_FLAG_RESERVE_PRESENT = 0x0004
+CAB_COMPRESS_MASK = 0x000F
+CAB_COMPRESS_NONE = 0
+CAB_COMPRESS_MSZIP = 1
+CAB_ATTRIB_NAME_IS_UTF = 0x80
+CAB_NAME_MAX = 256
+CAB_MEMBERS_MAX = 1024
+CAB_BLOCK_MAX = 32768
+CAB_EXTRACT_MAX_SIZE = 512 * 1024 * 1024
+MSZIP_SIGNATURE = b"CK"
+
+FIRMWARE_MEMBERS_REGEX = re.compile(
+    r"^(firmware[A-Za-z0-9_.\-]{0,200}\.(bin|asc)|firmware\.metainfo\.xml)$"
+)
+
+
+class CabinetReader:
+    """Reads MS-Cabinet archives with uncompressed or MSZIP folders.
+
+    The headers are parsed when the reader is created. Extraction streams
+    the folders block by block and writes only the requested members, so
+    neither the whole folder nor the unneeded members ever reach the disk.
+    """
+
+    def __init__(self, archive_path):
+        """Keyword argument:
+        archive_path -- absolute path to the cabinet file
+        """
+        self.archive_path = archive_path
+        self.folders = []
+        self.members = []
+        self._data_reserve = 0
+        with open(archive_path, "rb") as cab:
+            self._read_headers(cab)
+
+    def _read_struct(self, cab, fmt):
+        """Reads and unpacks a structure of the cabinet.
+
+        Keyword arguments:
+        cab -- cabinet file
+        fmt -- struct.Struct of the read structure
+        """
+        data = cab.read(fmt.size)
+        if len(data) != fmt.size:
+            raise ValueError("Invalid cabinet: unexpected end of file")
+        return fmt.unpack(data)
+
+    def _read_name(self, cab, attribs):
+        """Reads NUL terminated name of the member.
+
+        Keyword arguments:
+        cab -- cabinet file
+        attribs -- attributes of the member
+        """
+        name = b""
+        while True:
+            char = cab.read(1)
+            if not char:
+                raise ValueError("Invalid cabinet: unexpected end of file")
+            if char == b"\0":
+                break
+            name += char
+            if len(name) > CAB_NAME_MAX:
+                raise ValueError("Invalid cabinet: member name too long")
+        encoding = "utf-8" if attribs & CAB_ATTRIB_NAME_IS_UTF else "ascii"
+        return name.decode(encoding, errors="replace")
+
+    def _read_headers(self, cab):
+        """Reads the cabinet header, the folders and the members list.
+
+        Keyword argument:
+        cab -- cabinet file
+        """
+        (
+            signature, __, cab_size, __, files_offset, __,
+            version_minor, version_major, folders_num, files_num,
+            flags, __, __
+        ) = self._read_struct(cab, CAB_HEADER)
+        if signature != CAB_SIGNATURE:
+            raise ValueError("Invalid cabinet: wrong signature")
+        if (version_major, version_minor) != CAB_VERSION:
+            raise ValueError(
+                f"Unsupported cabinet version {version_major}.{version_minor}"
+            )
+        if flags & (CAB_FLAG_PREV_CABINET | CAB_FLAG_NEXT_CABINET):
+            raise ValueError("Multi-part cabinets are not supported")
+        if os.fstat(cab.fileno()).st_size < cab_size:
+            raise ValueError("Invalid cabinet: file is truncated")
+        if files_num > CAB_MEMBERS_MAX:
+            raise ValueError(f"Cabinet has more than {CAB_MEMBERS_MAX} files")
+        folder_reserve = 0
+        if flags & CAB_FLAG_RESERVE_PRESENT:
+            header_reserve, folder_reserve, self._data_reserve = \
+                self._read_struct(cab, CAB_RESERVE)
+            cab.seek(header_reserve, os.SEEK_CUR)
+        for __ in range(folders_num):
+            offset, blocks_num, compression = self._read_struct(
+                cab,
+                CAB_FOLDER
+            )
+            cab.seek(folder_reserve, os.SEEK_CUR)
+            compression &= CAB_COMPRESS_MASK
+            if compression not in (CAB_COMPRESS_NONE, CAB_COMPRESS_MSZIP):
+                raise ValueError(
+                    f"Unsupported cabinet compression: {compression}"
+                )
+            self.folders.append(
+                {
+                    "Offset": offset,
+                    "Blocks": blocks_num,
+                    "Compression": compression,
+                }
+            )
+        cab.seek(files_offset)
+        for __ in range(files_num):
+            size, offset, folder, __, __, attribs = self._read_struct(
+                cab,
+                CAB_FILE
+            )
+            name = self._read_name(cab, attribs)
+            if folder >= len(self.folders):
+                raise ValueError(f"Invalid cabinet folder of {name}")
+            self.members.append(
+                {
+                    "Name": name,
+                    "Size": size,
+                    "Folder": folder,
+                    "Offset": offset,
+                }
+            )
+
+    def _folder_blocks(self, cab, folder):
+        """Yields uncompressed data blocks of the folder.
+
+        Keyword arguments:
+        cab -- cabinet file
+        folder -- folder dictionary
+        """
+        cab.seek(folder["Offset"])
+        window = b""
+        for __ in range(folder["Blocks"]):
+            __, packed_size, size = self._read_struct(cab, CAB_DATA)
+            cab.seek(self._data_reserve, os.SEEK_CUR)
+            packed = cab.read(packed_size)
+            if len(packed) != packed_size:
+                raise ValueError("Invalid cabinet: unexpected end of file")
+            if folder["Compression"] == CAB_COMPRESS_NONE:
+                data = packed
+            else:
+                if not packed.startswith(MSZIP_SIGNATURE):
+                    raise ValueError("Invalid cabinet: wrong MSZIP block")
+                # Every MSZIP block is a complete deflate stream, which may
+                # refer to the data of the previous blocks.
+                decompressor = zlib.decompressobj(
+                    -zlib.MAX_WBITS,
+                    zdict=window
+                )
+                data = decompressor.decompress(packed[2:], CAB_BLOCK_MAX + 1)
+                window = (window + data)[-CAB_BLOCK_MAX:]
+            if len(data) != size or size > CAB_BLOCK_MAX:
+                raise ValueError("Invalid cabinet: wrong size of data block")
+            yield data
+
+    def list(self):
+        """Returns names of the cabinet members."""
+        return [member["Name"] for member in self.members]
+
+    def extract(self, output_path, members_regex=FIRMWARE_MEMBERS_REGEX,
+                max_size=CAB_EXTRACT_MAX_SIZE):
+        """Extracts the members matching `members_regex` to the output
+        directory and returns their paths. The regex has to admit only
+        plain file names.
+
+        Keyword arguments:
+        output_path -- absolute path to the output directory
+        members_regex -- pattern of the extracted member names
+        max_size -- maximal total size of the extracted members
+        """
+        wanted = [m for m in self.members if members_regex.match(m["Name"])]
+        names = [member["Name"] for member in wanted]
+        if len(set(names)) != len(names):
+            raise ValueError("Invalid cabinet: duplicated member names")
+        for name in names:
+            if name in (".", "..") or "/" in name or "\\" in name:
+                raise ValueError(f"Invalid cabinet member name: {name}")
+        if sum(member["Size"] for member in wanted) > max_size:
+            raise ValueError(f"Cabinet content exceeds limit of {max_size}")
+        if not os.path.exists(output_path):
+            os.mkdir(output_path)
+        extracted = []
+        try:
+            with open(self.archive_path, "rb") as cab:
+                for index, folder in enumerate(self.folders):
+                    members = [m for m in wanted if m["Folder"] == index]
+                    if members:
+                        extracted += self._extract_folder(
+                            cab,
+                            folder,
+                            members,
+                            output_path
+                        )
+        except Exception:
+            for file_path in extracted:
+                os.remove(file_path)
+            raise
+        return extracted
+
+    def _extract_folder(self, cab, folder, members, output_path):
+        """Writes the members of a single folder while its blocks are
+        decompressed. The rest of the folder is not read.
+
+        Keyword arguments:
+        cab -- cabinet file
+        folder -- folder dictionary
+        members -- wanted members of the folder
+        output_path -- absolute path to the output directory
+        """
+        outputs = []
+        try:
+            for member in members:
+                file_path = os.path.join(output_path, member["Name"])
+                fd = os.open(
+                    file_path,
+                    os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                    0o644
+                )
+                outputs.append((member, file_path, os.fdopen(fd, "wb")))
+            end = max(m["Offset"] + m["Size"] for m in members)
+            position = 0
+            blocks = self._folder_blocks(cab, folder)
+            while position < end:
+                data = next(blocks, None)
+                if data is None:
+                    raise ValueError("Invalid cabinet: folder is truncated")
+                for member, __, output in outputs:
+                    start = max(member["Offset"], position)
+                    stop = min(
+                        member["Offset"] + member["Size"],
+                        position + len(data)
+                    )
+                    if start < stop:
+                        output.write(data[start - position:stop - position])
+                position += len(data)
+        except Exception:
+            for __, file_path, output in outputs:
+                output.close()
+                os.remove(file_path)
+            raise
+        for __, __, output in outputs:
+            output.close()
+        return [file_path for __, file_path, __ in outputs]
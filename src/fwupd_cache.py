@@ -0,0 +1,552 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import contextlib
+import fcntl
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+SNAPSHOT_TTL = 300
+SNAPSHOT_NAME_REGEX = re.compile(r"^[a-z0-9\-]{1,64}$")
+FIRMWARE_STORE_BUDGET = 1024 * 1024 * 1024
+FIRMWARE_STORE_INDEX = "index.json"
+FIRMWARE_STORE_LOCKS = "locks"
+FIRMWARE_CHECKSUM_REGEX = re.compile(r"^([a-f0-9]{40}|[a-f0-9]{64})$")
+FACTS_TTL = 600
+
+
+def file_stamp(file_path):
+    """Returns stamp identifying the version of the file, which changes
+    whenever the file is modified or replaced.
+
+    Keyword argument:
+    file_path -- absolute path to the file
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return "none"
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+class SnapshotCache:
+    """Stores fwupdagent output per domain, so that consecutive
+    `get-devices` and `get-updates` calls do not have to query fwupd again.
+
+    A snapshot is valid as long as it is younger than `ttl` seconds and was
+    taken with the same metadata file as the one currently in dom0. The
+    offline listings read the `get-devices` snapshots regardless of their
+    age, as the last known device inventory.
+    """
+
+    def __init__(self, cache_dir, metadata_file, ttl=SNAPSHOT_TTL,
+                 enabled=True):
+        """Keyword arguments:
+        cache_dir -- absolute path to the snapshot directory
+        metadata_file -- absolute path to the dom0 metadata file
+        ttl -- snapshot lifetime in seconds
+        enabled -- if False, nothing is loaded or stored
+        """
+        self.cache_dir = cache_dir
+        self.metadata_file = metadata_file
+        self.ttl = ttl
+        self.enabled = enabled
+
+    def _metadata_version(self):
+        """Returns stamp identifying the metadata file in use."""
+        return file_stamp(self.metadata_file)
+
+    def _snapshot_path(self, domain, command):
+        """Returns path of the snapshot file.
+
+        Keyword arguments:
+        domain -- name of the queried domain
+        command -- fwupdagent command
+        """
+        name = f"{domain}-{command}"
+        if not SNAPSHOT_NAME_REGEX.match(name):
+            raise ValueError(f"Invalid snapshot name: {name}")
+        return os.path.join(self.cache_dir, f"{name}.json")
+
+    def open(self, domain, command, check_metadata=True, check_age=True):
+        """Returns the snapshot file positioned at the cached output, or None
+        if there is no valid snapshot.
+
+        Keyword arguments:
+        domain -- name of the queried domain
+        command -- fwupdagent command
+        check_metadata -- if False, a snapshot taken with another metadata
+        file is accepted too
+        check_age -- if False, the snapshot is returned regardless of its
+        age and of the disabled cache, as the offline listings do
+        """
+        if check_age and (not self.enabled or self.ttl <= 0):
+            return None
+        snapshot_path = self._snapshot_path(domain, command)
+        try:
+            snapshot_file = open(snapshot_path)
+        except OSError:
+            return None
+        try:
+            header = json.loads(snapshot_file.readline())
+        except (OSError, ValueError):
+            header = None
+        if self._valid_header(header, check_metadata, check_age):
+            return snapshot_file
+        snapshot_file.close()
+        return None
+
+    def _valid_header(self, header, check_metadata, check_age):
+        """Returns whether the snapshot header is valid.
+
+        Keyword arguments:
+        header -- decoded header of the snapshot
+        check_metadata -- if False, a snapshot taken with another metadata
+        file is accepted too
+        check_age -- if False, a snapshot older than `ttl` is accepted too
+        """
+        if not isinstance(header, dict):
+            return False
+        if (
+            check_metadata
+            and header.get("metadata") != self._metadata_version()
+        ):
+            return False
+        created = header.get("created")
+        if not isinstance(created, (int, float)):
+            return False
+        if not check_age:
+            return True
+        return 0 <= time.time() - created < self.ttl
+
+    def load(self, domain, command, check_metadata=True, check_age=True):
+        """Returns cached output or None if there is no valid snapshot.
+
+        Keyword arguments:
+        domain -- name of the queried domain
+        command -- fwupdagent command
+        check_metadata -- if False, a snapshot taken with another metadata
+        file is accepted too
+        check_age -- if False, the snapshot is returned regardless of its
+        age and of the disabled cache
+        """
+        snapshot_file = self.open(
+            domain,
+            command,
+            check_metadata,
+            check_age
+        )
+        if snapshot_file is None:
+            return None
+        with snapshot_file:
+            try:
+                return snapshot_file.read()
+            except (OSError, ValueError):
+                return None
+
+    def writer(self, domain, command, always=False):
+        """Returns SnapshotWriter saving the output of the fwupdagent command
+        while it is written, or None if the cache is disabled.
+
+        Keyword arguments:
+        domain -- name of the queried domain
+        command -- fwupdagent command
+        always -- saves the snapshot even if the cache is disabled, so that
+        the device list stays available to the offline listings
+        """
+        if not self.enabled and not always:
+            return None
+        snapshot_path = self._snapshot_path(domain, command)
+        header = {
+            "metadata": self._metadata_version(),
+            "created": time.time(),
+        }
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return SnapshotWriter(snapshot_path, header)
+
+    def tee(self, domain, command, stream, always=False):
+        """Returns the stream, whose output is saved as the snapshot when
+        it has been read to the end.
+
+        Keyword arguments:
+        domain -- name of the queried domain
+        command -- fwupdagent command
+        stream -- readable text stream with the output
+        always -- saves the snapshot even if the cache is disabled
+        """
+        writer = self.writer(domain, command, always)
+        if writer is None:
+            return stream
+        return SnapshotTee(stream, writer)
+
+    def store(self, domain, command, output, always=False):
+        """Saves the output of the fwupdagent command.
+
+        Keyword arguments:
+        domain -- name of the queried domain
+        command -- fwupdagent command
+        output -- output to be cached
+        always -- saves the snapshot even if the cache is disabled
+        """
+        writer = self.writer(domain, command, always)
+        if writer is None:
+            return
+        writer.write(output)
+        writer.commit()
+
+    def invalidate(self, commands=None):
+        """Removes the snapshots of the given commands, or all snapshots.
+
+        Keyword argument:
+        commands -- list of fwupdagent commands, None removes all snapshots
+        """
+        if not os.path.exists(self.cache_dir):
+            return
+        if commands is None:
+            shutil.rmtree(self.cache_dir)
+            return
+        for name in os.listdir(self.cache_dir):
+            if any(name.endswith(f"-{cmd}.json") for cmd in commands):
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+class SnapshotWriter:
+    """Writes the snapshot into a temporary file, which replaces the old
+    snapshot only when the whole output has been written.
+    """
+
+    def __init__(self, snapshot_path, header):
+        """Keyword arguments:
+        snapshot_path -- absolute path to the snapshot file
+        header -- dictionary stored in the first line of the snapshot
+        """
+        self.snapshot_path = snapshot_path
+        self.tmp_path = f"{snapshot_path}.tmp"
+        self.snapshot_file = open(self.tmp_path, "w")
+        self.snapshot_file.write(json.dumps(header) + "\n")
+
+    def write(self, data):
+        """Appends the part of the output.
+
+        Keyword argument:
+        data -- part of the output
+        """
+        self.snapshot_file.write(data)
+
+    def commit(self):
+        """Replaces the old snapshot with the written one."""
+        self.snapshot_file.close()
+        os.replace(self.tmp_path, self.snapshot_path)
+
+    def discard(self):
+        """Removes the incomplete snapshot."""
+        self.snapshot_file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class SnapshotTee:
+    """Readable stream copying everything read from the wrapped stream
+    into the snapshot. The snapshot is saved at the end of the stream and
+    discarded if reading fails.
+    """
+
+    def __init__(self, stream, writer):
+        """Keyword arguments:
+        stream -- readable text stream
+        writer -- SnapshotWriter instance
+        """
+        self.stream = stream
+        self.writer = writer
+
+    def read(self, size=-1):
+        """Returns the next part of the stream.
+
+        Keyword argument:
+        size -- maximal number of the read characters
+        """
+        if self.writer is None:
+            return self.stream.read(size)
+        try:
+            data = self.stream.read(size)
+        except BaseException:
+            self.writer.discard()
+            self.writer = None
+            raise
+        if data:
+            self.writer.write(data)
+        else:
+            self.writer.commit()
+            self.writer = None
+        return data
+
+
+class FactsCache:
+    """Stores facts about the Qubes environment, which are slow to gather,
+    like the fwupd client version in usbvm or the updatevm preference.
+
+    Every fact is stored with the stamp of its source, for example the
+    modification time of a binary or the ID of a running domain. A fact is
+    gathered again when the stamp differs or the fact is older than `ttl`
+    seconds.
+    """
+
+    def __init__(self, facts_path, ttl=FACTS_TTL, enabled=True):
+        """Keyword arguments:
+        facts_path -- absolute path to the facts file
+        ttl -- lifetime of the facts in seconds
+        enabled -- if False, every fact is gathered and nothing is stored
+        """
+        self.facts_path = facts_path
+        self.ttl = ttl
+        self.enabled = enabled
+        self.facts = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        """Returns the stored facts."""
+        try:
+            with open(self.facts_path) as facts_file:
+                facts = json.load(facts_file)
+        except (OSError, ValueError):
+            return {}
+        return facts if isinstance(facts, dict) else {}
+
+    def _save(self):
+        """Saves the facts, ignoring failures."""
+        try:
+            os.makedirs(os.path.dirname(self.facts_path), exist_ok=True)
+            tmp_path = f"{self.facts_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as facts_file:
+                json.dump(self.facts, facts_file)
+            os.replace(tmp_path, self.facts_path)
+        except OSError:
+            pass
+
+    def get(self, name, stamp, gather, ttl=None):
+        """Returns the fact, which is gathered and stored if it is not
+        known for the stamp.
+
+        Keyword arguments:
+        name -- name of the fact
+        stamp -- string identifying the state of the source of the fact
+        gather -- function returning JSON serializable value of the fact
+        ttl -- lifetime of the fact in seconds, the `ttl` of the cache if
+        None
+        """
+        if not self.enabled:
+            return gather()
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            if self.facts is None:
+                self.facts = self._load()
+            fact = self.facts.get(name)
+        if (
+            isinstance(fact, dict)
+            and fact.get("stamp") == stamp
+            and isinstance(fact.get("created"), (int, float))
+            and 0 <= time.time() - fact["created"] < ttl
+            and "value" in fact
+        ):
+            return fact["value"]
+        value = gather()
+        with self.lock:
+            self.facts[name] = {
+                "stamp": stamp,
+                "created": time.time(),
+                "value": value,
+            }
+            self._save()
+        return value
+
+    def invalidate(self):
+        """Removes all facts."""
+        with self.lock:
+            self.facts = {}
+            if os.path.exists(self.facts_path):
+                os.remove(self.facts_path)
+
+
+class FirmwareStore:
+    """Keeps verified firmware archives and their extracted content
+    addressed by the checksum of the release, so that re-installing or
+    retrying a firmware does not download it again.
+
+    Entries are recorded in an index file together with their size and
+    the time of the last use. When the store exceeds its size budget,
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, store_dir, budget=FIRMWARE_STORE_BUDGET):
+        """Keyword arguments:
+        store_dir -- absolute path to the store directory
+        budget -- maximal size of the stored entries in bytes
+        """
+        self.store_dir = store_dir
+        self.budget = budget
+        self.index_path = os.path.join(store_dir, FIRMWARE_STORE_INDEX)
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """Locks the index for the read-modify-write cycle and yields its
+        entries. The entries are saved when the block ends."""
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(f"{self.index_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = self._load_index()
+            yield entries
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w") as index_file:
+                json.dump({"entries": entries}, index_file)
+            os.replace(tmp_path, self.index_path)
+
+    @contextlib.contextmanager
+    def locked(self, checksum, blocking=True):
+        """Serializes downloads of the release, so that concurrent runs
+        do not fetch the same archive twice. Yields False if `blocking` is
+        False and the release is being downloaded, True otherwise.
+
+        Keyword arguments:
+        checksum -- SHA1 or SHA256 checksum of the release
+        blocking -- waits for the running download of the release
+        """
+        self._entry_paths(checksum)
+        locks_dir = os.path.join(self.store_dir, FIRMWARE_STORE_LOCKS)
+        os.makedirs(locks_dir, exist_ok=True)
+        lock_path = os.path.join(locks_dir, f"{checksum}.lock")
+        operation = fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        with open(lock_path, "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, operation)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def _load_index(self):
+        """Returns the entries of the index file."""
+        try:
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+        entries = index.get("entries") if isinstance(index, dict) else None
+        if not isinstance(entries, dict):
+            return {}
+        return {
+            checksum: entry for checksum, entry in entries.items()
+            if FIRMWARE_CHECKSUM_REGEX.match(checksum)
+            and isinstance(entry, dict)
+            and isinstance(entry.get("size"), int)
+            and isinstance(entry.get("used"), (int, float))
+        }
+
+    def _entry_paths(self, checksum):
+        """Returns paths of the archive and of the extracted directory.
+
+        Keyword argument:
+        checksum -- SHA1 or SHA256 checksum of the release
+        """
+        if not FIRMWARE_CHECKSUM_REGEX.match(checksum):
+            raise ValueError(f"Invalid firmware checksum: {checksum}")
+        entry_path = os.path.join(self.store_dir, checksum)
+        return f"{entry_path}.cab", entry_path
+
+    def _remove_entry(self, checksum):
+        """Removes files of the entry.
+
+        Keyword argument:
+        checksum -- SHA1 or SHA256 checksum of the release
+        """
+        archive_path, extracted_path = self._entry_paths(checksum)
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        if os.path.exists(extracted_path):
+            shutil.rmtree(extracted_path)
+
+    def _evict(self, entries, keep):
+        """Removes the least recently used entries until the store fits
+        in the budget.
+
+        Keyword arguments:
+        entries -- entries of the index
+        keep -- checksum of the entry which is never evicted
+        """
+        total = sum(entry["size"] for entry in entries.values())
+        for checksum in sorted(entries, key=lambda c: entries[c]["used"]):
+            if total <= self.budget:
+                break
+            if checksum == keep:
+                continue
+            self._remove_entry(checksum)
+            total -= entries.pop(checksum)["size"]
+
+    def lookup(self, checksum):
+        """Returns path of the stored archive or None if the release is not
+        in the store. The entry is marked as recently used.
+
+        Keyword argument:
+        checksum -- SHA1 or SHA256 checksum of the release
+        """
+        archive_path, extracted_path = self._entry_paths(checksum)
+        if not os.path.exists(self.index_path):
+            return None
+        with self._locked_index() as entries:
+            if checksum not in entries:
+                return None
+            if not os.path.isfile(archive_path) or \
+                    not os.path.isdir(extracted_path):
+                del entries[checksum]
+                self._remove_entry(checksum)
+                return None
+            entries[checksum]["used"] = time.time()
+        return archive_path
+
+    def add(self, checksum, archive_path, extracted_path):
+        """Moves verified archive and its extracted content into the store
+        and returns the path of the stored archive.
+
+        Keyword arguments:
+        checksum -- SHA1 or SHA256 checksum of the release
+        archive_path -- absolute path to the verified archive
+        extracted_path -- absolute path to the extracted archive
+        """
+        stored_archive, stored_extracted = self._entry_paths(checksum)
+        size = os.path.getsize(archive_path)
+        for root, __, files in os.walk(extracted_path):
+            for name in files:
+                size += os.path.getsize(os.path.join(root, name))
+        with self._locked_index() as entries:
+            self._remove_entry(checksum)
+            os.replace(archive_path, stored_archive)
+            os.replace(extracted_path, stored_extracted)
+            entries[checksum] = {
+                "size": size,
+                "used": time.time(),
+            }
+            self._evict(entries, keep=checksum)
+        return stored_archive
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import hashlib
+import re
+
+FRAME_HEADER_MAX = 4096
+FRAME_TOKEN_REGEX = re.compile(r"^[A-Za-z0-9_.\-+=]{1,255}$")
+COPY_BUFFER_SIZE = 64 * 1024
+DIGEST_BUFFER_SIZE = 1024 * 1024
+DIGEST_ALGORITHMS = ("sha1", "sha256")
+DIGEST_LENGTHS = {
+    40: "sha1",
+    64: "sha256",
+}
+
+
+def read_header(stream):
+    """Reads a frame header and returns the list of its tokens.
+
+    Frames exchanged over qrexec consist of a single ASCII header line
+    of space separated tokens, which ends with the size of the payload,
+    followed by the payload itself.
+
+    Keyword argument:
+    stream -- binary stream
+    """
+    line = stream.readline(FRAME_HEADER_MAX + 1)
+    if not line:
+        raise EOFError("Connection closed")
+    if len(line) > FRAME_HEADER_MAX or not line.endswith(b"\n"):
+        raise ValueError("Invalid frame header")
+    try:
+        tokens = line[:-1].decode("ascii").split(" ")
+    except UnicodeDecodeError:
+        raise ValueError("Invalid frame header")
+    for token in tokens:
+        if not FRAME_TOKEN_REGEX.match(token):
+            raise ValueError("Invalid frame header")
+    return tokens
+
+
+def parse_size(token, max_size):
+    """Converts frame size token to integer.
+
+    Keyword arguments:
+    token -- size token of the frame header
+    max_size -- maximal accepted size
+    """
+    if not token.isdigit() or len(token) > 12:
+        raise ValueError(f"Invalid frame size: {token}")
+    size = int(token)
+    if size > max_size:
+        raise ValueError(f"Frame size {size} exceeds limit of {max_size}")
+    return size
+
+
+def write_frame(stream, tokens, payload=b""):
+    """Writes a frame with the payload given as bytes.
+
+    Keyword arguments:
+    stream -- binary stream
+    tokens -- list of header tokens
+    payload -- frame payload
+    """
+    header = " ".join(list(tokens) + [str(len(payload))])
+    stream.write(header.encode("ascii") + b"\n")
+    stream.write(payload)
+    stream.flush()
+
+
+def write_file_frame(stream, tokens, file_path):
+    """Writes a frame with the content of the file as the payload.
+
+    Keyword arguments:
+    stream -- binary stream
+    tokens -- list of header tokens
+    file_path -- absolute path to the sent file
+    """
+    with open(file_path, "rb") as payload:
+        payload.seek(0, 2)
+        size = payload.tell()
+        payload.seek(0)
+        header = " ".join(list(tokens) + [str(size)])
+        stream.write(header.encode("ascii") + b"\n")
+        copy_payload(payload, stream, size)
+    stream.flush()
+
+
+def copy_payload(stream, output, size, digests=()):
+    """Copies exactly `size` bytes from the stream to the output.
+
+    Keyword arguments:
+    stream -- binary input stream
+    output -- binary output stream, may be None to discard the payload
+    size -- number of bytes to copy
+    digests -- hashlib objects updated with the copied data
+    """
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(min(COPY_BUFFER_SIZE, remaining))
+        if not chunk:
+            raise EOFError("Connection closed before the end of the frame")
+        for digest in digests:
+            digest.update(chunk)
+        if output is not None:
+            output.write(chunk)
+        remaining -= len(chunk)
+
+
+def copy_stream(stream, output, max_size, digests=()):
+    """Copies the stream to the output until the end of the stream and
+    returns the number of the copied bytes. Fails as soon as the stream
+    exceeds `max_size`.
+
+    Keyword arguments:
+    stream -- binary input stream
+    output -- binary output stream
+    max_size -- maximal accepted size
+    digests -- hashlib objects updated with the copied data
+    """
+    copied = 0
+    while True:
+        chunk = stream.read(COPY_BUFFER_SIZE)
+        if not chunk:
+            return copied
+        copied += len(chunk)
+        if copied > max_size:
+            raise ValueError(f"Stream size exceeds limit of {max_size}")
+        for digest in digests:
+            digest.update(chunk)
+        output.write(chunk)
+
+
+def read_payload(stream, size):
+    """Returns the payload of the frame as bytes.
+
+    Keyword arguments:
+    stream -- binary stream
+    size -- size of the payload
+    """
+    payload = stream.read(size)
+    if len(payload) != size:
+        raise EOFError("Connection closed before the end of the frame")
+    return payload
+
+
+def file_digests(file_path, algorithms=DIGEST_ALGORITHMS):
+    """Computes the digests of the file in a single pass and returns them
+    as a dictionary of hex strings keyed by the algorithm name. The file is
+    read into one fixed-size buffer, so the memory usage does not depend
+    on the size of the file.
+
+    Keyword arguments:
+    file_path -- absolute path to the file
+    algorithms -- names of the hashlib algorithms
+    """
+    digests = [(name, hashlib.new(name)) for name in algorithms]
+    buffer = bytearray(DIGEST_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            for __, digest in digests:
+                digest.update(view[:size])
+    return {name: digest.hexdigest() for name, digest in digests}
+
+
+def digest_algorithm(checksum):
+    """Returns name of the algorithm, SHA1 or SHA256, chosen by the length
+    of the checksum.
+
+    Keyword argument:
+    checksum -- hex checksum
+    """
+    algorithm = DIGEST_LENGTHS.get(len(checksum))
+    if algorithm is None:
+        raise ValueError(f"Unsupported checksum: {checksum}")
+    return algorithm
+
+
+def compare_digest(computed, checksum):
+    """Compares computed hex digest with the expected checksum.
+
+    Keyword arguments:
+    computed -- computed hex digest
+    checksum -- expected hex checksum
+    """
+    if computed != checksum:
+        raise ValueError(
+            f"Computed checksum {computed} did NOT match {checksum}."
+        )
+
+
+def check_digest(file_path, checksum):
+    """Compares computed checksum of the file with `checksum` parameter.
+
+    Keyword arguments:
+    file_path -- absolute path to the file
+    checksum -- expected hex checksum of the file
+    """
+    algorithm = digest_algorithm(checksum)
+    compare_digest(
+        file_digests(file_path, algorithms=(algorithm,))[algorithm],
+        checksum
+    )
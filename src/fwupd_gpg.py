@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import json
+import os
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+from fwupd_common import file_digests
+
+GPG_JOBS = 4
+GPG_CACHE_MAX_ENTRIES = 64
+GPG_KEYRING_FILES = ("pubring.kbx", "pubring.gpg", "trustdb.gpg")
+GPG_STATUS_PREFIX = "[GNUPG:] "
+GPG_STATUS_FAILURES = (
+    "BADSIG",
+    "ERRSIG",
+    "EXPSIG",
+    "EXPKEYSIG",
+    "REVKEYSIG",
+    "NO_PUBKEY",
+)
+
+
+class GpgVerifier:
+    """Verifies detached GPG signatures using the machine-readable
+    `--status-fd` output of gpg.
+
+    Successful results are cached by the SHA256 digests of the data and
+    the signature, so an unchanged file is not verified again. The cache
+    is dropped whenever the keyring changes.
+    """
+
+    def __init__(self, cache_path=None, jobs=GPG_JOBS):
+        """Keyword arguments:
+        cache_path -- absolute path to the cache file, None disables
+        the cache
+        jobs -- maximal number of the concurrent gpg processes
+        """
+        self.cache_path = cache_path
+        self.jobs = jobs
+
+    def _keyring_version(self):
+        """Returns stamp identifying the state of the keyring."""
+        gpg_home = os.environ.get(
+            "GNUPGHOME",
+            os.path.join(os.path.expanduser("~"), ".gnupg")
+        )
+        version = []
+        for name in GPG_KEYRING_FILES:
+            try:
+                stat = os.stat(os.path.join(gpg_home, name))
+            except OSError:
+                continue
+            version.append([name, stat.st_mtime_ns, stat.st_size])
+        return version
+
+    def _load_cache(self):
+        """Returns cached fingerprints of the verified files, which were
+        verified with the current keyring."""
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        if cache.get("keyring") != self._keyring_version():
+            return {}
+        entries = cache.get("entries")
+        return entries if isinstance(entries, dict) else {}
+
+    def _save_cache(self, entries):
+        """Saves the cache, keeping the most recent entries.
+
+        Keyword argument:
+        entries -- dictionary of the verification keys and fingerprints
+        """
+        if self.cache_path is None:
+            return
+        keys = list(entries)[-GPG_CACHE_MAX_ENTRIES:]
+        cache = {
+            "keyring": self._keyring_version(),
+            "entries": {key: entries[key] for key in keys},
+        }
+        try:
+            with open(f"{self.cache_path}.part", "w") as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(f"{self.cache_path}.part", self.cache_path)
+        except OSError:
+            pass
+
+    def _verification_key(self, file_path, signature_path, data_sha=None):
+        """Returns the cache key of the signed file.
+
+        Keyword arguments:
+        file_path -- absolute path to the signed file
+        signature_path -- absolute path to the detached signature
+        data_sha -- already known SHA256 checksum of the signed file
+        """
+        if data_sha is None:
+            data_sha = file_digests(file_path, ("sha256",))["sha256"]
+        signature_sha = file_digests(signature_path, ("sha256",))["sha256"]
+        return f"{data_sha}:{signature_sha}"
+
+    def _parse_status(self, status):
+        """Returns fingerprint of the key which made the good signature,
+        or None if any of the signatures is not valid.
+
+        Keyword argument:
+        status -- gpg status output
+        """
+        good = False
+        fingerprint = None
+        for line in status.splitlines():
+            if not line.startswith(GPG_STATUS_PREFIX):
+                continue
+            keyword, *args = line[len(GPG_STATUS_PREFIX):].split()
+            if keyword in GPG_STATUS_FAILURES:
+                return None
+            if keyword == "GOODSIG":
+                good = True
+            elif keyword == "VALIDSIG" and args:
+                fingerprint = args[0]
+        return fingerprint if good else None
+
+    def _run_gpg(self, file_path, signature_path):
+        """Runs gpg for a single signature and returns fingerprint of
+        the signing key, or None if the verification failed.
+
+        Keyword arguments:
+        file_path -- absolute path to the signed file
+        signature_path -- absolute path to the detached signature
+        """
+        cmd_gpg = [
+            "gpg",
+            "--batch",
+            "--status-fd",
+            "1",
+            "--verify",
+            signature_path,
+            file_path,
+        ]
+        p = subprocess.Popen(
+            cmd_gpg,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        status, stderr = p.communicate()
+        print(stderr.decode("utf-8", errors="replace"))
+        if p.returncode != 0:
+            return None
+        return self._parse_status(status.decode("utf-8", errors="replace"))
+
+    def verify_many(self, pairs, digests=None):
+        """Verifies the signed files and returns fingerprints of the signing
+        keys. Files which are not in the cache are verified concurrently.
+
+        Keyword arguments:
+        pairs -- list of (file path, detached signature path) tuples
+        digests -- SHA256 checksums of the signed files computed before,
+        keyed by the file path
+        """
+        if digests is None:
+            digests = {}
+        entries = self._load_cache()
+        keys = [
+            self._verification_key(
+                file_path,
+                signature_path,
+                digests.get(file_path)
+            )
+            for file_path, signature_path in pairs
+        ]
+        fingerprints = [entries.get(key) for key in keys]
+        missing = [i for i, fpr in enumerate(fingerprints) if fpr is None]
+        if not missing:
+            return fingerprints
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            results = executor.map(
+                lambda i: self._run_gpg(*pairs[i]),
+                missing
+            )
+            for i, fingerprint in zip(missing, results):
+                fingerprints[i] = fingerprint
+        for (file_path, __), fingerprint in zip(pairs, fingerprints):
+            if fingerprint is None:
+                raise Exception(f"gpg: Verification of {file_path} failed")
+        for i in missing:
+            entries.pop(keys[i], None)
+            entries[keys[i]] = fingerprints[i]
+        self._save_cache(entries)
+        return fingerprints
+
+    def verify(self, file_path, signature_path=None):
+        """Verifies the signed file and returns fingerprint of the signing
+        key.
+
+        Keyword arguments:
+        file_path -- absolute path to the signed file
+        signature_path -- absolute path to the detached signature,
+        `<file_path>.asc` by default
+        """
+        if signature_path is None:
+            signature_path = f"{file_path}.asc"
+        return self.verify_many([(file_path, signature_path)])[0]
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import base64
+import binascii
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import zlib
+
+from fwupd_common import compare_digest, file_digests
+
+JCAT_BLOB_KIND_SHA256 = 1
+JCAT_BLOB_KIND_GPG = 2
+JCAT_BLOB_KIND_PKCS7 = 3
+JCAT_BLOB_KIND_SHA1 = 4
+JCAT_BLOB_KIND_SHA512 = 10
+JCAT_BLOB_FLAG_IS_UTF8 = 1
+JCAT_CHECKSUM_KINDS = {
+    JCAT_BLOB_KIND_SHA1: "sha1",
+    JCAT_BLOB_KIND_SHA256: "sha256",
+    JCAT_BLOB_KIND_SHA512: "sha512",
+}
+JCAT_STRONG_CHECKSUMS = ("sha256", "sha512")
+JCAT_MAX_SIZE = 1024 * 1024
+
+
+class JcatFile:
+    """Reads JSON catalog (JCAT) files published by LVFS next to the
+    metadata. A catalog is gzip-compressed JSON with a list of items, each
+    carrying checksum and signature blobs of a single file.
+    """
+
+    def __init__(self, jcat_path):
+        """Keyword argument:
+        jcat_path -- absolute path to the jcat file
+        """
+        self.jcat_path = jcat_path
+        self.items = {}
+        self._load()
+
+    def _load(self):
+        """Parses the catalog into dictionary of item ids and blobs."""
+        try:
+            with gzip.open(self.jcat_path, "rb") as jcat_file:
+                content = jcat_file.read(JCAT_MAX_SIZE + 1)
+            if len(content) > JCAT_MAX_SIZE:
+                raise ValueError(f"size exceeds limit of {JCAT_MAX_SIZE}")
+            catalog = json.loads(content)
+            for item in catalog["Items"]:
+                self.items[str(item["Id"])] = [
+                    self._parse_blob(blob) for blob in item.get("Blobs", [])
+                ]
+        except (
+            AttributeError,
+            OSError,
+            EOFError,
+            zlib.error,
+            KeyError,
+            TypeError,
+            ValueError
+        ) as e:
+            raise ValueError(f"Invalid jcat file {self.jcat_path}: {e}")
+
+    def _parse_blob(self, blob):
+        """Returns kind, target and decoded data of the blob.
+
+        Keyword argument:
+        blob -- blob dictionary of the catalog
+        """
+        data = blob["Data"]
+        if blob.get("Flags", 0) & JCAT_BLOB_FLAG_IS_UTF8:
+            data = data.encode("utf-8")
+        else:
+            try:
+                data = base64.b64decode(data, validate=True)
+            except binascii.Error:
+                raise ValueError("Invalid base64 data of blob")
+        return {
+            "Kind": int(blob["Kind"]),
+            "Target": blob.get("Target", 0),
+            "Data": data,
+        }
+
+    def blobs(self, item_id, kind):
+        """Returns data of the blobs of the given kind, which are related
+        to the file itself, not to the other blobs.
+
+        Keyword arguments:
+        item_id -- id of the item, the file name
+        kind -- kind of the blobs
+        """
+        return [
+            blob["Data"] for blob in self.items.get(item_id, [])
+            if blob["Kind"] == kind and not blob["Target"]
+        ]
+
+    def verify_checksums(self, file_path, item_id=None):
+        """Checks the file against all checksum blobs of its item and
+        returns the computed digests. At least SHA256 or SHA512 checksum
+        is required.
+
+        Keyword arguments:
+        file_path -- absolute path to the file
+        item_id -- id of the item, the file name by default
+        """
+        if item_id is None:
+            item_id = os.path.basename(file_path)
+        checksums = [
+            (JCAT_CHECKSUM_KINDS[kind], checksum.decode("ascii").strip())
+            for kind in JCAT_CHECKSUM_KINDS
+            for checksum in self.blobs(item_id, kind)
+        ]
+        algorithms = {name for name, __ in checksums}
+        if not algorithms.intersection(JCAT_STRONG_CHECKSUMS):
+            raise ValueError(f"No SHA256 checksum of {item_id} in jcat file")
+        algorithms.add("sha256")
+        digests = file_digests(file_path, sorted(algorithms))
+        for name, checksum in checksums:
+            compare_digest(digests[name], checksum.lower())
+        return digests
+
+    def verify(self, file_path, gpg_verifier, item_id=None):
+        """Checks the embedded checksums of the file first, so a corrupted
+        file is rejected without running gpg. Then verifies the detached
+        signature of the file together with the GPG blobs of the catalog,
+        which differ from it.
+
+        Keyword arguments:
+        file_path -- absolute path to the file
+        gpg_verifier -- GpgVerifier instance
+        item_id -- id of the item, the file name by default
+        """
+        if item_id is None:
+            item_id = os.path.basename(file_path)
+        digests = self.verify_checksums(file_path, item_id)
+        signature_path = f"{file_path}.asc"
+        with open(signature_path, "rb") as signature_file:
+            detached = signature_file.read()
+        pairs = [(file_path, signature_path)]
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for i, blob in enumerate(self.blobs(item_id, JCAT_BLOB_KIND_GPG)):
+                if blob.strip() == detached.strip():
+                    continue
+                blob_path = os.path.join(tmp_dir, f"{i}.asc")
+                with open(blob_path, "wb") as blob_file:
+                    blob_file.write(blob)
+                pairs.append((file_path, blob_path))
+            gpg_verifier.verify_many(
+                pairs,
+                digests={file_path: digests["sha256"]}
+            )
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import xml.etree.ElementTree as ET
+import zlib
+
+from xml.sax.saxutils import escape
+
+from fwupd_common import file_digests
+
+METADATA_INDEX_SCHEMA = 1
+METADATA_INDEX_TABLES = (
+    """CREATE TABLE IF NOT EXISTS info (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS components (
+        id TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        name TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS guids (
+        guid TEXT NOT NULL,
+        component TEXT NOT NULL,
+        PRIMARY KEY (guid, component)
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS releases (
+        component TEXT NOT NULL,
+        version TEXT NOT NULL,
+        url TEXT NOT NULL,
+        checksum TEXT NOT NULL,
+        sha256 TEXT,
+        size INTEGER,
+        description TEXT NOT NULL
+    )""",
+    """CREATE INDEX IF NOT EXISTS releases_component
+        ON releases (component)""",
+)
+
+
+def _inner_xml(element):
+    """Returns the markup of the release description. The description
+    consists only of paragraphs and lists without attributes.
+
+    Keyword argument:
+    element -- XML element
+    """
+    content = escape(element.text or "")
+    for child in element:
+        content += (
+            f"<{child.tag}>{_inner_xml(child)}</{child.tag}>"
+            f"{escape(child.tail or '')}"
+        )
+    return content
+
+
+def _parse_release(release):
+    """Returns dictionary of the release element, or None if the release
+    has no location or SHA1 checksum of the archive.
+
+    Keyword argument:
+    release -- release element of the component
+    """
+    checksums = {
+        checksum.get("type"): (checksum.text or "").strip()
+        for checksum in release.iterfind("checksum")
+        if checksum.get("target") == "container"
+    }
+    url = (release.findtext("location") or "").strip()
+    if not url or not checksums.get("sha1") or not release.get("version"):
+        return None
+    size = release.findtext("size[@type='download']")
+    description = release.find("description")
+    return {
+        "Version": release.get("version"),
+        "Uri": url,
+        "Checksum": checksums["sha1"],
+        "Sha256": checksums.get("sha256"),
+        "Size": int(size) if size and size.strip().isdigit() else None,
+        "Description": (
+            _inner_xml(description).strip() if description is not None
+            else ""
+        ),
+    }
+
+
+def _parse_component(component):
+    """Returns dictionary of the firmware component element.
+
+    Keyword argument:
+    component -- component element of the metadata
+    """
+    releases = [
+        _parse_release(release)
+        for release in component.iterfind("releases/release")
+    ]
+    component = {
+        "Id": (component.findtext("id") or "").strip(),
+        "Name": component.findtext("name"),
+        "Guids": sorted(
+            {
+                firmware.text.strip().lower()
+                for firmware in component.iterfind("provides/firmware")
+                if firmware.get("type") == "flashed" and firmware.text
+            }
+        ),
+        "Releases": [release for release in releases if release],
+    }
+    component["Digest"] = hashlib.sha256(
+        json.dumps(component).encode()
+    ).hexdigest()
+    return component
+
+
+def iter_components(metadata_file):
+    """Yields the firmware components of the gzip-compressed AppStream
+    metadata one by one. Every component is dropped from the tree once it
+    is parsed, so the memory usage does not grow with the metadata.
+
+    Keyword argument:
+    metadata_file -- absolute path to the firmware.xml.gz file
+    """
+    with gzip.open(metadata_file, "rb") as xml_file:
+        root = None
+        for event, element in ET.iterparse(xml_file, ("start", "end")):
+            if root is None:
+                root = element
+            elif event == "end" and element.tag == "component":
+                if element.get("type", "firmware") == "firmware":
+                    yield _parse_component(element)
+                root.clear()
+
+
+class MetadataIndex:
+    """SQLite index of the LVFS metadata keyed by device GUID.
+
+    The index is rebuilt only when the digest of the metadata file
+    changes. Components whose content is the same as in the previous
+    metadata are kept, only the changed ones are written again.
+    """
+
+    def __init__(self, index_path):
+        """Keyword argument:
+        index_path -- absolute path to the SQLite database
+        """
+        self.index_path = index_path
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Opens the database and commits the changes on success."""
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        db = sqlite3.connect(self.index_path)
+        try:
+            with db:
+                for table in METADATA_INDEX_TABLES:
+                    db.execute(table)
+                yield db
+        finally:
+            db.close()
+
+    def _info(self, db, key):
+        """Returns the stored value of the index information.
+
+        Keyword arguments:
+        db -- database connection
+        key -- key of the value
+        """
+        row = db.execute(
+            "SELECT value FROM info WHERE key = ?",
+            (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _delete_component(self, db, component_id):
+        """Removes the component with its GUIDs and releases.
+
+        Keyword arguments:
+        db -- database connection
+        component_id -- id of the component
+        """
+        for table, column in (
+            ("components", "id"),
+            ("guids", "component"),
+            ("releases", "component"),
+        ):
+            db.execute(
+                f"DELETE FROM {table} WHERE {column} = ?",
+                (component_id,)
+            )
+
+    def _insert_component(self, db, component_id, component):
+        """Writes the component with its GUIDs and releases.
+
+        Keyword arguments:
+        db -- database connection
+        component_id -- id of the component
+        component -- component dictionary
+        """
+        db.execute(
+            "INSERT INTO components (id, digest, name) VALUES (?, ?, ?)",
+            (component_id, component["Digest"], component["Name"])
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO guids (guid, component) VALUES (?, ?)",
+            [(guid, component_id) for guid in component["Guids"]]
+        )
+        db.executemany(
+            "INSERT INTO releases (component, version, url, checksum, "
+            "sha256, size, description) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    component_id,
+                    release["Version"],
+                    release["Uri"],
+                    release["Checksum"],
+                    release["Sha256"],
+                    release["Size"],
+                    release["Description"],
+                ) for release in component["Releases"]
+            ]
+        )
+
+    def update(self, metadata_file):
+        """Brings the index up to date with the metadata file. Returns
+        False if the index already matches the metadata.
+
+        Keyword argument:
+        metadata_file -- absolute path to the firmware.xml.gz file
+        """
+        digest = file_digests(metadata_file, ("sha256",))["sha256"]
+        try:
+            return self._update(metadata_file, digest)
+        except (ET.ParseError, sqlite3.Error, EOFError, zlib.error) as e:
+            raise ValueError(f"Indexing of {metadata_file} failed: {e}")
+
+    def _update(self, metadata_file, digest):
+        """Writes the changed components of the metadata to the index.
+
+        Keyword arguments:
+        metadata_file -- absolute path to the firmware.xml.gz file
+        digest -- SHA256 checksum of the metadata file
+        """
+        with self._connect() as db:
+            if (
+                self._info(db, "schema") == str(METADATA_INDEX_SCHEMA)
+                and self._info(db, "digest") == digest
+            ):
+                return False
+            if self._info(db, "schema") != str(METADATA_INDEX_SCHEMA):
+                for table in ("components", "guids", "releases"):
+                    db.execute(f"DELETE FROM {table}")
+            known = dict(db.execute("SELECT id, digest FROM components"))
+            seen = {}
+            for component in iter_components(metadata_file):
+                # The same component id may be published more than once.
+                occurrence = seen.get(component["Id"], 0)
+                seen[component["Id"]] = occurrence + 1
+                component_id = f"{component['Id']}#{occurrence}"
+                known_digest = known.pop(component_id, None)
+                if known_digest == component["Digest"]:
+                    continue
+                if known_digest is not None:
+                    self._delete_component(db, component_id)
+                self._insert_component(db, component_id, component)
+            for component_id in known:
+                self._delete_component(db, component_id)
+            db.executemany(
+                "INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)",
+                [("schema", str(METADATA_INDEX_SCHEMA)), ("digest", digest)]
+            )
+        return True
+
+    def releases(self, guids):
+        """Returns releases of the components providing any of the GUIDs
+        as dictionaries in the format of fwupdagent.
+
+        Keyword argument:
+        guids -- list of the device GUIDs
+        """
+        guids = list(guids)
+        if not guids or not os.path.exists(self.index_path):
+            return []
+        placeholders = ", ".join("?" * len(guids))
+        try:
+            with self._connect() as db:
+                rows = db.execute(
+                    "SELECT DISTINCT r.version, r.url, r.checksum, r.sha256, "
+                    "r.size, r.description FROM guids g JOIN releases r "
+                    "ON r.component = g.component "
+                    f"WHERE g.guid IN ({placeholders})",
+                    [guid.lower() for guid in guids]
+                ).fetchall()
+        except sqlite3.Error as e:
+            raise ValueError(f"Query of {self.index_path} failed: {e}")
+        releases = []
+        for version, url, checksum, sha256, size, description in rows:
+            release = {
+                "Version": version,
+                "Uri": url,
+                "Checksum": [checksum] + ([sha256] if sha256 else []),
+                "Description": description,
+            }
+            if size is not None:
+                release["Size"] = size
+            releases.append(release)
+        return releases
@@ -0,0 +1,439 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import io
+import json
+import re
+
+from fwupd_version import sort_releases
+
+JSON_CHUNK_SIZE = 64 * 1024
+JSON_ELEMENT_MAX_SIZE = 16 * 1024 * 1024
+JSON_WHITESPACE_REGEX = re.compile(r"[ \t\n\r]*")
+# Fields of the fwupdagent output read by the device model. The other ones,
+# like Icons, Guid or Flags, are dropped as soon as their object is decoded.
+MODEL_KEYS = frozenset(
+    (
+        "Name",
+        "DeviceId",
+        "Version",
+        "VersionFormat",
+        "Releases",
+        "Uri",
+        "Checksum",
+        "Description",
+        "Size",
+    )
+)
+MODEL_TEXT_MAX = 64 * 1024
+MODEL_TEXT_REGEX = re.compile(r"^[^\x00-\x08\x0b-\x1f\x7f-\x9f]*$")
+MODEL_VERSION_REGEX = re.compile(r"^[A-Za-z0-9_.\-+~:]{1,64}$")
+MODEL_VERSION_FORMAT_REGEX = re.compile(r"^[a-z0-9\-]{1,32}$")
+MODEL_URL_REGEX = re.compile(r"^https?://[A-Za-z0-9_.\-~/:%+=?&]{1,2048}$")
+MODEL_CHECKSUM_REGEX = re.compile(r"^([a-f0-9]{40}|[a-f0-9]{64})$")
+
+
+class Release:
+    """Firmware release offered for a device. Only the fields used by
+    qubes-fwupdmgr are kept.
+    """
+    __slots__ = ("version", "url", "checksum", "description", "size")
+
+    def __init__(self, version, url, checksum, description="", size=None):
+        """Keyword arguments:
+        version -- version of the firmware
+        url -- url path to the firmware update archive
+        checksum -- SHA1 checksum of the firmware update archive
+        description -- HTML description of the release
+        size -- size of the firmware update archive in bytes, if known
+        """
+        self.version = version
+        self.url = url
+        self.checksum = checksum
+        self.description = description
+        self.size = size
+
+    @classmethod
+    def from_json(cls, release):
+        """Creates the release from the fwupdagent release dictionary.
+
+        Keyword argument:
+        release -- release dictionary
+        """
+        size = release.get("Size")
+        if isinstance(size, bool) or not isinstance(size, int) or size < 0:
+            size = None
+        return cls(
+            release["Version"],
+            release["Uri"],
+            release["Checksum"][0],
+            release.get("Description", ""),
+            size
+        )
+
+    def to_json(self):
+        """Returns the release dictionary of the JSON output."""
+        return {
+            "Version": self.version,
+            "Uri": self.url,
+            "Checksum": self.checksum,
+            "Description": self.description,
+            "Size": self.size,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, Release):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __repr__(self):
+        return f"Release({self.version!r}, {self.url!r}, {self.checksum!r})"
+
+
+class Device:
+    """Device reported by fwupdagent with its releases sorted from
+    the newest to the oldest one.
+    """
+    __slots__ = ("name", "version", "version_format", "releases")
+
+    def __init__(self, name, version=None, version_format=None,
+                 releases=()):
+        """Keyword arguments:
+        name -- name of the device
+        version -- current firmware version, None if it is not reported
+        version_format -- VersionFormat of the device
+        releases -- list of Release instances
+        """
+        self.name = name
+        self.version = version
+        self.version_format = version_format
+        self.releases = sort_releases(releases, version_format)
+
+    @classmethod
+    def from_json(cls, device):
+        """Creates the device from the fwupdagent device dictionary, whose
+        releases have been already converted.
+
+        Keyword argument:
+        device -- device dictionary
+        """
+        return cls(
+            device["Name"],
+            device.get("Version"),
+            device.get("VersionFormat"),
+            [
+                release for release in device.get("Releases", [])
+                if isinstance(release, Release)
+            ]
+        )
+
+    def to_json(self):
+        """Returns the device dictionary of the JSON output."""
+        return {
+            "Name": self.name,
+            "Version": self.version,
+            "VersionFormat": self.version_format,
+            "Releases": [release.to_json() for release in self.releases],
+        }
+
+    def __repr__(self):
+        return f"Device({self.name!r}, {self.version!r})"
+
+
+def _model_hook(obj):
+    """Replaces the release and device dictionaries with the model objects
+    while the JSON is decoded, so the unused fields are dropped as soon as
+    their object is complete.
+
+    Keyword argument:
+    obj -- decoded JSON object
+    """
+    if "Uri" in obj and "Checksum" in obj and "Version" in obj:
+        return Release.from_json(obj)
+    if "Name" in obj and ("Releases" in obj or "DeviceId" in obj):
+        return Device.from_json(obj)
+    return obj
+
+
+def _check_text(text, field, regex=MODEL_TEXT_REGEX):
+    """Checks the untrusted string field of the device.
+
+    Keyword arguments:
+    text -- value of the field
+    field -- name of the field
+    regex -- pattern of the valid value
+    """
+    if (
+        not isinstance(text, str)
+        or len(text) > MODEL_TEXT_MAX
+        or not regex.match(text)
+    ):
+        raise ValueError(f"Invalid device {field}: {text!r:.80}")
+
+
+def check_device(device):
+    """Checks the device received from an untrusted domain, so that it can
+    be printed and its releases downloaded. Raises ValueError on invalid
+    field.
+
+    Keyword argument:
+    device -- Device instance
+    """
+    _check_text(device.name, "name")
+    if device.version is not None:
+        _check_text(device.version, "version", MODEL_VERSION_REGEX)
+    if device.version_format is not None:
+        _check_text(
+            device.version_format,
+            "version format",
+            MODEL_VERSION_FORMAT_REGEX
+        )
+    for release in device.releases:
+        _check_text(release.version, "release version", MODEL_VERSION_REGEX)
+        _check_text(release.url, "release url", MODEL_URL_REGEX)
+        _check_text(release.checksum, "checksum", MODEL_CHECKSUM_REGEX)
+        _check_text(release.description, "release description")
+
+
+def _model_pairs_hook(pairs):
+    """Keeps only the fields of the device model and converts the object
+    as `_model_hook` does.
+
+    Keyword argument:
+    pairs -- list of the decoded key and value pairs
+    """
+    return _model_hook(
+        {key: value for key, value in pairs if key in MODEL_KEYS}
+    )
+
+
+class AgentOutput:
+    """Readable output of a running fwupdagent process. The exit status is
+    checked when the output ends, so a failed query raises instead of
+    reporting the end of the stream.
+    """
+
+    def __init__(self, process, error_msg, copy_path=None):
+        """Keyword arguments:
+        process -- subprocess.Popen instance with the text stdout pipe
+        error_msg -- message of the exception raised on failure
+        copy_path -- absolute path to the file receiving a copy of the
+        read output, meant for debugging
+        """
+        self.process = process
+        self.error_msg = error_msg
+        self.copy_file = None
+        if copy_path is not None:
+            self.copy_file = open(copy_path, "w")
+
+    def read(self, size=-1):
+        """Returns the next part of the output.
+
+        Keyword argument:
+        size -- maximal number of the read characters
+        """
+        data = self.process.stdout.read(size)
+        if self.copy_file is not None:
+            self.copy_file.write(data)
+            if not data:
+                self.copy_file.close()
+        if not data:
+            self.process.stdout.close()
+            if self.process.wait() != 0:
+                raise Exception(self.error_msg)
+        return data
+
+
+class _JsonStream:
+    """Buffer of the JSON text read from a stream, which holds only the
+    value being decoded."""
+
+    def __init__(self, stream, chunk_size):
+        """Keyword arguments:
+        stream -- readable text stream
+        chunk_size -- number of the characters read at once
+        """
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Appends the next chunk of the stream to the buffer and drops the
+        decoded part. Returns False at the end of the stream."""
+        if self.eof:
+            return False
+        pending = len(self.buffer) - self.pos
+        if pending > JSON_ELEMENT_MAX_SIZE:
+            raise ValueError(
+                f"JSON value exceeds limit of {JSON_ELEMENT_MAX_SIZE}"
+            )
+        # A value spanning many chunks is read in growing parts, so it is
+        # not decoded again for every chunk.
+        chunk = self.stream.read(max(self.chunk_size, pending))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character, or an empty string
+        at the end of the stream."""
+        while True:
+            self.pos = JSON_WHITESPACE_REGEX.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def skip(self, char):
+        """Consumes the character if it comes next and returns whether it
+        did.
+
+        Keyword argument:
+        char -- structural character of JSON
+        """
+        if self.peek() != char:
+            return False
+        self.pos += 1
+        return True
+
+    def expect(self, char):
+        """Consumes the character, which has to come next.
+
+        Keyword argument:
+        char -- structural character of JSON
+        """
+        if not self.skip(char):
+            raise ValueError(f"Invalid JSON: expecting '{char}'")
+
+    def decode(self, decoder):
+        """Decodes the next complete value.
+
+        Keyword argument:
+        decoder -- json.JSONDecoder instance
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next
+            # chunk.
+            if (
+                isinstance(value, (int, float))
+                and end == len(self.buffer)
+                and self._fill()
+            ):
+                continue
+            self.pos = end
+            return value
+
+    def end(self):
+        """Checks that only whitespace is left in the stream."""
+        if self.peek():
+            raise ValueError("Invalid JSON: extra data")
+
+
+def iter_json_array(stream, key, object_pairs_hook=None,
+                    chunk_size=JSON_CHUNK_SIZE):
+    """Yields elements of the array stored under the key of the top level
+    JSON object, while the stream is read. Only a single element is held
+    in memory at a time.
+
+    Keyword arguments:
+    stream -- readable text stream
+    key -- key of the array
+    object_pairs_hook -- hook of the JSON decoder called for every object
+    chunk_size -- number of the characters read at once
+    """
+    reader = _JsonStream(stream, chunk_size)
+    decoder = json.JSONDecoder(object_pairs_hook=object_pairs_hook)
+    plain_decoder = json.JSONDecoder()
+    found = False
+    reader.expect("{")
+    if not reader.skip("}"):
+        while True:
+            name = reader.decode(plain_decoder)
+            if not isinstance(name, str):
+                raise ValueError("Invalid JSON: expecting object key")
+            reader.expect(":")
+            if name == key and reader.peek() == "[":
+                found = True
+                reader.expect("[")
+                if not reader.skip("]"):
+                    while True:
+                        yield reader.decode(decoder)
+                        if reader.skip("]"):
+                            break
+                        reader.expect(",")
+            else:
+                reader.decode(plain_decoder)
+            if reader.skip("}"):
+                break
+            reader.expect(",")
+    reader.end()
+    if not found:
+        raise ValueError(f"Invalid JSON: missing {key} list")
+
+
+def iter_devices(stream):
+    """Yields the devices of the fwupdagent `get-devices` or `get-updates`
+    output one by one, while the output is read.
+
+    Keyword argument:
+    stream -- readable text stream with JSON output of fwupdagent
+    """
+    for device in iter_json_array(stream, "Devices", _model_pairs_hook):
+        if isinstance(device, Device):
+            yield device
+        else:
+            yield Device.from_json(device)
+
+
+def as_stream(devices_info):
+    """Returns readable stream of the fwupdagent output given as a string
+    or as a stream.
+
+    Keyword argument:
+    devices_info -- JSON output of fwupdagent
+    """
+    if isinstance(devices_info, str):
+        return io.StringIO(devices_info)
+    return devices_info
+
+
+def parse_devices(devices_info):
+    """Returns list of the devices of the fwupdagent `get-devices` or
+    `get-updates` output.
+
+    Keyword argument:
+    devices_info -- JSON output of fwupdagent, a string or a stream
+    """
+    return list(iter_devices(as_stream(devices_info)))
@@ -0,0 +1,352 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import json
+import os
+import re
+import sys
+
+OUTPUT_JSON = "json"
+OUTPUT_NDJSON = "ndjson"
+# EXIT_CODES["ERROR"] of qubes_fwupdmgr
+OUTPUT_ERROR_CODE = 1
+TREE_DECORATOR = 70 * "="
+UPDATES_DECORATOR = 54 * "="
+UPDATES_SEPARATOR = 54 * "^"
+TREE_KEY_MAX_LENGTH = 12
+TREE_SKIPPED_KEYS = ("Icons", "Releases")
+RENDER_CACHE_MAX_ENTRIES = 4096
+DESCRIPTION_TAGS_REGEX = re.compile(r"</?(?:p|li|ul)>")
+DESCRIPTION_BREAKS = ("</p>", "</li>")
+
+
+def strip_description(description, indent):
+    """Returns the release description without the HTML tags. Paragraphs
+    and list items are ended with a new line and the indent.
+
+    Keyword arguments:
+    description -- HTML description of the release
+    indent -- indent of the lines following the first one
+    """
+    newline = "\n" + indent
+    return DESCRIPTION_TAGS_REGEX.sub(
+        lambda tag: newline if tag.group(0) in DESCRIPTION_BREAKS else "",
+        description
+    )
+
+
+def _tabs(key_word):
+    """Returns the key word aligned to the column of the values.
+
+    Keyword argument:
+    key_word -- key word of the line
+    """
+    return key_word + "\t" * (4 - len(key_word) // 8)
+
+
+class JsonOutput:
+    """Collects the records of a command and writes them to stdout with
+    a single write when the command finishes.
+
+    While the command runs, stdout of the process and of its children is
+    redirected to stderr, so that the progress messages and the prompts
+    never mix with the machine-readable output.
+
+    The JSON document has the `Command`, `ExitCode` and `Records` keys and
+    `Error` key if the command failed. The NDJSON output has one record
+    per line followed by the line with the command result.
+    """
+
+    def __init__(self, command, output_format=OUTPUT_JSON):
+        """Keyword arguments:
+        command -- name of the command
+        output_format -- `json` or `ndjson`
+        """
+        self.command = command
+        self.output_format = output_format
+        self.records = []
+        self.error = None
+
+    def add(self, record):
+        """Adds the record to the output.
+
+        Keyword argument:
+        record -- JSON serializable dictionary
+        """
+        self.records.append(record)
+
+    def dumps(self, exit_code):
+        """Returns the serialized output of the command.
+
+        Keyword argument:
+        exit_code -- exit code of the command
+        """
+        result = {"Command": self.command, "ExitCode": exit_code}
+        if self.error is not None:
+            result["Error"] = self.error
+        if self.output_format == OUTPUT_NDJSON:
+            lines = [
+                json.dumps(record, sort_keys=True) for record in self.records
+            ]
+            lines.append(json.dumps(result, sort_keys=True))
+            return "\n".join(lines) + "\n"
+        result["Records"] = self.records
+        return json.dumps(result, indent=2, sort_keys=True) + "\n"
+
+    def run(self, func, *args):
+        """Runs the command with stdout redirected to stderr, writes its
+        output and returns the exit code. Errors of the command are
+        reported in the output instead of being raised.
+
+        Keyword arguments:
+        func -- function of the command returning the exit code or None
+        *args -- arguments of the function
+        """
+        stdout = sys.stdout
+        stdout.flush()
+        stdout_fd = os.dup(1)
+        os.dup2(2, 1)
+        sys.stdout = sys.stderr
+        try:
+            ret = func(*args)
+            exit_code = 0 if ret is None else ret
+        except SystemExit as e:
+            exit_code = 0 if e.code is None else e.code
+        except Exception as e:
+            self.error = str(e)
+            exit_code = OUTPUT_ERROR_CODE
+        finally:
+            sys.stdout.flush()
+            sys.stdout = stdout
+            os.dup2(stdout_fd, 1)
+            os.close(stdout_fd)
+        stdout.write(self.dumps(exit_code))
+        stdout.flush()
+        return exit_code
+
+
+def _tree_content(updev_dict):
+    """Returns the content of the dictionary shown in the tree, which
+    identifies its rendered block.
+
+    Keyword argument:
+    updev_dict -- update/device information dictionary
+    """
+    return json.dumps(
+        [
+            (key, value) for key, value in updev_dict.items()
+            if len(key) <= TREE_KEY_MAX_LENGTH
+            and key not in TREE_SKIPPED_KEYS
+        ]
+    )
+
+
+class TextRenderer:
+    """Renders the human readable device and update listings. A listing is
+    rendered into a single string, or device by device while the devices
+    are read.
+
+    The rendered blocks of the devices are cached by their content, so
+    a device which has been rendered before is not formatted again.
+    """
+
+    def __init__(self, cache_size=RENDER_CACHE_MAX_ENTRIES):
+        """Keyword argument:
+        cache_size -- maximal number of the cached blocks
+        """
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def _cached(self, key, render, *args):
+        """Returns the cached block, or renders and caches it.
+
+        Keyword arguments:
+        key -- hashable content of the block
+        render -- function rendering the block
+        *args -- arguments of the function
+        """
+        block = self.cache.get(key)
+        if block is None:
+            block = render(*args)
+            if len(self.cache) >= self.cache_size:
+                del self.cache[next(iter(self.cache))]
+            self.cache[key] = block
+        return block
+
+    def tree(self, updev_dict, level=0, prefix=""):
+        """Returns the device or help information rendered as a tree.
+
+        Keyword arguments:
+        updev_dict -- update/device information dictionary
+        level -- level of the tree
+        prefix -- prefix of the lists on the top level of the tree
+        """
+        lines = []
+        self._tree(updev_dict, level, prefix, lines)
+        return "\n".join(lines) + "\n"
+
+    def device_tree(self, devices, prefix=""):
+        """Yields the device list rendered as a tree device by device. The
+        output is the same as the tree of the `Devices` dictionary.
+
+        Keyword arguments:
+        devices -- iterable of the device dictionaries
+        prefix -- prefix of the device list
+        """
+        yield TREE_DECORATOR + "\n"
+        header = prefix + _tabs("Devices:") + "\n"
+        for device in devices:
+            if header:
+                yield header
+                header = None
+            yield self._cached(
+                (1, _tree_content(device)),
+                self._tree_block,
+                device,
+                1
+            ) + "\n"
+
+    def _tree_block(self, updev_dict, level):
+        """Returns the nested dictionary rendered as a block of lines.
+
+        Keyword arguments:
+        updev_dict -- nested dictionary
+        level -- level of the tree
+        """
+        lines = []
+        self._tree(updev_dict, level, "", lines)
+        return "\n".join(lines)
+
+    def _tree(self, updev_dict, level, prefix, lines):
+        """Appends the lines of the tree to the list.
+
+        Keyword arguments:
+        updev_dict -- update/device information dictionary
+        level -- level of the tree
+        prefix -- prefix of the lists on the top level of the tree
+        lines -- list of the rendered lines
+        """
+        lines.append(TREE_DECORATOR)
+        style = "\t" * level
+        for key, value in updev_dict.items():
+            if len(key) > TREE_KEY_MAX_LENGTH or key in TREE_SKIPPED_KEYS:
+                continue
+            output = style + _tabs(key + ":")
+            if key == "Name":
+                lines.append(style + value)
+                lines.append(TREE_DECORATOR)
+            elif isinstance(value, str):
+                lines.append(output + value)
+            elif isinstance(value, int):
+                lines.append(output + str(value))
+            elif not isinstance(value, list) or not value:
+                continue
+            elif isinstance(value[0], str):
+                lines.append(output + "\u00B7" + value[0])
+                lines.extend(
+                    style + _tabs(" ") + "\u00B7" + data
+                    for data in value[1:]
+                )
+            elif isinstance(value[0], dict):
+                if level == 0:
+                    lines.append(prefix + output)
+                for nested_dict in value:
+                    lines.append(
+                        self._cached(
+                            (level + 1, _tree_content(nested_dict)),
+                            self._tree_block,
+                            nested_dict,
+                            level + 1
+                        )
+                    )
+
+    def _releases_block(self, device):
+        """Returns the current version and the releases of the device.
+
+        Keyword argument:
+        device -- Device with available releases
+        """
+        lines = [f"   Current firmware version:\t {device.version}"]
+        for update in device.releases:
+            description = strip_description(update.description, "\t")
+            lines += [
+                UPDATES_DECORATOR,
+                f"   Firmware update version:\t {update.version}",
+                f"   URL:\t {update.url}",
+                f"   SHA1 checksum:\t {update.checksum}",
+                f"   Description: {description}",
+            ]
+        lines.append(UPDATES_DECORATOR)
+        return "\n".join(lines)
+
+    def iter_updates(self, updates_list, title, prefix=0):
+        """Yields the list of the updates rendered device by device, each
+        part together with whether any update has been available so far.
+
+        Keyword arguments:
+        updates_list -- iterable of the Device instances
+        title -- title of the list
+        prefix -- device number prefix
+        """
+        available_updates = False
+        yield "\n".join(
+            [UPDATES_DECORATOR, title, UPDATES_DECORATOR]
+        ) + "\n", available_updates
+        for i, device in enumerate(updates_list):
+            if not device.releases:
+                continue
+            lines = []
+            if not available_updates:
+                lines += ["Available updates:", UPDATES_DECORATOR]
+                available_updates = True
+            lines += [
+                UPDATES_SEPARATOR,
+                f"{i+1+prefix}. Device: {device.name}"
+            ]
+            key = (
+                device.version,
+                tuple(
+                    (r.version, r.url, r.checksum, r.description)
+                    for r in device.releases
+                )
+            )
+            lines.append(self._cached(key, self._releases_block, device))
+            yield "\n".join(lines) + "\n", available_updates
+        if not available_updates:
+            yield "No updates available.\n", available_updates
+
+    def updates(self, updates_list, title, prefix=0):
+        """Returns the rendered list of the updates and whether any update
+        is available.
+
+        Keyword arguments:
+        updates_list -- list of the Device instances
+        title -- title of the list
+        prefix -- device number prefix
+        """
+        parts = []
+        available_updates = False
+        for output, available_updates in self.iter_updates(
+            updates_list,
+            title,
+            prefix
+        ):
+            parts.append(output)
+        return "".join(parts), available_updates
@@ -19,7 +19,6 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
 #
-import glob
 import grp
 import hashlib
 import os
@@ -28,11 +27,31 @@ import re
 import shutil
 import sys
 import subprocess
+import zlib
+
+from fwupd_cab import CabinetReader
+from fwupd_cache import FIRMWARE_CHECKSUM_REGEX, FirmwareStore
+from fwupd_common import (
+    compare_digest,
+    copy_payload,
+    copy_stream,
+    digest_algorithm,
+    parse_size,
+    read_header,
+)
+from fwupd_gpg import GpgVerifier
+from fwupd_jcat import JcatFile
 
 FWUPD_DOM0_DIR = "/root/.cache/fwupd"
 FWUPD_DOM0_UPDATES_DIR = path.join(FWUPD_DOM0_DIR, "updates")
+FWUPD_DOM0_GPG_CACHE = path.join(FWUPD_DOM0_DIR, "gpg-cache.json")
 FWUPD_DOM0_UNTRUSTED_DIR = path.join(FWUPD_DOM0_UPDATES_DIR, "untrusted")
+FWUPD_DOM0_STORE_DIR = path.join(FWUPD_DOM0_UPDATES_DIR, "store")
 FWUPD_DOM0_METADATA_DIR = path.join(FWUPD_DOM0_DIR, "metadata")
+FWUPD_DOM0_UNTRUSTED_METADATA_DIR = path.join(
+    FWUPD_DOM0_DIR,
+    "metadata-untrusted"
+)
 FWUPD_DOM0_METADATA_SIGNATURE = path.join(
     FWUPD_DOM0_METADATA_DIR,
     "firmware.xml.gz.asc"
@@ -46,6 +65,7 @@ FWUPD_DOM0_METADATA_FILE_JCAT = path.join(
     "firmware.xml.gz.jcat"
 )
 
+FWUPD_UPDATEVM_SCRIPT = "/usr/share/qubes-fwupd/fwupd-download-updates.sh"
 FWUPD_UPDATEVM_DIR = "/home/user/.cache/fwupd"
 FWUPD_UPDATEVM_UPDATES_DIR = path.join(FWUPD_UPDATEVM_DIR, "updates")
 FWUPD_UPDATEVM_METADATA_DIR = path.join(FWUPD_UPDATEVM_DIR, "metadata")
@@ -66,28 +86,21 @@ FWUPD_METADATA_FLAG_REGEX = re.compile(r"^metaflag")
 FWUPD_METADATA_FILES_REGEX = re.compile(
     r"^firmware.xml.gz.?[aj]?[sc]?[ca]?t?$"
 )
-GPG_LVFS_REGEX = re.compile(
-    r"gpg: Good signature from [a-z0-9\[\]\@\<\>\.\"\"]{1,128}"
+FWUPD_METADATA_BUNDLE_FILES = (
+    "firmware.xml.gz",
+    "firmware.xml.gz.asc",
+    "firmware.xml.gz.jcat",
 )
+FWUPD_METADATA_MAX_SIZE = 64 * 1024 * 1024
+FWUPD_FIRMWARE_MAX_SIZE = 512 * 1024 * 1024
+SHA256_REGEX = re.compile(r"^[a-f0-9]{64}$")
 WARNING_COLOR = '\033[93m'
 
 
 class FwupdReceiveUpdates:
-    def _check_shasum(self, file_path, sha):
-        """Compares computed SHA1 checksum with `sha` parameter.
-
-        Keyword arguments:
-        file_path -- absolute path to the file
-        sha -- SHA1 checksum of the file
-        """
-        with open(file_path, 'rb') as f:
-            c_sha = hashlib.sha1(f.read()).hexdigest()
-        if c_sha != sha:
-            raise ValueError(f"Computed checksum {c_sha} did NOT match {sha}.")
-
     def _check_domain(self, updatevm):
         """Checks if domain given as `updatevm` is allowed to send update
-        files.
+        files. The preference is read on every call, it is never cached.
 
         Keyword argument:
         updatevm - domain to be checked
@@ -145,105 +158,148 @@ class FwupdReceiveUpdates:
                 )
 
     def _extract_archive(self, archive_path, output_path):
-        """Extracts archive file to the specified directory.
+        """Extracts the firmware, its signature and metainfo from archive
+        file to the specified directory. Returns paths of extracted files.
 
         Keyword arguments:
         archive_path -- absolute path to archive file
         output_path -- absolute path to the output directory
         """
-        cmd_extract = [
-            "cabextract",
-            "-d",
-            f"{output_path}",
-            f"{archive_path}"
-        ]
-        shutil.copy(archive_path, FWUPD_DOM0_UPDATES_DIR)
-        p = subprocess.Popen(cmd_extract, stdout=subprocess.PIPE)
-        p.communicate()[0].decode('ascii')
-        if p.returncode != 0:
+        try:
+            return CabinetReader(archive_path).extract(output_path)
+        except (OSError, ValueError, zlib.error) as e:
             raise Exception(
-                f'cabextract: Error while extracting {archive_path}.'
+                f'Error while extracting {archive_path}: {e}'
             )
 
-    def _gpg_verification(self, file_path):
-        """Verifies GPG signature.
+    def _gpg_verification(self, *file_paths):
+        """Verifies GPG signatures of the files with a single batch.
 
         Keyword argument:
-        file_path -- absolute path to inspected file
+        *file_paths -- absolute paths to inspected files
         """
-        cmd_gpg = [
-            "gpg",
-            "--verify",
-            f"{file_path}.asc",
-            f"{file_path}",
-        ]
-        p = subprocess.Popen(
-            cmd_gpg,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+        GpgVerifier(FWUPD_DOM0_GPG_CACHE).verify_many(
+            [(file_path, f"{file_path}.asc") for file_path in file_paths]
         )
-        __, stderr = p.communicate()
-        verification = stderr.decode('ascii')
-        print(verification)
-        if p.returncode != 0:
-            raise Exception('gpg: Verification failed')
-        if not GPG_LVFS_REGEX.search(verification.strip()):
-            raise Exception(
-                f'Domain updateVM sent not signed firmware: {file_path}'
+
+    def _verify_metadata(self, metadata_file):
+        """Checks the metadata checksum embedded in the JCAT file before
+        verifying GPG signatures of the metadata.
+
+        Keyword argument:
+        metadata_file -- absolute path to the metadata file
+        """
+        JcatFile(f"{metadata_file}.jcat").verify(
+            metadata_file,
+            GpgVerifier(FWUPD_DOM0_GPG_CACHE)
+        )
+
+    def _receive_firmware(self, stream, file_path, sha, size=None):
+        """Writes the firmware archive while it arrives from the updateVM
+        and computes its checksum on the fly. Fails as soon as the archive
+        exceeds the expected size.
+
+        Keyword arguments:
+        stream -- binary stream of the archive
+        file_path -- absolute path to the received archive
+        sha -- SHA1 or SHA256 checksum of the firmware update archive
+        size -- expected size of the archive, if known
+        """
+        digest = hashlib.new(digest_algorithm(sha))
+        max_size = FWUPD_FIRMWARE_MAX_SIZE if size is None else size
+        with open(file_path, "wb") as untrusted_f:
+            received = copy_stream(stream, untrusted_f, max_size, (digest,))
+        if size is not None and received != size:
+            raise ValueError(
+                f"Received {received} bytes of firmware, expected {size}."
             )
+        compare_digest(digest.hexdigest(), sha)
 
-    def handle_fw_update(self, updatevm, sha, filename):
-        """Copies firmware update archives from the updateVM.
+    def handle_fw_update(self, updatevm, sha, filename, size=None):
+        """Copies firmware update archives from the updateVM. The verified
+        archive is added to the firmware store under its checksum.
 
         Keyword arguments:
         updatevm -- update VM name
-        sha -- SHA1 checksum of the firmware update archive
+        sha -- SHA1 or SHA256 checksum of the firmware update archive
         filename -- name of the firmware update archive
+        size -- expected size of the archive, if known
         """
+        if not FIRMWARE_CHECKSUM_REGEX.match(sha):
+            raise ValueError(f"Invalid firmware checksum: {sha}")
         fwupd_firmware_file_regex = re.compile(filename)
-        dom0_firmware_untrusted_path = os.path.join(
-            FWUPD_DOM0_UNTRUSTED_DIR,
-            filename
-        )
+        # Every download has its own untrusted directory, so that
+        # the archives can be received concurrently.
+        untrusted_dir = path.join(FWUPD_DOM0_UNTRUSTED_DIR, sha)
+        dom0_firmware_untrusted_path = os.path.join(untrusted_dir, filename)
         updatevm_firmware_file_path = os.path.join(
             FWUPD_UPDATEVM_UPDATES_DIR,
             filename
         )
 
         self._check_domain(updatevm)
-        self._create_dirs(FWUPD_DOM0_UPDATES_DIR, FWUPD_DOM0_UNTRUSTED_DIR)
-
-        cmd_copy = 'qvm-run --pass-io %s %s > %s' % (
-            updatevm,
-            "'cat %s'" % updatevm_firmware_file_path,
-            dom0_firmware_untrusted_path
-        )
-        p = subprocess.Popen(cmd_copy, shell=True)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception('qvm-run: Copying firmware file failed!!')
-
-        self._verify_received(
+        if path.exists(untrusted_dir):
+            shutil.rmtree(untrusted_dir)
+        self._create_dirs(
+            FWUPD_DOM0_UPDATES_DIR,
             FWUPD_DOM0_UNTRUSTED_DIR,
-            fwupd_firmware_file_regex,
-            updatevm
+            untrusted_dir
         )
-        self._check_shasum(dom0_firmware_untrusted_path, sha)
-        untrusted_dir_name = filename.replace(".cab", "")
-        output_path = path.join(FWUPD_DOM0_UNTRUSTED_DIR, untrusted_dir_name)
-        self._extract_archive(dom0_firmware_untrusted_path, output_path)
-        signature_name = path.join(output_path, "firmware*.asc")
-        file_path = glob.glob(signature_name)
-        self._gpg_verification(file_path[0].replace(".asc", ""))
-        os.umask(self.old_umask)
-        if untrusted_dir_name == "untrusted":
-            untrusted_dir_name = "trusted"
-            verified_file = path.join(FWUPD_DOM0_UPDATES_DIR, filename)
-            trusted_file = path.join(FWUPD_DOM0_UPDATES_DIR, "trusted.cab")
-            shutil.move(verified_file, trusted_file)
-        dir_name = path.join(FWUPD_DOM0_UPDATES_DIR, untrusted_dir_name)
-        shutil.move(output_path, dir_name)
-        shutil.rmtree(FWUPD_DOM0_UNTRUSTED_DIR)
+
+        # The untrusted directory is removed even if the update is
+        # rejected, it is not accounted in the budget of the store.
+        try:
+            cmd_copy = [
+                "qvm-run",
+                "--pass-io",
+                updatevm,
+                f"cat {updatevm_firmware_file_path}"
+            ]
+            p = subprocess.Popen(cmd_copy, stdout=subprocess.PIPE)
+            try:
+                self._receive_firmware(
+                    p.stdout,
+                    dom0_firmware_untrusted_path,
+                    sha,
+                    size
+                )
+            except Exception:
+                p.kill()
+                raise
+            finally:
+                p.stdout.close()
+                p.wait()
+            if p.returncode != 0:
+                raise Exception('qvm-run: Copying firmware file failed!!')
+
+            self._verify_received(
+                untrusted_dir,
+                fwupd_firmware_file_regex,
+                updatevm
+            )
+            output_path = path.join(
+                untrusted_dir,
+                filename.replace(".cab", "")
+            )
+            extracted = self._extract_archive(
+                dom0_firmware_untrusted_path,
+                output_path
+            )
+            signatures = [f for f in extracted if f.endswith(".asc")]
+            if not signatures:
+                raise Exception('Firmware signature does not exist')
+            self._gpg_verification(
+                *[f[:-len(".asc")] for f in signatures]
+            )
+            FirmwareStore(FWUPD_DOM0_STORE_DIR).add(
+                sha,
+                dom0_firmware_untrusted_path,
+                output_path
+            )
+        finally:
+            os.umask(self.old_umask)
+            if path.exists(untrusted_dir):
+                shutil.rmtree(untrusted_dir)
         exit(0)
 
     def handle_metadata_update(self, updatevm):
@@ -291,7 +347,95 @@ class FwupdReceiveUpdates:
             FWUPD_METADATA_FILES_REGEX,
             updatevm
         )
-        self._gpg_verification(FWUPD_DOM0_METADATA_FILE)
+        self._verify_metadata(FWUPD_DOM0_METADATA_FILE)
+        os.umask(self.old_umask)
+        exit(0)
+
+    def _receive_metadata_bundle(self, stream, output_path, updatevm):
+        """Unpacks metadata bundle while it arrives from the updateVM.
+
+        Every file of the bundle is sent as a frame with the header
+        `file <name> <sha256> <size>`. The bundle ends with `end 0` frame.
+
+        Keyword arguments:
+        stream -- binary stream of the bundle
+        output_path -- absolute path to the untrusted directory
+        updatevm -- update VM name
+        """
+        received = set()
+        while True:
+            tokens = read_header(stream)
+            if tokens == ["end", "0"]:
+                break
+            if len(tokens) != 4 or tokens[0] != "file":
+                raise Exception(f'Domain {updatevm} sent invalid bundle')
+            __, name, untrusted_sha, size = tokens
+            if name not in FWUPD_METADATA_BUNDLE_FILES or name in received:
+                raise Exception(f'Domain {updatevm} sent unexpected file')
+            if not SHA256_REGEX.match(untrusted_sha):
+                raise Exception(f'Domain {updatevm} sent invalid checksum')
+            size = parse_size(size, FWUPD_METADATA_MAX_SIZE)
+            digest = hashlib.sha256()
+            with open(path.join(output_path, name), "wb") as untrusted_f:
+                copy_payload(stream, untrusted_f, size, (digest,))
+            if digest.hexdigest() != untrusted_sha:
+                raise ValueError(
+                    f"Computed checksum of {name} did NOT match "
+                    f"{untrusted_sha}."
+                )
+            received.add(name)
+        if received != set(FWUPD_METADATA_BUNDLE_FILES):
+            raise Exception(f'Domain {updatevm} sent incomplete bundle')
+
+    def handle_metadata_bundle(self, updatevm):
+        """Copies metadata files from the updateVM as a single bundle.
+
+        Keyword argument:
+        updatevm -- update VM name
+        """
+        self._check_domain(updatevm)
+        if path.exists(FWUPD_DOM0_UNTRUSTED_METADATA_DIR):
+            shutil.rmtree(FWUPD_DOM0_UNTRUSTED_METADATA_DIR)
+        self._create_dirs(
+            FWUPD_DOM0_METADATA_DIR,
+            FWUPD_DOM0_UNTRUSTED_METADATA_DIR
+        )
+        cmd_bundle = [
+            "qvm-run",
+            "--pass-io",
+            updatevm,
+            f"{FWUPD_UPDATEVM_SCRIPT} --bundle"
+        ]
+        p = subprocess.Popen(cmd_bundle, stdout=subprocess.PIPE)
+        try:
+            self._receive_metadata_bundle(
+                p.stdout,
+                FWUPD_DOM0_UNTRUSTED_METADATA_DIR,
+                updatevm
+            )
+        except Exception:
+            p.kill()
+            raise
+        finally:
+            p.stdout.close()
+            p.wait()
+        if p.returncode != 0:
+            raise Exception('qvm-run: Copying metadata bundle failed!!')
+
+        self._verify_received(
+            FWUPD_DOM0_UNTRUSTED_METADATA_DIR,
+            FWUPD_METADATA_FILES_REGEX,
+            updatevm
+        )
+        self._verify_metadata(
+            path.join(FWUPD_DOM0_UNTRUSTED_METADATA_DIR, "firmware.xml.gz")
+        )
+        for name in FWUPD_METADATA_BUNDLE_FILES:
+            os.replace(
+                path.join(FWUPD_DOM0_UNTRUSTED_METADATA_DIR, name),
+                path.join(FWUPD_DOM0_METADATA_DIR, name)
+            )
+        shutil.rmtree(FWUPD_DOM0_UNTRUSTED_METADATA_DIR)
         os.umask(self.old_umask)
         exit(0)
 
@@ -305,6 +449,17 @@ def main():
         raise Exception("No flag mode has been set!!!")
     elif sys.argv[2] == "metadata":
         fwupd.handle_metadata_update(updatevm)
+    elif sys.argv[2] == "metadata-bundle":
+        fwupd.handle_metadata_bundle(updatevm)
+    elif sys.argv[2] == "update" and len(sys.argv) == 6:
+        if not sys.argv[5].isdigit():
+            raise Exception(f"Invalid firmware size: {sys.argv[5]}")
+        fwupd.handle_fw_update(
+            updatevm,
+            sys.argv[3],
+            sys.argv[4],
+            int(sys.argv[5])
+        )
     elif sys.argv[2] == "update":
         fwupd.handle_fw_update(updatevm, sys.argv[3], sys.argv[4])
 
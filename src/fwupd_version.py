@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import functools
+import re
+
+VERSION_KEY_CACHE_SIZE = 8192
+VERSION_FORMAT_PLAIN = "plain"
+VERSION_FORMAT_HEX = "hex"
+VERSION_SPLIT_REGEX = re.compile(r"[.\-]")
+VERSION_SEGMENT_REGEX = re.compile(r"^([0-9]*)(.*)$", re.DOTALL)
+VERSION_UINT32_REGEX = re.compile(r"^(0x[0-9a-fA-F]{1,8}|[0-9]{1,10})$")
+UINT32_MAX = 0xffffffff
+
+
+def _bcd(value):
+    """Returns decimal value of the BCD encoded byte.
+
+    Keyword argument:
+    value -- BCD encoded byte
+    """
+    return (value >> 4) * 10 + (value & 0x0f)
+
+
+# Sections of the versions stored as a single integer, the same way as
+# fwupd formats them for the given VersionFormat.
+VERSION_FORMAT_SECTIONS = {
+    "number": lambda v: (v,),
+    "hex": lambda v: (v,),
+    "pair": lambda v: (v >> 16 & 0xffff, v & 0xffff),
+    "triplet": lambda v: (v >> 24 & 0xff, v >> 16 & 0xff, v & 0xffff),
+    "quad": lambda v: (v >> 24 & 0xff, v >> 16 & 0xff, v >> 8 & 0xff,
+                       v & 0xff),
+    "bcd": lambda v: (_bcd(v >> 24 & 0xff), _bcd(v >> 16 & 0xff),
+                      _bcd(v >> 8 & 0xff), _bcd(v & 0xff)),
+    "intel-me": lambda v: ((v >> 29 & 0x07) + 0x0b, v >> 24 & 0x1f,
+                           v >> 16 & 0xff, v & 0xffff),
+    "intel-me2": lambda v: (v >> 28 & 0x0f, v >> 24 & 0x0f, v >> 16 & 0xff,
+                            v & 0xffff),
+    "surface-legacy": lambda v: (v >> 22 & 0x3ff, v >> 10 & 0xfff,
+                                 v & 0x3ff),
+    "surface": lambda v: (v >> 24 & 0xff, v >> 8 & 0xffff, v & 0xff),
+    "dell-bios": lambda v: (v >> 16 & 0xff, v >> 8 & 0xff, v & 0xff),
+}
+
+
+def _parse_uint32(version):
+    """Returns the version stored as a decimal or hexadecimal integer,
+    or None.
+
+    Keyword argument:
+    version -- version string
+    """
+    if not VERSION_UINT32_REGEX.match(version):
+        return None
+    value = int(version, 0) if version.startswith("0x") else int(version)
+    return value if value <= UINT32_MAX else None
+
+
+@functools.lru_cache(maxsize=VERSION_KEY_CACHE_SIZE)
+def version_key(version, version_format=None):
+    """Returns comparable key of the version. The key is computed once per
+    version string and format, so sorting and repeated comparisons do not
+    parse the versions again.
+
+    Versions in the `plain` format are compared as strings. Versions given
+    as a single integer are split into sections according to the format.
+    Other versions are split into dot or dash separated sections, which
+    are compared by the leading number first and by the rest of the section
+    next. A version with more sections is newer.
+
+    Keyword arguments:
+    version -- version string
+    version_format -- VersionFormat of the device reported by fwupd
+    """
+    version = str(version).strip()
+    if version_format == VERSION_FORMAT_PLAIN:
+        return ((-1, version),)
+    value = _parse_uint32(version)
+    if value is not None:
+        if version_format in VERSION_FORMAT_SECTIONS:
+            sections = VERSION_FORMAT_SECTIONS[version_format](value)
+            return tuple((section, "") for section in sections)
+        if version.startswith("0x"):
+            return ((value, ""),)
+    key = []
+    for section in VERSION_SPLIT_REGEX.split(version):
+        digits, rest = VERSION_SEGMENT_REGEX.match(section).groups()
+        key.append((int(digits) if digits else -1, rest))
+    return tuple(key)
+
+
+def sort_releases(releases, version_format=None):
+    """Returns the releases sorted from the newest to the oldest one.
+
+    Keyword arguments:
+    releases -- list of Release instances
+    version_format -- VersionFormat of the device
+    """
+    return sorted(
+        releases,
+        key=lambda release: version_key(release.version, version_format),
+        reverse=True
+    )
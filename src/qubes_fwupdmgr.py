@@ -22,12 +22,47 @@ import json
 import os
 import re
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 import xml.etree.ElementTree as ET
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from distutils.version import LooseVersion as l_ver
+from fwupd_cache import (
+    FactsCache,
+    FirmwareStore,
+    FIRMWARE_CHECKSUM_REGEX,
+    SnapshotCache,
+    SNAPSHOT_TTL,
+    file_stamp
+)
+from fwupd_common import (
+    file_digests,
+    parse_size,
+    read_header,
+    read_payload,
+    write_file_frame,
+    write_frame,
+)
+from fwupd_metadata import MetadataIndex
+from fwupd_model import (
+    AgentOutput,
+    as_stream,
+    check_device,
+    iter_devices,
+    iter_json_array,
+    parse_devices,
+)
+from fwupd_output import (
+    JsonOutput,
+    OUTPUT_JSON,
+    OUTPUT_NDJSON,
+    TextRenderer,
+    strip_description,
+)
+from fwupd_version import version_key
 
 FWUPD_QUBES_DIR = "/usr/share/qubes-fwupd"
 FWUPD_DOM0_UPDATE = os.path.join(FWUPD_QUBES_DIR, "src/fwupd-dom0-update")
@@ -46,7 +81,21 @@ FWUPD_DOM0_METADATA_JCAT = os.path.join(
     FWUPD_DOM0_METADATA_DIR,
     "firmware.xml.gz.jcat"
 )
+FWUPD_DOM0_METADATA_INDEX = os.path.join(
+    FWUPD_DOM0_METADATA_DIR,
+    "firmware-index.sqlite"
+)
+FWUPD_DOM0_METADATA_LOADED = os.path.join(
+    FWUPD_DOM0_METADATA_DIR,
+    "firmware.xml.gz.loaded"
+)
+FWUPD_DOM0_SNAPSHOTS_DIR = os.path.join(FWUPD_DOM0_DIR, "snapshots")
+FWUPD_DOM0_FACTS = os.path.join(FWUPD_DOM0_DIR, "facts.json")
+FWUPD_DOM0_UNTRUSTED_DIR = os.path.join(FWUPD_DOM0_UPDATES_DIR, "untrusted")
+FWUPD_DOM0_STORE_DIR = os.path.join(FWUPD_DOM0_UPDATES_DIR, "store")
+FWUPD_DOM0_PREFETCH_LOG = os.path.join(FWUPD_DOM0_DIR, "prefetch.log")
 FWUPD_USBVM_LOG = os.path.join(FWUPD_DOM0_DIR, "usbvm-devices.log")
+FWUPD_DEBUG_ENV = "QUBES_FWUPD_DEBUG"
 FWUPD_USBVM_VALIDATE = "/usr/share/qubes-fwupd/fwupd_usbvm_validate.py"
 FWUPD_USBVM_DIR = "/home/user/.cache/fwupd"
 FWUPD_USBVM_UPDATES_DIR = os.path.join(FWUPD_USBVM_DIR, "updates")
@@ -63,21 +112,24 @@ FWUPD_USBVM_METADATA_JCAT = os.path.join(
     FWUPD_USBVM_METADATA_DIR,
     "firmware.xml.gz.jcat"
 )
-FWUPD_DOWNLOAD_PREFIX = "https://fwupd.org/downloads/"
 FWUPDMGR = "/bin/fwupdmgr"
 # version > 1.3.8
 FWUPDAGENT_NEW = "/bin/fwupdagent"
+FWUPD_AGENT_NEW_VERSION = "1.3.8"
 # version <= 1.3.8
 FWUPDAGENT_OLD = "/usr/libexec/fwupd/fwupdagent"
 USBVM_N = "sys-usb"
+USBVM_RESPONSE_MAX = 64 * 1024
+USBVM_METADATA_TTL = 7 * 24 * 3600
+QUBES_FWUPDMGR = "/bin/qubes-fwupdmgr"
+PREFETCH_JOBS = 2
+SPECULATIVE_POLL_INTERVAL = 0.2
 BIOS_UPDATE_FLAG = os.path.join(FWUPD_DOM0_DIR, "bios_update")
 
 METADATA_REFRESH_REGEX = re.compile(
     r"^Successfully refreshed metadata manually$"
 )
 
-SPECIAL_CHAR_REGEX = re.compile(r'%20|&|\||#')
-
 HELP = {
     "Usage": [
         {
@@ -91,12 +143,25 @@ HELP = {
             "refresh": "Refresh metadata from remote server",
             "update": "Updates chosen device to latest firmware version",
             "downgrade": "Downgrade chosen device to chosen firmware version",
+            "prefetch": "Downloads all available updates to the cache",
             "clean": "Deletes all cached update files"
         }
     ],
     "Flags": [
         {
-            "--whonix": "Downloads firmware updates via Tor"
+            "--whonix": "Downloads firmware updates via Tor",
+            "--no-cache": "Ignores cached device and update information",
+            "--cache-ttl=": (
+                "Sets lifetime of the cached information in seconds"
+            ),
+            "--all": "Updates all devices without asking",
+            "--device=": "Updates only the device with the given name",
+            "--version=": "Installs the given firmware version",
+            "--prefetch": "Prefetches available updates after refresh",
+            "--offline": "Lists updates using the local metadata index",
+            "--usbvm": "Includes devices of sys-usb in get-devices",
+            "--json": "Prints the result as a single JSON document",
+            "--ndjson": "Prints the result as newline delimited JSON"
         }
     ],
     "Help": [
@@ -106,16 +171,60 @@ HELP = {
     ],
 }
 
+# Facts gathered before the command runs:
+# usbvm -- whether sys-usb is running
+# dom0-agent -- fwupdagent path in dom0
+# usbvm-agent -- fwupdagent path in sys-usb, if it is running
+# cleanup -- leftovers of the previous update removed
+# metadata -- metadata downloaded, and refreshed after the BIOS update
+# Commands which are not listed, like help, need no facts.
+COMMAND_FACTS = {
+    "get-devices": ("dom0-agent",),
+    "get-updates": ("dom0-agent", "usbvm-agent", "metadata"),
+    "refresh": ("usbvm",),
+    "prefetch": ("dom0-agent", "usbvm-agent", "metadata"),
+    "update": ("dom0-agent", "usbvm-agent", "cleanup", "metadata"),
+    "downgrade": ("dom0-agent", "usbvm-agent", "cleanup", "metadata"),
+    "clean": ("usbvm",),
+}
+
 EXIT_CODES = {
     "ERROR": 1,
     "SUCCESS": 0,
     "NO_UPDATES": 99,
+    "METADATA_UNCHANGED": 100,
 }
 
 
 class QubesFwupdmgr:
+    def __init__(self, use_cache=True, cache_ttl=SNAPSHOT_TTL,
+                 json_output=None, offline=False):
+        """Keyword arguments:
+        use_cache -- allows reusing cached fwupdagent output
+        cache_ttl -- lifetime of the cached fwupdagent output in seconds
+        json_output -- JsonOutput collecting the records of the command,
+        None for the human readable output
+        offline -- answers the update and downgrade listings from the cached
+        device list and the metadata index instead of fwupdagent
+        """
+        self.snapshots = SnapshotCache(
+            FWUPD_DOM0_SNAPSHOTS_DIR,
+            FWUPD_DOM0_METADATA_FILE,
+            ttl=cache_ttl,
+            enabled=use_cache
+        )
+        self.facts = FactsCache(FWUPD_DOM0_FACTS, enabled=use_cache)
+        self.firmware_store = FirmwareStore(FWUPD_DOM0_STORE_DIR)
+        self.usbvm_domid = None
+        self.usbvm_session = None
+        self.json_output = json_output
+        self.renderer = TextRenderer()
+        self.metadata_index = MetadataIndex(FWUPD_DOM0_METADATA_INDEX)
+        self.offline = offline
+
     def _download_metadata(self, whonix=False):
-        """Initialize downloading metadata files.
+        """Initialize downloading metadata files. Returns False if
+        the metadata has not been modified since the last download.
 
         Keywords arguments:
         whonix -- Flag enforces downloading the metadata updates via Tor
@@ -128,103 +237,127 @@ class QubesFwupdmgr:
             cmd_metadata.append("--whonix")
         p = subprocess.Popen(cmd_metadata)
         p.wait()
-        if p.returncode != 0:
+        if p.returncode not in (
+            EXIT_CODES["SUCCESS"],
+            EXIT_CODES["METADATA_UNCHANGED"]
+        ):
             raise Exception("fwudp-qubes: Metadata update failed")
         if not os.path.exists(FWUPD_DOM0_METADATA_FILE):
             raise Exception("Metadata signature does not exist")
-
-    def _validate_usbvm_dirs(self):
-        """Validates if sys-ubs updates and metadata directories exist."""
-        cmd_validate_dirs = [
+        return p.returncode != EXIT_CODES["METADATA_UNCHANGED"]
+
+    def _open_usbvm_session(self):
+        """Starts the validation server in usbvm. All requests of the usbvm
+        workflow are sent over this single qrexec connection."""
+        if self.usbvm_session is not None:
+            return self.usbvm_session
+        cmd_server = [
             "qvm-run",
+            "--nogui",
             "--pass-io",
             USBVM_N,
-            f'script --quiet --return --command "{FWUPD_USBVM_VALIDATE} dirs"'
+            f"{FWUPD_USBVM_VALIDATE} server"
         ]
-        p = subprocess.Popen(cmd_validate_dirs)
+        self.usbvm_session = subprocess.Popen(
+            cmd_server,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        return self.usbvm_session
+
+    def close_usbvm_session(self):
+        """Stops the validation server in usbvm. The reply to `quit` is read
+        before the pipes are closed, so the server can finish writing it."""
+        if self.usbvm_session is None:
+            return
+        p = self.usbvm_session
+        self.usbvm_session = None
+        try:
+            write_frame(p.stdin, ["quit"])
+            p.stdin.close()
+            response = read_header(p.stdout)
+            read_payload(
+                p.stdout,
+                parse_size(response[-1], USBVM_RESPONSE_MAX)
+            )
+        except (BrokenPipeError, EOFError, ValueError):
+            pass
+        p.stdout.close()
         p.wait()
-        if p.returncode != 0:
-            raise Exception("Validation of usbvm directories failed.")
+
+    def _usbvm_request(self, tokens, error_msg, file_path=None):
+        """Sends request to the usbvm validation server and waits for the
+        response.
+
+        Keywords arguments:
+        tokens -- request header tokens
+        error_msg -- message of the exception raised on failure
+        file_path -- absolute path to the file sent as payload
+        """
+        p = self._open_usbvm_session()
+        try:
+            if file_path is None:
+                write_frame(p.stdin, tokens)
+            else:
+                write_file_frame(p.stdin, tokens, file_path)
+            response = read_header(p.stdout)
+            size = parse_size(response[-1], USBVM_RESPONSE_MAX)
+            message = read_payload(p.stdout, size)
+        except (BrokenPipeError, EOFError, ValueError):
+            self.usbvm_session = None
+            p.kill()
+            p.wait()
+            raise Exception(f"{error_msg} Connection with usbvm lost.")
+        if response[0] != "ok":
+            untrusted_message = message.decode("ascii", errors="replace")
+            reason = "".join(
+                c if c.isprintable() else "?" for c in untrusted_message
+            )
+            raise Exception(f"{error_msg} {USBVM_N}: {reason}")
+
+    def _validate_usbvm_dirs(self):
+        """Validates if sys-ubs updates and metadata directories exist."""
+        self._usbvm_request(
+            ["dirs"],
+            "Validation of usbvm directories failed."
+        )
 
     def _validate_usbvm_archive(self, arch_name, sha):
         """Validates checksum and gpg signature of the archive file."""
-        arch_path = os.path.join(FWUPD_USBVM_UPDATES_DIR, arch_name)
-        arch_validate = f"{FWUPD_USBVM_VALIDATE} updates {arch_path} {sha}"
-        cmd_validate_arch = [
-            "qvm-run",
-            "--pass-io",
-            USBVM_N,
-            f'script --quiet --return --command "{arch_validate}"'
-        ]
-        p = subprocess.Popen(cmd_validate_arch)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("Validation of the archive file failed.")
+        self._usbvm_request(
+            ["updates", arch_name, sha],
+            "Validation of the archive file failed."
+        )
 
     def _copy_usbvm_metadata(self):
         """Copies metadata files to usbvm."""
-        cat_file = "cat > %s" % FWUPD_USBVM_METADATA_FILE
-        cmd_copy_file = 'cat %s | qvm-run --nogui --pass-io %s "%s"' % (
-            FWUPD_DOM0_METADATA_FILE,
-            USBVM_N,
-            cat_file
+        self._usbvm_request(
+            ["put", "metadata", os.path.basename(FWUPD_USBVM_METADATA_FILE)],
+            "Copying metadata file failed.",
+            file_path=FWUPD_DOM0_METADATA_FILE
         )
-        cat_sig = "cat > %s" % FWUPD_USBVM_METADATA_SIGNATURE
-        cmd_copy_sig = 'cat %s | qvm-run --nogui --pass-io %s "%s"' % (
-            FWUPD_DOM0_METADATA_SIGNATURE,
-            USBVM_N,
-            cat_sig
+        self._usbvm_request(
+            [
+                "put",
+                "metadata",
+                os.path.basename(FWUPD_USBVM_METADATA_SIGNATURE)
+            ],
+            "Copying metadata signature failed.",
+            file_path=FWUPD_DOM0_METADATA_SIGNATURE
         )
-        cat_jcat = "cat > %s" % FWUPD_USBVM_METADATA_JCAT
-        cmd_copy_jcat = 'cat %s | qvm-run --nogui --pass-io %s "%s"' % (
-            FWUPD_DOM0_METADATA_JCAT,
-            USBVM_N,
-            cat_jcat
+        self._usbvm_request(
+            ["put", "metadata", os.path.basename(FWUPD_USBVM_METADATA_JCAT)],
+            "Copying metadata jcat failed.",
+            file_path=FWUPD_DOM0_METADATA_JCAT
         )
-        p = subprocess.Popen(cmd_copy_file, shell=True)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("Copying metadata file failed.")
-        p = subprocess.Popen(cmd_copy_sig, shell=True)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("Copying metadata signature failed.")
-        p = subprocess.Popen(cmd_copy_jcat, shell=True)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("Copying metadata jcat failed.")
 
     def _validate_usbvm_metadata(self):
         """Checks GPG signature of metadata files in usbvm."""
-        cmd_validate_metadata = [
-            "qvm-run",
-            "--pass-io",
-            USBVM_N,
-            'script --quiet --return --command'
-            f' "{FWUPD_USBVM_VALIDATE} metadata"'
-        ]
-        p = subprocess.Popen(cmd_validate_metadata)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("Metadata validation failed")
+        self._usbvm_request(["metadata"], "Metadata validation failed")
 
     def _refresh_usbvm_metadata(self):
         """Refreshes metadata in usbvm."""
-        cmd_refresh_metadata = [
-            "qvm-run",
-            "--pass-io",
-            USBVM_N,
-            'script --quiet --return --command "%s refresh %s %s lvfs"' %
-            (
-                FWUPDMGR,
-                FWUPD_USBVM_METADATA_FILE,
-                FWUPD_USBVM_METADATA_JCAT,
-            )
-        ]
-        p = subprocess.Popen(cmd_refresh_metadata)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("Metadata refresh in usbvm failed")
+        self._usbvm_request(["refresh"], "Metadata refresh in usbvm failed")
 
     def _copy_firmware_updates(self, arch_name):
         """Copies updates files to usbvm.
@@ -232,18 +365,12 @@ class QubesFwupdmgr:
         Keywords arguments:
         arch_name - name of the archive file
         """
-        arch_path = os.path.join(FWUPD_DOM0_UPDATES_DIR, arch_name)
-        output_path = os.path.join(FWUPD_USBVM_UPDATES_DIR, arch_name)
-        cat_file = f"cat > {output_path}"
-        cmd_copy_file = 'cat %s | qvm-run --nogui --pass-io %s "%s"' % (
-            arch_path,
-            USBVM_N,
-            cat_file
+        arch_path = os.path.join(FWUPD_DOM0_STORE_DIR, arch_name)
+        self._usbvm_request(
+            ["put", "updates", arch_name],
+            "Copying metadata file failed.",
+            file_path=arch_path
         )
-        p = subprocess.Popen(cmd_copy_file, shell=True)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("Copying metadata file failed.")
 
     def _install_usbvm_firmware_update(self, arch_name):
         """Installs firmware update for specified device in dom0.
@@ -251,18 +378,10 @@ class QubesFwupdmgr:
         Keywords arguments:
         arch_name - name of the archive file
         """
-        arch_path = os.path.join(FWUPD_USBVM_UPDATES_DIR, arch_name)
-        CMD_update = [
-            "qvm-run",
-            "--pass-io",
-            USBVM_N,
-            f'script --quiet --return --command'
-            f' "{FWUPDMGR} install {arch_path}" /dev/null'
-        ]
-        p = subprocess.Popen(CMD_update)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("fwudp-qubes: Firmware update failed")
+        self._usbvm_request(
+            ["install", arch_name],
+            "fwudp-qubes: Firmware update failed"
+        )
 
     def _install_usbvm_firmware_downgrade(self, arch_name):
         """Installs firmware downgrades for specified device in dom0.
@@ -270,45 +389,88 @@ class QubesFwupdmgr:
         Keywords arguments:
         arch_name - name of the archive file
         """
-        arch_path = os.path.join(FWUPD_USBVM_UPDATES_DIR, arch_name)
-        CMD_downgrade = [
-            "qvm-run",
-            "--pass-io",
-            USBVM_N,
-            f'script --quiet --return --command'
-            f' "{FWUPDMGR} --allow-older install {arch_path}" /dev/null'
-        ]
-        p = subprocess.Popen(CMD_downgrade)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("fwudp-qubes: Firmware downgrade failed")
+        self._usbvm_request(
+            ["downgrade", arch_name],
+            "fwudp-qubes: Firmware downgrade failed"
+        )
+
+    def _sync_usbvm_metadata(self):
+        """Copies the dom0 metadata to usbvm and refreshes it there, unless
+        the running usbvm has already been refreshed with the same
+        metadata. The fwupd state of usbvm is lost when it restarts, so
+        the refresh is recorded in the facts cache per domain ID."""
+        def _refresh():
+            self._validate_usbvm_dirs()
+            self._copy_usbvm_metadata()
+            self._validate_usbvm_metadata()
+            self._refresh_usbvm_metadata()
+            return True
+
+        if self.usbvm_domid is None:
+            _refresh()
+            return
+        # The stamp changes with the metadata and with a restart of usbvm
+        self.facts.get(
+            f"{USBVM_N}-metadata",
+            f"domid-{self.usbvm_domid}-"
+            f"{file_stamp(FWUPD_DOM0_METADATA_FILE)}",
+            _refresh,
+            ttl=USBVM_METADATA_TTL
+        )
 
     def _clean_usbvm(self):
         """Cleans usbvm directories."""
-        cmd_clean = [
-            "qvm-run",
-            "--pass-io",
-            USBVM_N,
-            f'script --quiet --return --command "{FWUPD_USBVM_VALIDATE} clean"'
-        ]
-        p = subprocess.Popen(cmd_clean)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("Cleaning usbvm directories failed")
+        self._usbvm_request(["clean"], "Cleaning usbvm directories failed")
+
+    def _loaded_metadata_digest(self):
+        """Returns sha256 of the metadata last loaded by fwupd in dom0, or
+        None if it is not known."""
+        try:
+            with open(FWUPD_DOM0_METADATA_LOADED) as loaded_file:
+                return loaded_file.read().strip()
+        except OSError:
+            return None
+
+    def _save_loaded_metadata_digest(self, digest):
+        """Records sha256 of the metadata loaded by fwupd in dom0.
+
+        Keyword argument:
+        digest -- sha256 of the loaded metadata file
+        """
+        tmp_path = f"{FWUPD_DOM0_METADATA_LOADED}.tmp"
+        with open(tmp_path, "w") as loaded_file:
+            loaded_file.write(digest)
+        os.replace(tmp_path, FWUPD_DOM0_METADATA_LOADED)
 
-    def refresh_metadata(self, usbvm=False, whonix=False):
-        """Updates metadata with downloaded files.
+    def refresh_metadata(self, usbvm=False, whonix=False, force=False):
+        """Updates metadata with downloaded files. Unchanged metadata is
+        loaded again if fwupd in dom0 has not loaded it successfully.
 
         Keyword arguments:
         usbvm -- usbvm support flag
         whonix -- Flag enforces downloading the metadata updates via Tor
+        force -- loads the metadata even if fwupd has already loaded it,
+        as needed after the BIOS update
         """
-        self._download_metadata(whonix=whonix)
+        downloaded = self._download_metadata(whonix=whonix)
+        digest = file_digests(FWUPD_DOM0_METADATA_FILE, ("sha256",))["sha256"]
+        if (
+            not downloaded
+            and not force
+            and digest == self._loaded_metadata_digest()
+        ):
+            # A restarted usbvm has no metadata, although dom0 has
+            if usbvm:
+                self._sync_usbvm_metadata()
+            self.output = "Metadata unchanged\n"
+            print(self.output)
+            self._add_record({"MetadataChanged": False})
+            return EXIT_CODES["METADATA_UNCHANGED"]
+        # The cached device lists are kept for the offline listings. They
+        # are not used otherwise, since they were taken with old metadata.
+        self.snapshots.invalidate(commands=("get-updates", "get-downgrades"))
         if usbvm:
-            self._validate_usbvm_dirs()
-            self._copy_usbvm_metadata()
-            self._validate_usbvm_metadata()
-            self._refresh_usbvm_metadata()
+            self._sync_usbvm_metadata()
         cmd_refresh = [
             FWUPDMGR,
             "refresh",
@@ -326,70 +488,297 @@ class QubesFwupdmgr:
             raise Exception("fwudp-qubes: Refresh failed")
         if not METADATA_REFRESH_REGEX.match(self.output):
             raise Exception("Metadata signature does not exist")
+        self._save_loaded_metadata_digest(digest)
+        self._update_metadata_index()
+        self._add_record({"MetadataChanged": True})
+        return EXIT_CODES["SUCCESS"]
+
+    def _add_record(self, record):
+        """Adds the record to the JSON output of the command, if any.
+
+        Keywords argument:
+        record -- JSON serializable dictionary
+        """
+        if self.json_output is not None:
+            self.json_output.add(record)
+
+    def _add_update_record(self, vm_name, device, release, result):
+        """Adds result of the firmware update or downgrade to the JSON
+        output of the command.
+
+        Keywords arguments:
+        vm_name -- "dom0" or "usbvm"
+        device -- updated Device
+        release -- installed Release
+        result -- result of the update
+        """
+        self._add_record(
+            {
+                "VM": USBVM_N if vm_name == "usbvm" else vm_name,
+                "Name": device.name,
+                "Version": device.version,
+                "Release": release.to_json(),
+                "Result": result,
+            }
+        )
+
+    def _update_metadata_index(self):
+        """Brings the metadata index up to date. Returns False if the index
+        cannot be used. The failure is not fatal, fwupdagent is queried
+        instead."""
+        try:
+            self.metadata_index.update(FWUPD_DOM0_METADATA_FILE)
+        except (OSError, ValueError) as e:
+            print(f"Metadata index is not available: {e}", file=sys.stderr)
+            return False
+        return True
+
+    def _offline_devices_info(self, domain, updates=False):
+        """Returns fwupdagent output answered from the last device list of
+        the domain and the metadata index. The device list is used
+        regardless of its age, fwupdagent is never queried.
+
+        Keywords arguments:
+        domain -- name of the queried domain
+        updates -- keeps only the newer releases and the devices having
+        them, as `get-updates` does
+        """
+        devices_info = self.snapshots.load(
+            domain,
+            "get-devices",
+            check_metadata=False,
+            check_age=False
+        )
+        if devices_info is None:
+            usbvm_flag = "" if domain == "dom0" else " --usbvm"
+            raise Exception(
+                f"fwudp-qubes: No device list of {domain} for the offline "
+                f"mode. Run 'qubes-fwupdmgr get-devices{usbvm_flag}' first"
+            )
+        if not self._update_metadata_index():
+            raise Exception(
+                "fwudp-qubes: Metadata index is required in the offline mode"
+            )
+        devices = []
+        try:
+            for device in json.loads(devices_info)["Devices"]:
+                guids = device.get("Guid", [])
+                if isinstance(guids, str):
+                    guids = [guids]
+                releases = self.metadata_index.releases(guids)
+                if updates:
+                    if "Version" not in device:
+                        continue
+                    version_format = device.get("VersionFormat")
+                    current_version = version_key(
+                        device["Version"],
+                        version_format
+                    )
+                    releases = [
+                        release for release in releases
+                        if version_key(release["Version"], version_format) >
+                        current_version
+                    ]
+                    if not releases:
+                        continue
+                device = dict(device)
+                device.pop("Releases", None)
+                if releases:
+                    device["Releases"] = releases
+                devices.append(device)
+        except ValueError as e:
+            raise Exception(
+                f"fwudp-qubes: Metadata index is not available: {e}"
+            )
+        return json.dumps({"Devices": devices})
 
     def _get_dom0_updates(self):
-        """Gathers infromations about available updates."""
+        """Gathers infromations about available updates. The output of
+        fwupdagent is left as a stream, which is parsed while it is read."""
+        self.dom0_updates_info = self.snapshots.open("dom0", "get-updates")
+        if self.dom0_updates_info is not None:
+            return
+        if self.offline:
+            self.dom0_updates_info = self._offline_devices_info(
+                "dom0",
+                updates=True
+            )
+            return
         cmd_get_dom0_updates = [
             self.fwupdagent_dom0,
             "get-updates"
         ]
         p = subprocess.Popen(
             cmd_get_dom0_updates,
-            stdout=subprocess.PIPE
+            stdout=subprocess.PIPE,
+            encoding="utf-8"
+        )
+        self.dom0_updates_info = self.snapshots.tee(
+            "dom0",
+            "get-updates",
+            AgentOutput(p, "fwudp-qubes: Getting available updates failed")
         )
-        self.dom0_updates_info = p.communicate()[0].decode()
-        if p.returncode != 0:
-            raise Exception("fwudp-qubes: Getting available updates failed")
 
     def _parse_dom0_updates_info(self, updates_info):
-        """Creates dictionary and list with information about updates.
+        """Creates list of the devices with available updates.
 
         Keywords argument:
-        updates_info - gathered update information
+        updates_info - gathered update information, a string or a stream
         """
-        self.dom0_updates_info_dict = json.loads(updates_info)
-        self.dom0_updates_list = [
-            {
-                    "Name": device["Name"],
-                    "Version": device["Version"],
-                    "Releases": [
-                        {
-                            "Version": update["Version"],
-                            "Url": update["Uri"],
-                            "Checksum": update["Checksum"][0],
-                            "Description": update["Description"]
-                        } for update in device["Releases"]
-                    ]
-            } for device in self.dom0_updates_info_dict["Devices"]
-        ]
+        self.dom0_updates_list = parse_devices(updates_info)
 
-    def _download_firmware_updates(self, url, sha, whonix=False):
-        """Initializes downloading firmware upadate archive.
+    def _fetch_firmware_updates(self, url, sha, whonix=False, cancel=None,
+                                size=None):
+        """Returns path of the verified firmware update archive. The archive
+        is taken from the firmware store if it has been downloaded before.
 
         Keywords arguments:
         url -- url path to the firmware upadate archive
         sha -- SHA1 checksum of the firmware update archive
         whonix -- Flag enforces downloading the updates via Tor
+        cancel -- event stopping the download, given only for the quiet
+        background downloads
+        size -- expected size of the archive, the transfer fails as soon as
+        it is exceeded
         """
-        self.arch_name = url.replace(FWUPD_DOWNLOAD_PREFIX, "")
-        if SPECIAL_CHAR_REGEX.search(self.arch_name):
-            self.arch_name = "trusted.cab"
-        self.arch_path = os.path.join(FWUPD_DOM0_UPDATES_DIR, self.arch_name)
-        update_path = self.arch_path.replace(".cab", "")
-        cmd_fwdownload = [
-            FWUPD_DOM0_UPDATE,
-            "--update",
-            f"--url={url}",
-            f"--sha={sha}"
-        ]
-        if whonix:
-            cmd_fwdownload.append("--whonix")
-        p = subprocess.Popen(cmd_fwdownload)
-        p.wait()
+        with self.firmware_store.locked(sha):
+            arch_path = self.firmware_store.lookup(sha)
+            if arch_path is not None:
+                if cancel is None:
+                    print("Firmware already downloaded. Using cached files.")
+                return arch_path
+            cmd_fwdownload = [
+                FWUPD_DOM0_UPDATE,
+                "--update",
+                f"--url={url}",
+                f"--sha={sha}"
+            ]
+            if size is not None:
+                cmd_fwdownload.append(f"--size={size}")
+            if whonix:
+                cmd_fwdownload.append("--whonix")
+            if cancel is None:
+                p = subprocess.Popen(cmd_fwdownload)
+                p.wait()
+                if p.returncode != 0:
+                    raise Exception("fwudp-qubes: Firmware download failed")
+            else:
+                self._wait_cancellable(
+                    subprocess.Popen(
+                        cmd_fwdownload,
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                        start_new_session=True
+                    ),
+                    cancel
+                )
+            arch_path = self.firmware_store.lookup(sha)
+        if arch_path is None:
+            raise Exception("Firmware update files do not exist")
+        return arch_path
+
+    def _wait_cancellable(self, p, cancel):
+        """Waits for the download process. When `cancel` is set, the whole
+        process group is terminated, so that no qvm-run is left behind.
+
+        Keywords arguments:
+        p -- download process started in a new session
+        cancel -- event stopping the download
+        """
+        while True:
+            try:
+                p.wait(timeout=SPECULATIVE_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel.is_set():
+                    os.killpg(p.pid, signal.SIGTERM)
+                    p.wait()
+                    raise Exception("fwudp-qubes: Firmware download cancelled")
         if p.returncode != 0:
             raise Exception("fwudp-qubes: Firmware download failed")
-        if not os.path.exists(update_path):
-            raise Exception("Firmware update files do not exist")
+
+    def _speculative_release(self, updates_dict, downgrade=False):
+        """Returns the release the user is going to choose with high
+        probability, or None. That is the latest release when only one
+        device has updates, or the only downgrade of the only device.
+
+        Keywords arguments:
+        updates_dict -- dictionary of updates for dom0 and usbvm
+        downgrade -- downgrade flag
+        """
+        devices = [
+            dev for dev_list in updates_dict.values() for dev in dev_list
+        ]
+        if len(devices) != 1 or not devices[0].releases:
+            return None
+        if downgrade:
+            if len(devices[0].releases) != 1:
+                return None
+            return devices[0].releases[0]
+        return self._plan_updates(updates_dict)[0]["Release"]
+
+    def _start_speculative_download(self, release, whonix=False):
+        """Starts downloading the release in the background while the user
+        is choosing. Returns the checksum, future and cancel event of
+        the download.
+
+        Keywords arguments:
+        release -- release to be downloaded
+        whonix -- Flag enforces downloading the updates via Tor
+        """
+        if release is None:
+            return None
+        cancel = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(
+            self._fetch_firmware_updates,
+            release.url,
+            release.checksum,
+            whonix,
+            cancel,
+            release.size
+        )
+        executor.shutdown(wait=False)
+        return release.checksum, future, cancel
+
+    def _finish_speculative_download(self, speculative, sha=None):
+        """Waits for the speculative download if it fetches the chosen
+        release, otherwise cancels it. Errors are ignored, the chosen
+        release is downloaded again in the foreground.
+
+        Keywords arguments:
+        speculative -- speculative download or None
+        sha -- checksum of the chosen release
+        """
+        if speculative is None:
+            return
+        speculative_sha, future, cancel = speculative
+        if speculative_sha != sha:
+            cancel.set()
+        else:
+            print("Waiting for the firmware download to finish...")
+        try:
+            future.result()
+        except Exception:
+            pass
+
+    def _download_firmware_updates(self, url, sha, whonix=False, size=None):
+        """Initializes downloading firmware upadate archive.
+
+        Keywords arguments:
+        url -- url path to the firmware upadate archive
+        sha -- SHA1 checksum of the firmware update archive
+        whonix -- Flag enforces downloading the updates via Tor
+        size -- expected size of the archive, if known
+        """
+        self.arch_path = self._fetch_firmware_updates(
+            url,
+            sha,
+            whonix=whonix,
+            size=size
+        )
+        self.arch_name = os.path.basename(self.arch_path)
 
     def _user_input(self, updates_dict, downgrade=False, usbvm=False):
         """UI for update process.
@@ -441,19 +830,17 @@ class QubesFwupdmgr:
         if downgrade:
             while True:
                 try:
-                    releases = updates_list[device_num]["Releases"]
+                    releases = updates_list[device_num].releases
                     for i, fw_dngd in enumerate(releases):
                         print(decorator)
                         print(
                             f"  {i+1}. Firmware downgrade version:"
-                            f"\t {fw_dngd['Version']}"
+                            f"\t {fw_dngd.version}"
+                        )
+                        description = strip_description(
+                            fw_dngd.description,
+                            "   "
                         )
-                        description = fw_dngd["Description"].replace("<p>", "")
-                        description = description.replace("<li>", "")
-                        description = description.replace("<ul>", "")
-                        description = description.replace("</ul>", "")
-                        description = description.replace("</p>", "\n   ")
-                        description = description.replace("</li>", "\n   ")
                         print(f"   Description:{description}")
                     print("If you want to abandon downgrade process press N.")
                     choice = input("Otherwise choose downgrade number: ")
@@ -479,13 +866,12 @@ class QubesFwupdmgr:
         vm_name - VM name
         choice -- number of device to be updated
         """
-        self.name = updates_dict[vm_name][choice]["Name"]
-        self.version = updates_dict[vm_name][choice]["Releases"][0]["Version"]
-        for ver_check in updates_dict[vm_name][choice]["Releases"]:
-            if l_ver(ver_check["Version"]) >= l_ver(self.version):
-                self.version = ver_check["Version"]
-                self.url = ver_check["Url"]
-                self.sha = ver_check["Checksum"]
+        self.name = updates_dict[vm_name][choice].name
+        latest = updates_dict[vm_name][choice].releases[0]
+        self.version = latest.version
+        self.url = latest.url
+        self.sha = latest.checksum
+        self.size = latest.size
 
     def _install_dom0_firmware_update(self, arch_path):
         """Installs firmware update for specified device in dom0.
@@ -541,93 +927,180 @@ class QubesFwupdmgr:
             raise ValueError("No vendor information in firmware metainfo.")
         if vendor not in dmi_info:
             raise ValueError("Wrong firmware provider.")
-        if not downgrade and l_ver(version) <= l_ver(self.dmi_version):
+        if not downgrade and \
+                version_key(version) <= version_key(self.dmi_version):
             raise ValueError(
                 f"{version} < {self.dmi_version} Downgrade not allowed"
             )
 
     def _get_dom0_devices(self):
-        """Gathers information about devices connected in dom0."""
+        """Gathers information about devices connected in dom0. The output
+        of fwupdagent is left as a stream, which is parsed while it is
+        read."""
+        self.dom0_devices_info = self.snapshots.open("dom0", "get-devices")
+        if self.dom0_devices_info is not None:
+            return
+        if self.offline:
+            self.dom0_devices_info = self._offline_devices_info("dom0")
+            return
         cmd_get_dom0_devices = [
             self.fwupdagent_dom0,
             "get-devices"
         ]
         p = subprocess.Popen(
             cmd_get_dom0_devices,
-            stdout=subprocess.PIPE
+            stdout=subprocess.PIPE,
+            encoding="utf-8"
+        )
+        self.dom0_devices_info = self.snapshots.tee(
+            "dom0",
+            "get-devices",
+            AgentOutput(p, "fwudp-qubes: Getting devices info failed"),
+            always=True
+        )
+
+    def _usbvm_devices_info(self, command, usbvm_cmd, error_msg,
+                            updates=False):
+        """Returns the cached output of the usbvm query, or starts the query
+        and returns its output as a stream, which is parsed while it is read.
+        If the QUBES_FWUPD_DEBUG environment variable is set, a copy of the
+        output is written to the usbvm device log.
+
+        Keywords arguments:
+        command -- name of the query in the snapshot cache
+        usbvm_cmd -- command run in usbvm
+        error_msg -- message of the exception raised on failure
+        updates -- the offline answer keeps only the newer releases
+        """
+        devices_info = self.snapshots.open(USBVM_N, command)
+        if devices_info is not None:
+            return devices_info
+        if self.offline:
+            return self._offline_devices_info(USBVM_N, updates=updates)
+        cmd_usbvm = [
+            "qvm-run",
+            "--nogui",
+            "--pass-io",
+            USBVM_N,
+            usbvm_cmd
+        ]
+        p = subprocess.Popen(
+            cmd_usbvm,
+            stdout=subprocess.PIPE,
+            encoding="utf-8"
+        )
+        copy_path = None
+        if os.environ.get(FWUPD_DEBUG_ENV):
+            os.makedirs(FWUPD_DOM0_DIR, exist_ok=True)
+            copy_path = FWUPD_USBVM_LOG
+        return self.snapshots.tee(
+            USBVM_N,
+            command,
+            AgentOutput(p, error_msg, copy_path=copy_path),
+            always=command == "get-devices"
         )
-        self.dom0_devices_info = p.communicate()[0].decode()
-        if p.returncode != 0:
-            raise Exception("fwudp-qubes: Getting devices info failed")
 
     def _get_usbvm_devices(self):
         """Gathers information about devices connected in usbvm."""
-        if os.path.exists(FWUPD_USBVM_LOG):
-            os.remove(FWUPD_USBVM_LOG)
         # Different versions of fwupd have different paths of binaries.
         # In the future the paths will be given dynamically.
-        usbvm_cmd = f'"{self.fwupdagent_usbvm} get-devices"'
-        cmd_get_usbvm_devices = 'qvm-run --nogui --pass-io %s %s > %s' % (
-            USBVM_N,
-            usbvm_cmd,
-            FWUPD_USBVM_LOG
+        self.usbvm_devices_info = self._usbvm_devices_info(
+            "get-devices",
+            f"{self.fwupdagent_usbvm} get-devices",
+            "fwudp-qubes: Getting usbvm devices info failed"
         )
-        p = subprocess.Popen(
-            cmd_get_usbvm_devices,
-            shell=True
+
+    def _get_usbvm_updates(self):
+        """Gathers the usbvm devices with newer releases. The releases are
+        filtered in usbvm, so only the compact list is sent to dom0."""
+        self.usbvm_updates_info = self._usbvm_devices_info(
+            "get-updates",
+            f"{FWUPD_USBVM_VALIDATE} devices updates {self.fwupdagent_usbvm}",
+            "fwudp-qubes: Getting usbvm updates failed",
+            updates=True
+        )
+
+    def _get_usbvm_downgrades(self):
+        """Gathers the usbvm devices with older releases. The releases are
+        filtered in usbvm, so only the compact list is sent to dom0."""
+        self.usbvm_downgrades_info = self._usbvm_devices_info(
+            "get-downgrades",
+            f"{FWUPD_USBVM_VALIDATE} devices downgrades "
+            f"{self.fwupdagent_usbvm}",
+            "fwudp-qubes: Getting usbvm downgrades failed"
         )
-        p.wait()
-        if p.returncode != 0:
-            raise Exception("fwudp-qubes: Getting usbvm devices info failed")
-        if not os.path.exists(FWUPD_USBVM_LOG):
-            raise Exception("usbvm device info log does not exist")
 
     def _parse_usbvm_updates(self, usbvm_devices_info):
-        """Creates dictionary and list with information about updates.
+        """Creates list of the usbvm devices with newer releases. The usbvm
+        output is not trusted, so every device is checked and the releases
+        are filtered again.
 
         Keywords argument:
-        usbvm_devices_info - gathered usbvm information
+        usbvm_devices_info - gathered usbvm information, a string or
+        a stream
         """
         self.usbvm_updates_list = []
-        usbvm_device_info_dict = json.loads(usbvm_devices_info)
-        for device in usbvm_device_info_dict["Devices"]:
-            if "Releases" in device:
-                self.usbvm_updates_list.append(
-                    {
-                        "Name": device["Name"],
-                        "Version": device["Version"],
-                        "Releases": []
-                    }
-                )
-                current_version = device["Version"]
-                for update in device["Releases"]:
-                    if l_ver(update["Version"]) > current_version:
-                        self.usbvm_updates_list[-1]["Releases"].append(
-                            {
-                                "Version": update["Version"],
-                                "Url": update["Uri"],
-                                "Checksum": update["Checksum"][0],
-                                "Description": update["Description"]
-                            }
-                        )
-                if not self.usbvm_updates_list[-1]["Releases"]:
-                    self.usbvm_updates_list.pop()
+        for device in parse_devices(usbvm_devices_info):
+            check_device(device)
+            if not device.releases or device.version is None:
+                continue
+            current_version = version_key(
+                device.version,
+                device.version_format
+            )
+            device.releases = [
+                update for update in device.releases
+                if version_key(update.version, device.version_format) >
+                current_version
+            ]
+            if device.releases:
+                self.usbvm_updates_list.append(device)
 
-    def check_fwupd_version(self, usbvm=False):
-        """Checks the fwupd client version and sets fwupdagent paths
-        dynamicly
+    def _query_domains(self, queries):
+        """Runs the queries of dom0 and usbvm concurrently and returns
+        a dictionary with the errors of the failed domains.
 
-        Keyword arguments:
-        usbvm -- usbvm support flag
+        Keywords argument:
+        queries -- dictionary of domain names and query methods
+        """
+        errors = {}
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            futures = {
+                domain: executor.submit(query)
+                for domain, query in queries.items()
+            }
+            for domain, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[domain] = e
+        return errors
+
+    def _check_domain_errors(self, errors):
+        """Reports errors of every failed domain.
+
+        Keywords argument:
+        errors -- dictionary of domain names and raised exceptions
+        """
+        if not errors:
+            return
+        for domain, error in errors.items():
+            print(f"{domain}: {error}", file=sys.stderr)
+        raise Exception(
+            "fwudp-qubes: Gathering information failed in: "
+            + ", ".join(errors)
+        )
+
+    def _agent_facts(self, cmd_version):
+        """Runs the fwupd client version command and returns the version
+        together with the matching fwupdagent path.
+
+        Keyword argument:
+        cmd_version -- version command arguments
         """
-        version_check = 'client version:\t1.3.8'
         version_regex = re.compile(
             r'client version:\t[0-9]{1,2}.[0-9]{1,2}.[0-9]{1,2}$'
         )
-        cmd_version = [
-            FWUPDMGR,
-            "--version"
-        ]
         p = subprocess.Popen(
             cmd_version,
             stdout=subprocess.PIPE
@@ -636,31 +1109,52 @@ class QubesFwupdmgr:
         assert version_regex.match(client_version), (
             'Version command output has changed!!!'
         )
-        if l_ver(version_check) > l_ver(client_version):
-            self.fwupdagent_dom0 = FWUPDAGENT_OLD
+        client_version = client_version.split("\t")[-1]
+        if version_key(FWUPD_AGENT_NEW_VERSION) > version_key(client_version):
+            agent = FWUPDAGENT_OLD
         else:
-            self.fwupdagent_dom0 = FWUPDAGENT_NEW
+            agent = FWUPDAGENT_NEW
+        return {"Version": client_version, "Agent": agent}
+
+    def check_fwupd_version(self, usbvm=False):
+        """Checks the fwupd client version and sets fwupdagent paths
+        dynamicly. The versions are cached until fwupdmgr in dom0 changes
+        or usbvm is restarted, so a warm start does not run any command
+        in usbvm.
 
+        Keyword arguments:
+        usbvm -- usbvm support flag
+        """
+        self._check_dom0_agent()
         if usbvm:
-            cmd_version = f'"{FWUPDMGR}" --version'
-            cmd_usbvm_version = [
-                'qvm-run',
-                '--pass-io',
-                USBVM_N,
-                cmd_version
-            ]
-            p = subprocess.Popen(
-                cmd_usbvm_version,
-                stdout=subprocess.PIPE
-            )
-            client_version = p.communicate()[0].decode().split("\n")[0]
-            assert version_regex.match(client_version), (
-                'Version command output has changed!!!'
-            )
-            if l_ver(version_check) > l_ver(client_version):
-                self.fwupdagent_usbvm = FWUPDAGENT_OLD
-            else:
-                self.fwupdagent_usbvm = FWUPDAGENT_NEW
+            self._check_usbvm_agent()
+
+    def _check_dom0_agent(self):
+        """Sets fwupdagent path in dom0."""
+        dom0_facts = self.facts.get(
+            "dom0-fwupd",
+            file_stamp(FWUPDMGR),
+            lambda: self._agent_facts([FWUPDMGR, "--version"])
+        )
+        self.fwupdagent_dom0 = dom0_facts["Agent"]
+
+    def _check_usbvm_agent(self):
+        """Sets fwupdagent path in usbvm."""
+        if self.usbvm_domid is None:
+            self.usbvm_domid = self._domid(USBVM_N)
+        cmd_version = f'"{FWUPDMGR}" --version'
+        cmd_usbvm_version = [
+            'qvm-run',
+            '--pass-io',
+            USBVM_N,
+            cmd_version
+        ]
+        usbvm_facts = self.facts.get(
+            f"{USBVM_N}-fwupd",
+            f"domid-{self.usbvm_domid}",
+            lambda: self._agent_facts(cmd_usbvm_version)
+        )
+        self.fwupdagent_usbvm = usbvm_facts["Agent"]
 
     def update_firmware(self, usbvm=False, whonix=False):
         """Updates firmware of the specified device.
@@ -669,27 +1163,42 @@ class QubesFwupdmgr:
         usbvm -- usbvm support flag
         whonix -- Flag enforces downloading the metadata updates via Tor
         """
-        self._get_dom0_updates()
+        queries = {"dom0": self._get_dom0_updates}
+        if usbvm:
+            queries[USBVM_N] = self._get_usbvm_updates
+        self._check_domain_errors(self._query_domains(queries))
         self._parse_dom0_updates_info(self.dom0_updates_info)
         if usbvm:
-            self._get_usbvm_devices()
-            with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-                self._parse_usbvm_updates(usbvm_device_info.read())
+            self._parse_usbvm_updates(self.usbvm_updates_info)
             update_dict = {
                 "usbvm": self.usbvm_updates_list,
                 "dom0": self.dom0_updates_list
             }
-            ret_input = self._user_input(update_dict, usbvm=True)
         else:
             update_dict = {
                 "dom0": self.dom0_updates_list
             }
-            ret_input = self._user_input(update_dict)
+        speculative = self._start_speculative_download(
+            self._speculative_release(update_dict),
+            whonix=whonix
+        )
+        try:
+            ret_input = self._user_input(update_dict, usbvm=usbvm)
+        except BaseException:
+            self._finish_speculative_download(speculative)
+            raise
         if ret_input == EXIT_CODES["NO_UPDATES"]:
+            self._finish_speculative_download(speculative)
             exit(EXIT_CODES["NO_UPDATES"])
         vm_name, choice = ret_input
         self._parse_parameters(update_dict, vm_name, choice)
-        self._download_firmware_updates(self.url, self.sha, whonix=whonix)
+        self._finish_speculative_download(speculative, sha=self.sha)
+        self._download_firmware_updates(
+            self.url,
+            self.sha,
+            whonix=whonix,
+            size=self.size
+        )
         if self.name == "System Firmware":
             Path(BIOS_UPDATE_FLAG).touch(mode=0o644, exist_ok=True)
             extracted_path = self.arch_path.replace(".cab", "")
@@ -700,36 +1209,246 @@ class QubesFwupdmgr:
             self._validate_usbvm_dirs()
             self._copy_firmware_updates(self.arch_name)
             self._install_usbvm_firmware_update(self.arch_name)
+        self.snapshots.invalidate()
+        device = update_dict[vm_name][choice]
+        self._add_update_record(
+            vm_name,
+            device,
+            device.releases[0],
+            "updated"
+        )
 
-    def _parse_downgrades(self, device_list):
-        """Parses information about possible downgrades.
+    def _gather_updates(self, usbvm=False):
+        """Returns dictionary of the available updates for dom0 and usbvm.
 
-        Keywords argument:
-        device_list -- list of connected devices
+        Keyword argument:
+        usbvm -- usbvm support flag
         """
-        downgrades = []
-        dom0_devices_info_dict = json.loads(device_list)
-        for device in dom0_devices_info_dict["Devices"]:
-            if "Releases" in device:
-                try:
-                    version = device["Version"]
-                except KeyError:
+        queries = {"dom0": self._get_dom0_updates}
+        if usbvm:
+            queries[USBVM_N] = self._get_usbvm_updates
+        self._check_domain_errors(self._query_domains(queries))
+        self._parse_dom0_updates_info(self.dom0_updates_info)
+        update_dict = {"dom0": self.dom0_updates_list}
+        if usbvm:
+            self._parse_usbvm_updates(self.usbvm_updates_info)
+            update_dict["usbvm"] = self.usbvm_updates_list
+        return update_dict
+
+    def _plan_updates(self, update_dict, device=None, version=None):
+        """Returns list of the updates to be installed in the batch mode.
+        Every device gets its latest release, or the release given with
+        `version`. System firmware is planned last.
+
+        Keywords arguments:
+        update_dict -- dictionary of updates for dom0 and usbvm
+        device -- name of the only device to be updated
+        version -- version of the firmware to be installed
+        """
+        plan = []
+        for vm_name, updates_list in update_dict.items():
+            for dev in updates_list:
+                if device is not None and dev.name != device:
+                    continue
+                if version is None:
+                    release = dev.releases[0] if dev.releases else None
+                else:
+                    release = next(
+                        (
+                            rel for rel in dev.releases
+                            if rel.version == version
+                        ),
+                        None
+                    )
+                if release is None:
                     continue
-                downgrades.append(
+                plan.append(
                     {
-                        "Name": device["Name"],
-                        "Version": device["Version"],
-                        "Releases": [
-                            {
-                                "Version": downgrade["Version"],
-                                "Description": downgrade["Description"],
-                                "Url": downgrade["Uri"],
-                                "Checksum": downgrade["Checksum"][0]
-                            } for downgrade in device["Releases"]
-                            if l_ver(downgrade["Version"]) < l_ver(version)
-                        ]
+                        "VM": vm_name,
+                        "Device": dev,
+                        "Release": release,
                     }
                 )
+        plan.sort(
+            key=lambda entry: entry["Device"].name == "System Firmware"
+        )
+        return plan
+
+    def _install_planned_update(self, entry, arch_path):
+        """Installs single update of the batch plan.
+
+        Keywords arguments:
+        entry -- update of the plan
+        arch_path -- absolute path to the verified firmware update archive
+        """
+        if entry["Device"].name == "System Firmware":
+            Path(BIOS_UPDATE_FLAG).touch(mode=0o644, exist_ok=True)
+            self._verify_dmi(
+                arch_path.replace(".cab", ""),
+                entry["Release"].version
+            )
+        if entry["VM"] == "dom0":
+            self._install_dom0_firmware_update(arch_path)
+        else:
+            arch_name = os.path.basename(arch_path)
+            self._copy_firmware_updates(arch_name)
+            self._install_usbvm_firmware_update(arch_name)
+
+    def _print_summary(self, plan, results, title="Update summary:"):
+        """Prints the result of every update of the batch plan.
+
+        Keywords arguments:
+        plan -- list of the planned updates
+        results -- list of the update results
+        title -- title of the summary
+        """
+        decorator = "======================================================"
+        print(decorator)
+        print(title)
+        for entry, result in zip(plan, results):
+            device = entry["Device"]
+            print(
+                f"  {entry['VM']:<6} {device.name}: {device.version} -> "
+                f"{entry['Release'].version}\t{result}"
+            )
+            self._add_update_record(
+                entry["VM"],
+                device,
+                entry["Release"],
+                result
+            )
+
+    def update_firmware_batch(self, usbvm=False, whonix=False, device=None,
+                              version=None):
+        """Updates all devices, or the device given with `device`, without
+        asking the user. The next archive is downloaded and verified while
+        the current one is being installed.
+
+        Keyword arguments:
+        usbvm -- usbvm support flag
+        whonix -- Flag enforces downloading the metadata updates via Tor
+        device -- name of the only device to be updated
+        version -- version of the firmware to be installed
+        """
+        update_dict = self._gather_updates(usbvm=usbvm)
+        plan = self._plan_updates(update_dict, device=device, version=version)
+        if not plan:
+            print("No updates available.")
+            return EXIT_CODES["NO_UPDATES"]
+        if usbvm and any(entry["VM"] == "usbvm" for entry in plan):
+            self._validate_usbvm_dirs()
+        results = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            downloads = [
+                executor.submit(
+                    self._fetch_firmware_updates,
+                    entry["Release"].url,
+                    entry["Release"].checksum,
+                    whonix,
+                    size=entry["Release"].size
+                ) for entry in plan
+            ]
+            for entry, download in zip(plan, downloads):
+                try:
+                    self._install_planned_update(entry, download.result())
+                    results.append("updated")
+                except Exception as e:
+                    results.append(f"failed: {e}")
+        self.snapshots.invalidate()
+        self._print_summary(plan, results)
+        if any(result != "updated" for result in results):
+            return EXIT_CODES["ERROR"]
+        return EXIT_CODES["SUCCESS"]
+
+    def prefetch_updates(self, usbvm=False, whonix=False,
+                         jobs=PREFETCH_JOBS):
+        """Downloads and verifies archives of all pending updates into
+        the firmware store, so that a later update does not have to wait
+        for the updateVM.
+
+        Keyword arguments:
+        usbvm -- usbvm support flag
+        whonix -- Flag enforces downloading the metadata updates via Tor
+        jobs -- maximal number of the concurrent downloads
+        """
+        plan = self._plan_updates(self._gather_updates(usbvm=usbvm))
+        if not plan:
+            print("No updates available.")
+            return EXIT_CODES["NO_UPDATES"]
+        downloads = {}
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for entry in plan:
+                release = entry["Release"]
+                if release.checksum not in downloads:
+                    downloads[release.checksum] = executor.submit(
+                        self._fetch_firmware_updates,
+                        release.url,
+                        release.checksum,
+                        whonix,
+                        size=release.size
+                    )
+        results = []
+        for entry in plan:
+            error = downloads[entry["Release"].checksum].exception()
+            if error is None:
+                results.append("prefetched")
+            else:
+                results.append(f"failed: {error}")
+        self._print_summary(plan, results, title="Prefetch summary:")
+        if any(result != "prefetched" for result in results):
+            return EXIT_CODES["ERROR"]
+        return EXIT_CODES["SUCCESS"]
+
+    def spawn_prefetch(self, whonix=False):
+        """Starts prefetching updates in a detached process, which outlives
+        the current command. Its output goes to the prefetch log.
+
+        Keyword argument:
+        whonix -- Flag enforces downloading the metadata updates via Tor
+        """
+        cmd_prefetch = [
+            QUBES_FWUPDMGR,
+            "prefetch"
+        ]
+        if whonix:
+            cmd_prefetch.append("--whonix")
+        with open(FWUPD_DOM0_PREFETCH_LOG, "w") as prefetch_log:
+            subprocess.Popen(
+                cmd_prefetch,
+                stdin=subprocess.DEVNULL,
+                stdout=prefetch_log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True
+            )
+        print(
+            "Prefetching firmware updates in the background. "
+            f"See {FWUPD_DOM0_PREFETCH_LOG}"
+        )
+
+    def _parse_downgrades(self, device_list, usbvm=False):
+        """Parses information about possible downgrades.
+
+        Keywords argument:
+        device_list -- fwupdagent list of connected devices, a string or
+        a stream
+        usbvm -- the list comes from usbvm, so every device is checked
+        """
+        downgrades = []
+        for device in parse_devices(device_list):
+            if usbvm:
+                check_device(device)
+            if not device.releases or device.version is None:
+                continue
+            current_version = version_key(
+                device.version,
+                device.version_format
+            )
+            device.releases = [
+                downgrade for downgrade in device.releases
+                if version_key(downgrade.version, device.version_format) <
+                current_version
+            ]
+            downgrades.append(device)
         return downgrades
 
     def _install_dom0_firmware_downgrade(self, arch_path):
@@ -756,45 +1475,57 @@ class QubesFwupdmgr:
         usbvm -- usbvm support flag
         whonix -- Flag enforces downloading the metadata updates via Tor
         """
-        self._get_dom0_devices()
+        queries = {"dom0": self._get_dom0_devices}
+        if usbvm:
+            queries[USBVM_N] = self._get_usbvm_downgrades
+        self._check_domain_errors(self._query_domains(queries))
         dom0_downgrades = self._parse_downgrades(self.dom0_devices_info)
         if usbvm:
-            self._get_usbvm_devices()
-            with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-                usbvm_downgrades = self._parse_downgrades(
-                    usbvm_device_info.read()
-                )
+            usbvm_downgrades = self._parse_downgrades(
+                self.usbvm_downgrades_info,
+                usbvm=True
+            )
             downgrade_dict = {
                 "usbvm": usbvm_downgrades,
                 "dom0": dom0_downgrades
             }
-            ret_input = self._user_input(
-                downgrade_dict,
-                downgrade=True,
-                usbvm=True
-            )
         else:
             downgrade_dict = {
                 "dom0": dom0_downgrades
             }
-            ret_input = self._user_input(downgrade_dict, downgrade=True)
+        speculative = self._start_speculative_download(
+            self._speculative_release(downgrade_dict, downgrade=True),
+            whonix=whonix
+        )
+        try:
+            ret_input = self._user_input(
+                downgrade_dict,
+                downgrade=True,
+                usbvm=usbvm
+            )
+        except BaseException:
+            self._finish_speculative_download(speculative)
+            raise
         if ret_input == EXIT_CODES["NO_UPDATES"]:
+            self._finish_speculative_download(speculative)
             exit(EXIT_CODES["NO_UPDATES"])
         vm_name, device_choice, downgrade_choice = ret_input
-        releases = downgrade_dict[vm_name][device_choice]["Releases"]
-        downgrade_url = releases[downgrade_choice]["Url"]
-        downgrade_sha = releases[downgrade_choice]["Checksum"]
+        device = downgrade_dict[vm_name][device_choice]
+        downgrade_url = device.releases[downgrade_choice].url
+        downgrade_sha = device.releases[downgrade_choice].checksum
+        self._finish_speculative_download(speculative, sha=downgrade_sha)
         self._download_firmware_updates(
             downgrade_url,
             downgrade_sha,
-            whonix=whonix
+            whonix=whonix,
+            size=device.releases[downgrade_choice].size
         )
-        if downgrade_dict[vm_name][device_choice]["Name"] == "System Firmware":
+        if device.name == "System Firmware":
             Path(BIOS_UPDATE_FLAG).touch(mode=0o644, exist_ok=True)
             extracted_path = self.arch_path.replace(".cab", "")
             self._verify_dmi(
                 extracted_path,
-                downgrade_dict[vm_name][device_choice]["Version"],
+                device.version,
                 downgrade=True
             )
         if vm_name == "dom0":
@@ -804,6 +1535,13 @@ class QubesFwupdmgr:
             self._copy_firmware_updates(self.arch_name)
             self._validate_usbvm_archive(self.arch_name, downgrade_sha)
             self._install_usbvm_firmware_downgrade(self.arch_name)
+        self.snapshots.invalidate()
+        self._add_update_record(
+            vm_name,
+            device,
+            device.releases[downgrade_choice],
+            "downgraded"
+        )
 
     def _output_crawler(self, updev_dict, level, help_f=False, dom0=True):
         """Prints device and updates information as a tree.
@@ -812,95 +1550,56 @@ class QubesFwupdmgr:
         updev_dict -- update/device information dictionary
         level -- level of the tree
         """
-        def _tabs(key_word):
-            return key_word + '\t'*(4 - int(len(key_word)/8))
-
-        decorator = "==================================="
-        print(2*decorator)
-        for updev_key in updev_dict:
-            style = '\t'*level
-            output = style + _tabs(updev_key + ":")
-            if len(updev_key) > 12:
-                continue
-            if updev_key == "Icons":
-                continue
-            if updev_key == "Releases":
-                continue
-            if updev_key == "Name":
-                print(style + updev_dict["Name"])
-                print(2*decorator)
-                continue
-            if isinstance(updev_dict[updev_key], str):
-                print(output + updev_dict[updev_key])
-            elif isinstance(updev_dict[updev_key], int):
-                print(output + str(updev_dict[updev_key]))
-            elif isinstance(updev_dict[updev_key][0], str):
-                for i, data in enumerate(updev_dict[updev_key]):
-                    if i == 0:
-                        print(output + u'\u00B7' + data)
-                        continue
-                    print(style + _tabs(' ') + u'\u00B7' + data)
-            elif isinstance(updev_dict[updev_key][0], dict):
-                if level == 0 and help_f is True:
-                    print(output)
-                else:
-                    if level == 0 and dom0 is True:
-                        print(f"Dom0 {output}")
-                    elif level == 0 and dom0 is False:
-                        print(f"{USBVM_N}{output}")
-
-                for nested_dict in updev_dict[updev_key]:
-                    self._output_crawler(nested_dict, level+1)
+        if help_f:
+            prefix = ""
+        elif dom0:
+            prefix = "Dom0 "
+        else:
+            prefix = USBVM_N
+        sys.stdout.write(self.renderer.tree(updev_dict, level, prefix))
+        sys.stdout.flush()
 
     def _updates_crawler(self, updates_list, usbvm=False, prefix=0):
         """Prints updates information for dom0 and usbvm
 
         Keywords arguments:
-        updates_list -- list of devices updates
+        updates_list -- iterable of devices updates, which is printed
+        device by device while it is read
         usbvm -- usbvm support flag
         prefix -- device number prefix
         """
-        available_updates = False
-        decorator = "======================================================"
-        print(decorator)
         if usbvm:
-            print(f"{USBVM_N} updates:")
+            title = f"{USBVM_N} updates:"
         else:
-            print("Dom0 updates:")
-        print(decorator)
-        if len(updates_list) == 0:
-            print("No updates available.")
+            title = "Dom0 updates:"
+        available_updates = False
+        for output, available_updates in self.renderer.iter_updates(
+            updates_list,
+            title,
+            prefix=prefix
+        ):
+            sys.stdout.write(output)
+        sys.stdout.flush()
+        if not available_updates:
             return EXIT_CODES["NO_UPDATES"]
-        else:
-            for i, device in enumerate(updates_list):
-                if len(device["Releases"]) == 0:
-                    continue
-                if not available_updates:
-                    print("Available updates:")
-                    print(decorator)
-                print("^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^")
-                print(f"{i+1+prefix}. Device: {device['Name']}")
-                print(f"   Current firmware version:\t {device['Version']}")
-                for update in device["Releases"]:
-                    print(decorator)
-                    print(
-                        "   Firmware update "
-                        f"version:\t {update['Version']}"
-                    )
-                    print(f"   URL:\t {update['Url']}")
-                    print(f"   SHA1 checksum:\t {update['Checksum']}")
-                    description = update["Description"].replace("<p>", "")
-                    description = description.replace("<li>", "")
-                    description = description.replace("<ul>", "")
-                    description = description.replace("</ul>", "")
-                    description = description.replace("</p>", "\n\t")
-                    description = description.replace("</li>", "\n\t")
-                    print(f"   Description: {description}")
-                print(decorator)
-                available_updates = True
-            if not available_updates:
-                print("No updates available.")
-                return EXIT_CODES["NO_UPDATES"]
+
+    def _list_devices(self, devices_info, vm_name):
+        """Prints the devices or adds their records while the fwupdagent
+        output is read.
+
+        Keywords arguments:
+        devices_info -- fwupdagent list of devices, a string or a stream
+        vm_name -- name of the queried domain
+        """
+        devices = iter_json_array(as_stream(devices_info), "Devices")
+        if self.json_output is not None:
+            for device in devices:
+                self._add_record(dict(device, VM=vm_name))
+            return
+        prefix = "Dom0 " if vm_name == "dom0" else USBVM_N
+        for output in self.renderer.device_tree(devices, prefix):
+            sys.stdout.write(output)
+        sys.stdout.flush()
 
     def get_devices_qubes(self, usbvm=False):
         """Gathers and prints devices information.
@@ -908,29 +1607,80 @@ class QubesFwupdmgr:
         Keyword arguments:
         usbvm -- usbvm support flag
         """
-        self._get_dom0_devices()
-        dom0_devices_info_dict = json.loads(self.dom0_devices_info)
-        self._output_crawler(dom0_devices_info_dict, 0)
+        queries = {"dom0": self._get_dom0_devices}
         if usbvm:
-            self._get_usbvm_devices()
-            with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-                usbvm_device_info_dict = json.loads(usbvm_device_info.read())
-            self._output_crawler(usbvm_device_info_dict, 0, dom0=False)
+            queries[USBVM_N] = self._get_usbvm_devices
+        errors = self._query_domains(queries)
+        if "dom0" not in errors:
+            try:
+                self._list_devices(self.dom0_devices_info, "dom0")
+            except Exception as e:
+                errors["dom0"] = e
+        if usbvm and USBVM_N not in errors:
+            try:
+                self._list_devices(self.usbvm_devices_info, USBVM_N)
+            except Exception as e:
+                errors[USBVM_N] = e
+        self._check_domain_errors(errors)
+
+    def _list_updates(self, devices, vm_name):
+        """Prints the updates or adds their records while the devices are
+        read, and returns the list of the devices.
+
+        Keywords arguments:
+        devices -- iterable of the Device instances
+        vm_name -- name of the queried domain
+        """
+        updates_list = []
+
+        def _read_devices():
+            for device in devices:
+                updates_list.append(device)
+                yield device
+
+        if self.json_output is None:
+            self._updates_crawler(_read_devices(), usbvm=vm_name != "dom0")
+        else:
+            updates_list = list(devices)
+        for device in updates_list:
+            if device.releases:
+                self._add_record(dict(device.to_json(), VM=vm_name))
+        return updates_list
 
     def get_updates_qubes(self, usbvm=False):
-        """Gathers and prints updates information.
+        """Gathers and prints updates information. The dom0 updates are
+        printed while fwupdagent output is read.
 
         Keyword arguments:
         usbvm -- usbvm support flag
         """
-        self._get_dom0_updates()
-        self._parse_dom0_updates_info(self.dom0_updates_info)
-        self._updates_crawler(self.dom0_updates_list)
+        queries = {"dom0": self._get_dom0_updates}
         if usbvm:
-            self._get_usbvm_devices()
-            with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-                self._parse_usbvm_updates(usbvm_device_info.read())
-            self._updates_crawler(self.usbvm_updates_list, usbvm=True)
+            queries[USBVM_N] = self._get_usbvm_updates
+        errors = self._query_domains(queries)
+        updates = {}
+        if "dom0" not in errors:
+            try:
+                self.dom0_updates_list = self._list_updates(
+                    iter_devices(as_stream(self.dom0_updates_info)),
+                    "dom0"
+                )
+                updates["dom0"] = self.dom0_updates_list
+            except Exception as e:
+                errors["dom0"] = e
+        if usbvm and USBVM_N not in errors:
+            try:
+                self._parse_usbvm_updates(self.usbvm_updates_info)
+                updates[USBVM_N] = self._list_updates(
+                    self.usbvm_updates_list,
+                    USBVM_N
+                )
+            except Exception as e:
+                errors[USBVM_N] = e
+        self._check_domain_errors(errors)
+        if not any(dev.releases for devs in updates.values() for dev in devs):
+            return EXIT_CODES["NO_UPDATES"]
+        return EXIT_CODES["SUCCESS"]
 
     def clean_cache(self, usbvm=False):
         """Removes updates data
@@ -939,6 +1689,8 @@ class QubesFwupdmgr:
         usbvm -- usbvm support flag
         """
         print("Cleaning dom0 cache directories")
+        self.snapshots.invalidate()
+        self.facts.invalidate()
         if os.path.exists(FWUPD_DOM0_METADATA_DIR):
             shutil.rmtree(FWUPD_DOM0_METADATA_DIR)
         if os.path.exists(FWUPD_DOM0_UPDATES_DIR):
@@ -951,31 +1703,50 @@ class QubesFwupdmgr:
         """Prints help information"""
         self._output_crawler(HELP, 0, help_f=True)
 
-    def check_usbvm(self):
-        """Checks if usbvm is running"""
-        cmd_xl_list = [
+    def _domid(self, vm_name):
+        """Returns ID of the running domain, or None if the domain is not
+        running. Unlike listing all of the domains, `xl domid` looks up
+        a single name.
+
+        Keyword argument:
+        vm_name -- name of the domain
+        """
+        cmd_domid = [
             "xl",
-            "list"
+            "domid",
+            vm_name
         ]
         p = subprocess.Popen(
-                cmd_xl_list,
-                stdout=subprocess.PIPE
-            )
-        self.output = p.communicate()[0].decode()
-        if p.returncode != 0:
-            raise Exception("fwudp-qubes: Firmware downgrade failed")
-        return USBVM_N in self.output
+            cmd_domid,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        domid = p.communicate()[0].decode().strip()
+        if p.returncode != 0 or not domid.isdigit():
+            return None
+        return int(domid)
+
+    def check_usbvm(self):
+        """Checks if usbvm is running"""
+        self.usbvm_domid = self._domid(USBVM_N)
+        return self.usbvm_domid is not None
 
-    def trusted_cleanup(self, usbvm=False):
-        """Deletes trusted directory.
+    def untrusted_cleanup(self, usbvm=False):
+        """Deletes the untrusted leftovers of interrupted downloads. The
+        downloads running concurrently hold the lock of their release in
+        the firmware store, so their directories are kept.
 
         Keyword arguments:
         usbvm -- usbvm support flag
         """
-        trusted_path = os.path.join(FWUPD_DOM0_UPDATES_DIR, "trusted.cab")
-        if os.path.exists(trusted_path):
-            os.remove(trusted_path)
-            shutil.rmtree(trusted_path.replace(".cab", ""))
+        if os.path.isdir(FWUPD_DOM0_UNTRUSTED_DIR):
+            for sha in os.listdir(FWUPD_DOM0_UNTRUSTED_DIR):
+                if not FIRMWARE_CHECKSUM_REGEX.match(sha):
+                    continue
+                leftover_path = os.path.join(FWUPD_DOM0_UNTRUSTED_DIR, sha)
+                with self.firmware_store.locked(sha, blocking=False) as idle:
+                    if idle:
+                        shutil.rmtree(leftover_path, ignore_errors=True)
         if usbvm:
             self._clean_usbvm()
 
@@ -987,34 +1758,147 @@ class QubesFwupdmgr:
         """
         if os.path.exists(BIOS_UPDATE_FLAG):
             print("BIOS was updated. Refreshing metadata...")
+            self.snapshots.invalidate()
             if "--whonix" in sys.argv:
-                self.refresh_metadata(usbvm=usbvm, whonix=True)
+                self.refresh_metadata(usbvm=usbvm, whonix=True, force=True)
             else:
-                self.refresh_metadata(usbvm=usbvm)
+                self.refresh_metadata(usbvm=usbvm, force=True)
             os.remove(BIOS_UPDATE_FLAG)
 
+    def _prepare_usbvm_side(self, facts, usbvm=False):
+        """Removes the update leftovers and refreshes the metadata, in this
+        order, as both of them may talk to usbvm.
 
-def main():
-    if os.geteuid() != 0:
-        print("You need to have root privileges to run this script.\n")
+        Keyword arguments:
+        facts -- names of the facts needed by the command
+        usbvm -- usbvm support flag
+        """
+        if "cleanup" in facts:
+            self.untrusted_cleanup(usbvm=usbvm)
+        if "metadata" in facts:
+            self.refresh_metadata_after_bios_update(usbvm=usbvm)
+            if not os.path.exists(FWUPD_DOM0_METADATA_DIR):
+                self.refresh_metadata(usbvm=usbvm)
+
+    def prepare(self, facts):
+        """Gathers the facts needed by the command and returns True if
+        usbvm is running. Only the listed facts are gathered, and those
+        independent of each other are gathered concurrently.
+
+        Keyword argument:
+        facts -- names of the facts from COMMAND_FACTS
+        """
+        usbvm = False
+        if set(facts) - {"dom0-agent"}:
+            usbvm = self.check_usbvm()
+        tasks = []
+        if "dom0-agent" in facts:
+            tasks.append(self._check_dom0_agent)
+        if "usbvm-agent" in facts and usbvm:
+            tasks.append(self._check_usbvm_agent)
+        if "cleanup" in facts or "metadata" in facts:
+            tasks.append(lambda: self._prepare_usbvm_side(facts, usbvm))
+        if not tasks:
+            return usbvm
+        with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+            futures = [executor.submit(task) for task in tasks]
+            for future in futures:
+                future.result()
+        return usbvm
+
+
+def _parse_cache_ttl():
+    """Returns the snapshot lifetime given with the --cache-ttl flag."""
+    for arg in sys.argv:
+        if arg.startswith("--cache-ttl="):
+            cache_ttl = arg.replace("--cache-ttl=", "")
+            if not cache_ttl.isdigit():
+                print(f"Invalid cache lifetime: {cache_ttl}")
+                exit(EXIT_CODES["ERROR"])
+            return int(cache_ttl)
+    return SNAPSHOT_TTL
+
+
+def _parse_update_selectors():
+    """Returns device name and firmware version given with the --device
+    and --version flags."""
+    device = None
+    version = None
+    for arg in sys.argv:
+        if arg.startswith("--device="):
+            device = arg.replace("--device=", "")
+        elif arg.startswith("--version="):
+            version = arg.replace("--version=", "")
+    if version is not None and device is None:
+        print("The --version flag requires --device.")
         exit(EXIT_CODES["ERROR"])
-    q = QubesFwupdmgr()
-    sys_usb = q.check_usbvm()
-    q.check_fwupd_version(usbvm=sys_usb)
-    q.trusted_cleanup(usbvm=sys_usb)
-    q.refresh_metadata_after_bios_update(usbvm=sys_usb)
-    if not os.path.exists(FWUPD_DOM0_DIR):
-        q.refresh_metadata(usbvm=sys_usb)
+    return device, version
+
+
+def _parse_output_format():
+    """Returns the output format given with the --json or --ndjson flag,
+    or None for the human readable output."""
+    if "--ndjson" in sys.argv:
+        return OUTPUT_NDJSON
+    if "--json" in sys.argv:
+        return OUTPUT_JSON
+    return None
+
+
+def _command_facts():
+    """Returns names of the facts needed by the command given in
+    the arguments."""
+    if len(sys.argv) < 2:
+        return ()
+    facts = COMMAND_FACTS.get(sys.argv[1], ())
+    if sys.argv[1] == "get-devices" and "--usbvm" in sys.argv:
+        facts += ("usbvm-agent",)
+    return facts
+
+
+def _run_command(q):
+    """Runs the command given in the arguments and returns its exit code.
+
+    Keyword argument:
+    q -- QubesFwupdmgr instance
+    """
+    sys_usb = q.prepare(_command_facts())
     if len(sys.argv) < 2:
         q.help()
     elif sys.argv[1] == "get-updates":
-        q.get_updates_qubes(usbvm=sys_usb)
+        return q.get_updates_qubes(usbvm=sys_usb)
     elif sys.argv[1] == "get-devices":
         q.get_devices_qubes(usbvm=sys_usb)
     elif sys.argv[1] == "refresh" and "--whonix" in sys.argv:
-        q.refresh_metadata(usbvm=sys_usb, whonix=True)
+        ret = q.refresh_metadata(usbvm=sys_usb, whonix=True)
+        if "--prefetch" in sys.argv:
+            q.spawn_prefetch(whonix=True)
+        return ret
     elif sys.argv[1] == "refresh" and "--whonix" not in sys.argv:
-        q.refresh_metadata(usbvm=sys_usb)
+        ret = q.refresh_metadata(usbvm=sys_usb)
+        if "--prefetch" in sys.argv:
+            q.spawn_prefetch()
+        return ret
+    elif sys.argv[1] == "prefetch":
+        exit(
+            q.prefetch_updates(
+                usbvm=sys_usb,
+                whonix="--whonix" in sys.argv
+            )
+        )
+    elif sys.argv[1] == "update" and (
+        "--all" in sys.argv
+        or any(arg.startswith("--device=") for arg in sys.argv)
+    ):
+        device, version = _parse_update_selectors()
+        exit(
+            q.update_firmware_batch(
+                usbvm=sys_usb,
+                whonix="--whonix" in sys.argv,
+                device=device,
+                version=version
+            )
+        )
     elif sys.argv[1] == "update" and "--whonix" in sys.argv:
         q.update_firmware(usbvm=sys_usb, whonix=True)
     elif sys.argv[1] == "update" and "--whonix" not in sys.argv:
@@ -1027,6 +1911,31 @@ def main():
         q.clean_cache(usbvm=sys_usb)
     else:
         q.help()
+    return EXIT_CODES["SUCCESS"]
+
+
+def main():
+    if os.geteuid() != 0:
+        print("You need to have root privileges to run this script.\n")
+        exit(EXIT_CODES["ERROR"])
+    output_format = _parse_output_format()
+    json_output = None
+    if output_format is not None:
+        command = sys.argv[1] if len(sys.argv) > 1 else "help"
+        json_output = JsonOutput(command, output_format)
+    q = QubesFwupdmgr(
+        use_cache="--no-cache" not in sys.argv,
+        cache_ttl=_parse_cache_ttl(),
+        json_output=json_output,
+        offline="--offline" in sys.argv
+    )
+    try:
+        if json_output is None:
+            _run_command(q)
+        else:
+            exit(json_output.run(_run_command, q))
+    finally:
+        q.close_usbvm_session()
 
 
 if __name__ == '__main__':
@@ -1,9 +1,16 @@
 #!/bin/bash
 
 FWUPD_UPDATEVM_DIR=/home/user/.cache/fwupd
+FWUPD_SCRIPTS_DIR=$(dirname "$(readlink -f "$0")")
+METADATA_DOWNLOADER="python3 $FWUPD_SCRIPTS_DIR/fwupd_download_metadata.py"
+# Whonix allows only torified connections
+if [ -e /usr/share/whonix/marker ] && command -v torsocks >/dev/null; then
+    METADATA_DOWNLOADER="torsocks $METADATA_DOWNLOADER"
+fi
 
-echo "Running fwupd download script..."
+echo "Running fwupd download script..." >&2
 
+BUNDLE=
 CLEAN=
 CHECK_ONLY=
 METADATA=
@@ -17,6 +24,9 @@ while [ -n "$1" ]; do
         --CHECK_ONLY)
             CHECK_ONLY=1
             ;;
+        --bundle)
+            BUNDLE=1
+            ;;
         --clean)
             CLEAN=1
             ;;
@@ -48,8 +58,30 @@ if [ ! -d $FWUPD_UPDATEVM_DIR ]; then
     exit 1
 fi
 
+# Stream the metadata files to dom0 as a single bundle. Every file is sent
+# as a frame with the "file <name> <sha256> <size>" header.
+if [ "$BUNDLE" == "1" ]; then
+    for FILE in firmware.xml.gz firmware.xml.gz.asc firmware.xml.gz.jcat; do
+        FILE_PATH=$FWUPD_UPDATEVM_DIR/metadata/$FILE
+        if [ ! -f "$FILE_PATH" ]; then
+            echo "Metadata file $FILE does not exist. Exiting..." >&2
+            exit 1
+        fi
+        SIZE=$(stat -c %s "$FILE_PATH")
+        DIGEST=$(sha256sum "$FILE_PATH" | cut -d ' ' -f 1)
+        echo "file $FILE $DIGEST $SIZE"
+        cat "$FILE_PATH"
+    done
+    echo "end 0"
+    exit 0
+fi
+
+# Ask the server with a conditional request, if the metadata was modified
+# since the last download. Exits with 100 when the metadata is unchanged.
 if [ "$CHECK_ONLY" == "1" ]; then
     echo "Check only mode."
+    $METADATA_DOWNLOADER --check-only
+    exit $?
 fi
 
 if [ "$CLEAN" == "1" ]; then
@@ -60,48 +92,56 @@ fi
 
 if [[ "$URL" == *"--and--"* ]]; then
     URL=${URL//--and--/&}
-    FW_NAME="untrusted.cab"
+    FW_NAME="untrusted-$SHASUM.cab"
 fi
 
 if [[ "$URL" == *"%20"* ]]; then
-    FW_NAME="untrusted.cab"
+    FW_NAME="untrusted-$SHASUM.cab"
 fi
 
 if [[ "$URL" == *"--or--"* ]]; then
     URL=${URL//--or--/|}
-    FW_NAME="untrusted.cab"
+    FW_NAME="untrusted-$SHASUM.cab"
 fi
 
 if [[ "$URL" == *"--hash--"* ]]; then
     URL=${URL//--hash--/#}
-    FW_NAME="untrusted.cab"
+    FW_NAME="untrusted-$SHASUM.cab"
 fi
 
 if [ "$METADATA" == "1" ]; then
     echo "Downloading metadata."
-    rm -rf $FWUPD_UPDATEVM_DIR/metadata/*
-    wget -P $FWUPD_UPDATEVM_DIR/metadata \
-        https://cdn.fwupd.org/downloads/firmware.xml.gz
-    wget -P $FWUPD_UPDATEVM_DIR/metadata \
-        https://cdn.fwupd.org/downloads/firmware.xml.gz.jcat
-    wget -P $FWUPD_UPDATEVM_DIR/metadata \
-        https://cdn.fwupd.org/downloads/firmware.xml.gz.asc
-    gpg --verify $FWUPD_UPDATEVM_DIR/metadata/firmware.xml.gz.asc \
-        $FWUPD_UPDATEVM_DIR/metadata/firmware.xml.gz
-    if [ ! $? -eq 0 ]; then
-        echo "Signature did NOT match. Exiting..."
+    # The metadata files are fetched concurrently over keep-alive
+    # connections, the signature is verified once all files are downloaded.
+    # Files not modified since the last download are not fetched again.
+    $METADATA_DOWNLOADER
+    RETCODE=$?
+    if [ $RETCODE -eq 100 ]; then
+        exit 100
+    elif [ ! $RETCODE -eq 0 ]; then
+        echo "Metadata download failed. Exiting..."
         exit 1
     fi
 fi
 
 if [ "$UPDATE" == "1" ]; then
-    echo "$SHASUM  $FWUPD_UPDATEVM_DIR/updates/$FW_NAME" \
-        > $FWUPD_UPDATEVM_DIR/updates/sha1-$FW_NAME
+    # The checksum length selects the algorithm, as in dom0
+    if [[ "$SHASUM" =~ ^[a-f0-9]{64}$ ]]; then
+        SHA_ALG=sha256
+    elif [[ "$SHASUM" =~ ^[a-f0-9]{40}$ ]]; then
+        SHA_ALG=sha1
+    else
+        echo "Invalid checksum: $SHASUM. Exiting..." >&2
+        exit 1
+    fi
+    SHA_FILE=$FWUPD_UPDATEVM_DIR/updates/$SHA_ALG-$FW_NAME
+    echo "$SHASUM  $FWUPD_UPDATEVM_DIR/updates/$FW_NAME" > "$SHA_FILE"
     echo "Downloading firmware update $FW_NAME"
     wget -O $FWUPD_UPDATEVM_DIR/updates/$FW_NAME $URL
-    sha1sum -c $FWUPD_UPDATEVM_DIR/updates/sha1-$FW_NAME
+    ${SHA_ALG}sum -c "$SHA_FILE"
     if [ ! $? -eq 0 ]; then
-        rm -f $FWUPD_UPDATEVM_DIR/updates/*
+        rm -f $FWUPD_UPDATEVM_DIR/updates/$FW_NAME
+        rm -f "$SHA_FILE"
         echo "Computed checksum did NOT match. Exiting..."
         exit 1
     fi
@@ -0,0 +1,366 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import base64
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import urllib.parse
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+FWUPD_UPDATEVM_DIR = "/home/user/.cache/fwupd"
+FWUPD_UPDATEVM_METADATA_DIR = os.path.join(FWUPD_UPDATEVM_DIR, "metadata")
+FWUPD_METADATA_URL = "https://cdn.fwupd.org/downloads/"
+FWUPD_METADATA_FILES = (
+    "firmware.xml.gz",
+    "firmware.xml.gz.jcat",
+    "firmware.xml.gz.asc",
+)
+FWUPD_METADATA_VALIDATORS = "validators.json"
+MAX_CONNECTIONS = 2
+HTTP_TIMEOUT = 60
+DOWNLOAD_BUFFER_SIZE = 64 * 1024
+USER_AGENT = "qubes-fwupd"
+EXIT_METADATA_UNCHANGED = 100
+
+
+class MetadataDownloader:
+    def __init__(self, base_url=FWUPD_METADATA_URL,
+                 output_dir=FWUPD_UPDATEVM_METADATA_DIR,
+                 connections=MAX_CONNECTIONS):
+        """Keyword arguments:
+        base_url -- url of the directory with the metadata files
+        output_dir -- absolute path to the metadata directory
+        connections -- number of the concurrent keep-alive connections
+        """
+        url = urllib.parse.urlsplit(base_url)
+        if url.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported url scheme: {url.scheme}")
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.base_path = url.path if url.path.endswith("/") else url.path + "/"
+        self.proxy = self._proxy(url)
+        if self.proxy is not None and self.scheme == "http":
+            # Plain HTTP requests are sent to the proxy with absolute urls
+            self.base_path = f"http://{self.netloc}{self.base_path}"
+        self.output_dir = output_dir
+        self.connections = connections
+        self._local = threading.local()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def _proxy(self, url):
+        """Returns the split url of the proxy set in the http_proxy or
+        https_proxy environment variable, as wget uses them, or None if
+        the server is reached directly.
+
+        Keyword argument:
+        url -- split url of the metadata directory
+        """
+        proxy_url = urllib.request.getproxies().get(url.scheme)
+        if not proxy_url or urllib.request.proxy_bypass(url.hostname):
+            return None
+        if "://" not in proxy_url:
+            proxy_url = f"http://{proxy_url}"
+        proxy = urllib.parse.urlsplit(proxy_url)
+        if proxy.scheme != "http" or not proxy.hostname:
+            raise ValueError(f"Unsupported proxy: {proxy_url}")
+        return proxy
+
+    def _proxy_headers(self):
+        """Returns the headers authenticating the client to the proxy."""
+        if self.proxy.username is None:
+            return {}
+        credentials = "{}:{}".format(
+            urllib.parse.unquote(self.proxy.username),
+            urllib.parse.unquote(self.proxy.password or "")
+        )
+        token = base64.b64encode(credentials.encode()).decode("ascii")
+        return {"Proxy-Authorization": f"Basic {token}"}
+
+    def _connection(self, reconnect=False):
+        """Returns keep-alive connection of the current worker thread.
+
+        Keyword argument:
+        reconnect -- drops the kept connection and opens a new one
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and not reconnect:
+            return conn
+        if conn is not None:
+            conn.close()
+        host = self.netloc
+        if self.proxy is not None:
+            host = self.proxy.hostname
+            if ":" in host:
+                host = f"[{host}]"
+            host = f"{host}:{self.proxy.port or 80}"
+        if self.scheme == "https":
+            conn = http.client.HTTPSConnection(
+                host,
+                timeout=HTTP_TIMEOUT
+            )
+            if self.proxy is not None:
+                # TLS to the server runs through a CONNECT tunnel
+                conn.set_tunnel(self.netloc, headers=self._proxy_headers())
+        else:
+            conn = http.client.HTTPConnection(
+                host,
+                timeout=HTTP_TIMEOUT
+            )
+        self._local.conn = conn
+        with self._lock:
+            self._opened.append(conn)
+        return conn
+
+    def _load_validators(self):
+        """Returns ETag and Last-Modified values of the previous download
+        of the metadata files, which still exist in the output directory."""
+        validators_path = os.path.join(
+            self.output_dir,
+            FWUPD_METADATA_VALIDATORS
+        )
+        try:
+            with open(validators_path) as validators_file:
+                validators = json.load(validators_file)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(validators, dict):
+            return {}
+        return {
+            name: validators[name] for name in FWUPD_METADATA_FILES
+            if isinstance(validators.get(name), dict)
+            and os.path.exists(os.path.join(self.output_dir, name))
+        }
+
+    def _save_validators(self, validators):
+        """Saves ETag and Last-Modified values of the metadata files.
+
+        Keyword argument:
+        validators -- dictionary of the metadata file names and validators
+        """
+        validators_path = os.path.join(
+            self.output_dir,
+            FWUPD_METADATA_VALIDATORS
+        )
+        with open(f"{validators_path}.part", "w") as validators_file:
+            json.dump(validators, validators_file)
+        os.replace(f"{validators_path}.part", validators_path)
+
+    def _request(self, name, method="GET", validator=None):
+        """Sends request for the metadata file and returns the response.
+        A kept connection closed by the server is reopened once.
+
+        Keyword arguments:
+        name -- name of the metadata file
+        method -- HTTP method
+        validator -- validators of the previous download, which make
+        the request conditional
+        """
+        headers = {
+            "Connection": "keep-alive",
+            "User-Agent": USER_AGENT,
+        }
+        if self.proxy is not None and self.scheme == "http":
+            headers.update(self._proxy_headers())
+        if validator:
+            if validator.get("etag"):
+                headers["If-None-Match"] = validator["etag"]
+            if validator.get("last_modified"):
+                headers["If-Modified-Since"] = validator["last_modified"]
+        for reconnect in (False, True):
+            conn = self._connection(reconnect=reconnect)
+            try:
+                conn.request(method, self.base_path + name, headers=headers)
+                return conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                if reconnect:
+                    raise
+        raise Exception(f"Downloading {name} failed")
+
+    def _fetch(self, name, validator=None):
+        """Downloads the metadata file to a temporary file. Returns its path
+        and validators, or None if the file has not been modified since
+        the previous download.
+
+        Keyword arguments:
+        name -- name of the metadata file
+        validator -- validators of the previous download
+        """
+        print(f"Downloading {name}")
+        response = self._request(name, validator=validator)
+        if response.status == 304 and validator:
+            response.read()
+            self._release_connection(response)
+            return None
+        if response.status != 200:
+            response.read()
+            raise Exception(
+                f"Downloading {name} failed: "
+                f"{response.status} {response.reason}"
+            )
+        part_path = os.path.join(self.output_dir, f"{name}.part")
+        with open(part_path, "wb") as part_file:
+            while True:
+                chunk = response.read(DOWNLOAD_BUFFER_SIZE)
+                if not chunk:
+                    break
+                part_file.write(chunk)
+        self._release_connection(response)
+        return part_path, {
+            "etag": response.getheader("ETag"),
+            "last_modified": response.getheader("Last-Modified"),
+        }
+
+    def _release_connection(self, response):
+        """Drops the kept connection if the server is going to close it.
+
+        Keyword argument:
+        response -- completely read response
+        """
+        if response.will_close:
+            self._local.conn.close()
+            self._local.conn = None
+
+    def _gpg_verification(self, file_path, signature_path):
+        """Verifies GPG signature of the downloaded metadata.
+
+        Keyword arguments:
+        file_path -- absolute path to the metadata file
+        signature_path -- absolute path to the detached signature
+        """
+        cmd_gpg = [
+            "gpg",
+            "--verify",
+            signature_path,
+            file_path,
+        ]
+        p = subprocess.Popen(cmd_gpg)
+        p.wait()
+        if p.returncode != 0:
+            raise Exception("Signature did NOT match. Exiting...")
+
+    def close(self):
+        """Closes all keep-alive connections."""
+        with self._lock:
+            for conn in self._opened:
+                conn.close()
+            self._opened = []
+
+    def check(self):
+        """Checks with a conditional HEAD request if the metadata has been
+        modified since the previous download."""
+        validator = self._load_validators().get("firmware.xml.gz")
+        try:
+            response = self._request(
+                "firmware.xml.gz",
+                method="HEAD",
+                validator=validator
+            )
+            response.read()
+        finally:
+            self.close()
+        if response.status == 304 and validator:
+            return False
+        if response.status != 200:
+            raise Exception(
+                "Checking metadata failed: "
+                f"{response.status} {response.reason}"
+            )
+        return True
+
+    def download(self):
+        """Downloads the modified metadata files concurrently, verifies
+        the signature and replaces the previous metadata files. Returns
+        False if none of the files has been modified."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        validators = self._load_validators()
+        downloaded = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.connections) as executor:
+                futures = {
+                    name: executor.submit(
+                        self._fetch,
+                        name,
+                        validators.get(name)
+                    )
+                    for name in FWUPD_METADATA_FILES
+                }
+                for name, future in futures.items():
+                    result = future.result()
+                    if result is not None:
+                        downloaded[name] = result
+            if not downloaded:
+                return False
+            part_paths = {
+                name: os.path.join(self.output_dir, name)
+                for name in FWUPD_METADATA_FILES
+            }
+            for name, (part_path, validator) in downloaded.items():
+                part_paths[name] = part_path
+                validators[name] = validator
+            self._gpg_verification(
+                part_paths["firmware.xml.gz"],
+                part_paths["firmware.xml.gz.asc"]
+            )
+            for name, (part_path, __) in downloaded.items():
+                os.replace(part_path, os.path.join(self.output_dir, name))
+            self._save_validators(validators)
+            return True
+        finally:
+            self.close()
+            for name in FWUPD_METADATA_FILES:
+                part_path = os.path.join(self.output_dir, f"{name}.part")
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+
+
+def main():
+    base_url = FWUPD_METADATA_URL
+    check_only = False
+    for arg in sys.argv[1:]:
+        if arg.startswith("--url="):
+            base_url = arg.replace("--url=", "")
+        elif arg == "--check-only":
+            check_only = True
+        else:
+            print(f"Command {arg} unknown. exiting...", file=sys.stderr)
+            exit(1)
+    downloader = MetadataDownloader(base_url=base_url)
+    try:
+        if check_only:
+            modified = downloader.check()
+        else:
+            modified = downloader.download()
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        exit(1)
+    if not modified:
+        print("Metadata unchanged.")
+        exit(EXIT_METADATA_UNCHANGED)
+
+
+if __name__ == '__main__':
+    main()
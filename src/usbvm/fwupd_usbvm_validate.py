@@ -1,17 +1,35 @@
 #!/usr/bin/python3
 
 import grp
-import glob
 import hashlib
+import json
 import os
 import os.path as path
 import re
 import shutil
 import subprocess
 import sys
+import zlib
+
+from fwupd_cab import CabinetReader
+from fwupd_common import (
+    DIGEST_ALGORITHMS,
+    check_digest,
+    compare_digest,
+    copy_payload,
+    digest_algorithm,
+    parse_size,
+    read_header,
+    write_frame,
+)
+from fwupd_gpg import GpgVerifier
+from fwupd_jcat import JcatFile
+from fwupd_model import AgentOutput, iter_devices
+from fwupd_version import version_key
 
 FWUPD_USBVM_DIR = "/home/user/.cache/fwupd"
 FWUPD_USBVM_UPDATES_DIR = path.join(FWUPD_USBVM_DIR, "updates")
+FWUPD_USBVM_GPG_CACHE = path.join(FWUPD_USBVM_DIR, "gpg-cache.json")
 FWUPD_USBVM_METADATA_DIR = os.path.join(FWUPD_USBVM_DIR, "metadata")
 FWUPD_USBVM_METADATA_SIGNATURE = os.path.join(
     FWUPD_USBVM_METADATA_DIR,
@@ -21,16 +39,28 @@ FWUPD_USBVM_METADATA_FILE = os.path.join(
     FWUPD_USBVM_METADATA_DIR,
     "firmware.xml.gz"
 )
+FWUPD_USBVM_METADATA_JCAT = os.path.join(
+    FWUPD_USBVM_METADATA_DIR,
+    "firmware.xml.gz.jcat"
+)
 FWUPDMGR = "/bin/fwupdmgr"
+FWUPDAGENT_PATHS = ("/bin/fwupdagent", "/usr/libexec/fwupd/fwupdagent")
+DEVICES_FILTERS = ("updates", "downgrades")
 
-GPG_LVFS_REGEX = re.compile(
-    r"gpg: Good signature from [a-z0-9\[\]\@\<\>\.\"\"]{1,128}"
+FWUPD_METADATA_FILES_REGEX = re.compile(
+    r"^firmware.xml.gz.?[aj]?[sc]?[ca]?t?$"
 )
+FWUPD_ARCHIVE_REGEX = re.compile(r"^[A-Za-z0-9_.\-]{1,250}\.cab$")
+FWUPD_SHA_REGEX = re.compile(r"^([a-f0-9]{40}|[a-f0-9]{64})$")
+MAX_PUT_SIZE = 512 * 1024 * 1024
 
 WARNING_COLOR = '\033[93m'
 
 
 class FwupdUsbvmUpdates:
+    def __init__(self):
+        self.received_digests = {}
+
     def _create_dirs(self, *args):
         """Method creates directories.
 
@@ -56,19 +86,14 @@ class FwupdUsbvmUpdates:
                 )
 
     def _check_shasum(self, file_path, sha):
-        """Compares computed SHA1 checksum with `sha` parameter.
+        """Compares computed SHA1 or SHA256 checksum with `sha` parameter.
+        The file is hashed in fixed-size chunks.
 
         Keyword arguments:
         file_path -- absolute path to the file
-        sha -- SHA1 checksum of the file
+        sha -- SHA1 or SHA256 checksum of the file
         """
-        with open(file_path, 'rb') as f:
-            c_sha = hashlib.sha1(f.read()).hexdigest()
-        if c_sha != sha:
-            raise ValueError(
-                "Computed checksum %s did NOT match %s. " %
-                (c_sha, sha)
-            )
+        check_digest(file_path, sha)
 
     def _verify_received(self, files_path, regex_pattern):
         """Checks if sent files match  regex filename pattern.
@@ -94,52 +119,41 @@ class FwupdUsbvmUpdates:
                 )
 
     def _extract_archive(self, archive_path, output_path):
-        """Extracts archive file to the specified directory.
+        """Extracts the firmware, its signature and metainfo from archive
+        file to the specified directory. Returns paths of extracted files.
 
         Keyword arguments:
         archive_path -- absolute path to archive file
         output_path -- absolute path to the output directory
         """
-        cmd_extract = [
-            "cabextract",
-            "-d",
-            "%s" % output_path,
-            "%s" % archive_path
-        ]
-        p = subprocess.Popen(cmd_extract, stdout=subprocess.PIPE)
-        p.communicate()[0].decode('ascii')
-        if p.returncode != 0:
+        try:
+            return CabinetReader(archive_path).extract(output_path)
+        except (OSError, ValueError, zlib.error) as e:
             raise Exception(
-                'cabextract: Error while extracting %s.' %
-                archive_path
+                'Error while extracting %s: %s' % (archive_path, e)
             )
 
-    def _gpg_verification(self, file_path):
-        """Verifies GPG signature.
+    def _gpg_verification(self, *file_paths):
+        """Verifies GPG signatures of the files with a single batch.
 
         Keyword argument:
-        file_path -- absolute path to inspected file
+        *file_paths -- absolute paths to inspected files
         """
-        cmd_gpg = [
-            "gpg",
-            "--verify",
-            "%s.asc" % file_path,
-            "%s" % file_path,
-        ]
-        p = subprocess.Popen(
-            cmd_gpg,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+        GpgVerifier(FWUPD_USBVM_GPG_CACHE).verify_many(
+            [(file_path, "%s.asc" % file_path) for file_path in file_paths]
+        )
+
+    def _verify_metadata(self, metadata_file):
+        """Checks the metadata checksum embedded in the JCAT file before
+        verifying GPG signatures of the metadata.
+
+        Keyword argument:
+        metadata_file -- absolute path to the metadata file
+        """
+        JcatFile("%s.jcat" % metadata_file).verify(
+            metadata_file,
+            GpgVerifier(FWUPD_USBVM_GPG_CACHE)
         )
-        __, stderr = p.communicate()
-        verification = stderr.decode('ascii')
-        print(verification)
-        if p.returncode != 0:
-            raise Exception('gpg: Verification failed')
-        if not GPG_LVFS_REGEX.search(verification.strip()):
-            raise Exception(
-                'Domain updateVM sent not signed firmware: ' + file_path
-            )
 
     def validate_dirs(self):
         """Validates and creates directories"""
@@ -167,11 +181,10 @@ class FwupdUsbvmUpdates:
         """Validates received the metadata files."""
         print("Running validation of the metadata files")
         try:
-            self._gpg_verification(FWUPD_USBVM_METADATA_FILE)
-        except Exception as e:
-            print(str(e), file=sys.stderr)
+            self._verify_metadata(FWUPD_USBVM_METADATA_FILE)
+        except Exception:
             self.clean()
-            exit(1)
+            raise
 
     def validate_updates(self, archive_path, sha):
         """Validates recived an update file.
@@ -181,25 +194,260 @@ class FwupdUsbvmUpdates:
         sha -- SHA1 checksum of the firmware update archive
         """
         print("Running validation of the update archive")
-        self._check_shasum(archive_path, sha)
+        received_digests = self.received_digests.pop(archive_path, None)
+        if received_digests is None:
+            self._check_shasum(archive_path, sha)
+        else:
+            compare_digest(received_digests[digest_algorithm(sha)], sha)
         output_path = archive_path.replace(".cab", "")
-        self._extract_archive(archive_path, output_path)
-        signature_name = path.join(output_path, "firmware*.asc")
-        file_path = glob.glob(signature_name)
+        extracted = self._extract_archive(archive_path, output_path)
+        signatures = [f for f in extracted if f.endswith(".asc")]
         try:
-            self._gpg_verification(file_path[0].replace(".asc", ""))
-        except Exception as e:
-            print(str(e), file=sys.stderr)
+            if not signatures:
+                raise Exception('Firmware signature does not exist')
+            self._gpg_verification(
+                *[f[:-len(".asc")] for f in signatures]
+            )
+        except Exception:
             self.clean()
-            exit(1)
+            raise
+
+    def _filter_releases(self, device, devices_filter):
+        """Returns the releases of the device newer than its current
+        version for the updates, or the older ones for the downgrades.
+
+        Keyword arguments:
+        device -- Device instance
+        devices_filter -- "updates" or "downgrades"
+        """
+        current_version = version_key(device.version, device.version_format)
+        releases = []
+        for release in device.releases:
+            version = version_key(release.version, device.version_format)
+            if devices_filter == "updates" and version > current_version:
+                releases.append(release)
+            elif devices_filter == "downgrades" and version < current_version:
+                releases.append(release)
+        return releases
+
+    def _compact_device(self, device):
+        """Returns the device dictionary with only the fields read by dom0,
+        in the format of fwupdagent.
+
+        Keyword argument:
+        device -- Device instance
+        """
+        compact = {
+            "Name": device.name,
+            "Version": device.version,
+            "Releases": [
+                {
+                    "Version": release.version,
+                    "Uri": release.url,
+                    "Checksum": [release.checksum],
+                    "Description": release.description,
+                    "Size": release.size,
+                } for release in device.releases
+            ],
+        }
+        if device.version_format is not None:
+            compact["VersionFormat"] = device.version_format
+        return compact
+
+    def list_devices(self, devices_filter, fwupdagent, stdout):
+        """Writes the devices with their releases filtered for dom0. The
+        updates list keeps only the devices with newer releases, as
+        `get-updates` does. The downgrades list keeps every device with
+        a version and releases, and only its older releases.
+
+        Keyword arguments:
+        devices_filter -- "updates" or "downgrades"
+        fwupdagent -- absolute path to fwupdagent
+        stdout -- text output stream
+        """
+        if devices_filter not in DEVICES_FILTERS:
+            raise Exception("Unknown devices filter: %s" % devices_filter)
+        if fwupdagent not in FWUPDAGENT_PATHS:
+            raise Exception("Unexpected fwupdagent path: %s" % fwupdagent)
+        p = subprocess.Popen(
+            [fwupdagent, "get-devices"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            encoding="utf-8"
+        )
+        devices = iter_devices(AgentOutput(p, "fwupdagent get-devices failed"))
+        separator = ""
+        stdout.write('{"Devices":[')
+        for device in devices:
+            if not device.releases or device.version is None:
+                continue
+            device.releases = self._filter_releases(device, devices_filter)
+            if devices_filter == "updates" and not device.releases:
+                continue
+            stdout.write(separator)
+            stdout.write(
+                json.dumps(self._compact_device(device), separators=(",", ":"))
+            )
+            separator = ","
+        stdout.write("]}\n")
+
+    def _run_fwupdmgr(self, *args):
+        """Runs fwupdmgr with the given arguments. The output is redirected
+        to stderr, because stdout is used by the server channel.
+
+        Keyword argument:
+        *args -- fwupdmgr arguments
+        """
+        p = subprocess.Popen(
+            [FWUPDMGR, *args],
+            stdin=subprocess.DEVNULL,
+            stdout=sys.stderr,
+        )
+        p.wait()
+        if p.returncode != 0:
+            raise Exception(f"fwupdmgr {args[0]} failed")
+
+    def _receive_file(self, stream, kind, name, size):
+        """Writes payload of the `put` request to the cache directory.
+        Checksums of the update archives are computed while they arrive.
+
+        Keyword arguments:
+        stream -- binary input stream
+        kind -- "metadata" or "updates"
+        name -- name of the received file
+        size -- size of the received file
+        """
+        if kind == "metadata" and FWUPD_METADATA_FILES_REGEX.match(name):
+            file_path = path.join(FWUPD_USBVM_METADATA_DIR, name)
+        elif kind == "updates" and FWUPD_ARCHIVE_REGEX.match(name):
+            file_path = path.join(FWUPD_USBVM_UPDATES_DIR, name)
+        else:
+            copy_payload(stream, None, size)
+            raise Exception(f"Unexpected file: {kind} {name}")
+        self.received_digests.pop(file_path, None)
+        digests = {}
+        if kind == "updates":
+            digests = {
+                algorithm: hashlib.new(algorithm)
+                for algorithm in DIGEST_ALGORITHMS
+            }
+        with open(file_path, "wb") as output:
+            copy_payload(stream, output, size, digests.values())
+        if digests:
+            self.received_digests[file_path] = {
+                algorithm: digest.hexdigest()
+                for algorithm, digest in digests.items()
+            }
+
+    def _archive_path(self, name):
+        """Returns path of the archive file in the updates directory.
+
+        Keyword argument:
+        name -- name of the archive file
+        """
+        if not FWUPD_ARCHIVE_REGEX.match(name):
+            raise Exception(f"Invalid archive name: {name}")
+        return path.join(FWUPD_USBVM_UPDATES_DIR, name)
+
+    def _handle_request(self, stream, tokens):
+        """Runs the command of a single server request.
+
+        Keyword arguments:
+        stream -- binary input stream
+        tokens -- tokens of the request header
+        """
+        command, args = tokens[0], tokens[1:-1]
+        size = parse_size(tokens[-1], MAX_PUT_SIZE)
+        if command == "put" and len(args) == 2:
+            self._receive_file(stream, args[0], args[1], size)
+            return
+        copy_payload(stream, None, size)
+        if command == "dirs" and not args:
+            self.validate_dirs()
+        elif command == "clean" and not args:
+            self.clean()
+        elif command == "metadata" and not args:
+            self.validate_metadata()
+        elif command == "refresh" and not args:
+            self._run_fwupdmgr(
+                "refresh",
+                FWUPD_USBVM_METADATA_FILE,
+                FWUPD_USBVM_METADATA_JCAT,
+                "lvfs"
+            )
+        elif command == "updates" and len(args) == 2:
+            if not FWUPD_SHA_REGEX.match(args[1]):
+                raise Exception(f"Invalid checksum: {args[1]}")
+            self.validate_updates(self._archive_path(args[0]), args[1])
+        elif command == "install" and len(args) == 1:
+            self._run_fwupdmgr("install", self._archive_path(args[0]))
+        elif command == "downgrade" and len(args) == 1:
+            self._run_fwupdmgr(
+                "--allow-older",
+                "install",
+                self._archive_path(args[0])
+            )
+        else:
+            raise Exception(f"Unknown command: {command}")
+
+    def serve(self, stdin, stdout):
+        """Handles requests sent by dom0 over a single qrexec connection.
+        Every request is answered with an `ok` or `error` frame.
+
+        Keyword arguments:
+        stdin -- binary stream of requests
+        stdout -- binary stream of responses
+        """
+        while True:
+            try:
+                tokens = read_header(stdin)
+            except EOFError:
+                return
+            except ValueError as e:
+                write_frame(stdout, ["error"], str(e).encode("utf-8"))
+                return
+            if tokens[0] == "quit":
+                # dom0 may close the connection without waiting for the reply
+                try:
+                    write_frame(stdout, ["ok"])
+                except BrokenPipeError:
+                    pass
+                return
+            try:
+                self._handle_request(stdin, tokens)
+            except EOFError:
+                return
+            except Exception as e:
+                write_frame(stdout, ["error"], str(e).encode("utf-8"))
+                continue
+            write_frame(stdout, ["ok"])
 
 
 def main():
     f = FwupdUsbvmUpdates()
     if len(sys.argv) < 2:
         raise Exception("Invalid number of arguments.")
+    if sys.argv[1] == "server":
+        stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+        sys.stdout = sys.stderr
+        f.serve(stdin, stdout)
     if sys.argv[1] == "metadata":
-        f.validate_metadata()
+        try:
+            f.validate_metadata()
+        except Exception as e:
+            print(str(e), file=sys.stderr)
+            exit(1)
+    if sys.argv[1] == "devices":
+        if len(sys.argv) < 4:
+            raise Exception(
+                "Invalid number of arguments.\n"
+                "Expected devices filter and fwupdagent path."
+            )
+        try:
+            f.list_devices(sys.argv[2], sys.argv[3], sys.stdout)
+        except Exception as e:
+            print(str(e), file=sys.stderr)
+            exit(1)
     if sys.argv[1] == "dirs":
         f.validate_dirs()
     if sys.argv[1] == "clean":
@@ -210,7 +458,11 @@ def main():
                 "Invalid number of arguments.\n"
                 "Expected archive path and checksum."
             )
-        f.validate_updates(sys.argv[2], sys.argv[3])
+        try:
+            f.validate_updates(sys.argv[2], sys.argv[3])
+        except Exception as e:
+            print(str(e), file=sys.stderr)
+            exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,13 @@
+import os
+import sys
+
+# The scripts import their helper modules as top-level modules, the same
+# way they do when they are run from the installation directory.
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+for script_dir in (
+    SRC_DIR,
+    os.path.join(SRC_DIR, "usbvm"),
+    os.path.join(SRC_DIR, "updatevm"),
+):
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
@@ -0,0 +1,689 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2020  Norbert Kaminski  <norbert.kaminski@3mdeb.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+import gzip
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fwupd_cab import CabinetReader  # noqa: E402
+from fwupd_common import file_digests  # noqa: E402
+from fwupd_metadata import MetadataIndex  # noqa: E402
+from fwupd_model import (  # noqa: E402
+    AgentOutput,
+    Release,
+    iter_devices,
+    parse_devices,
+)
+from fwupd_output import TextRenderer  # noqa: E402
+from fwupd_version import sort_releases, version_key  # noqa: E402
+
+MB = 1024 * 1024
+DIGEST_SIZES_MB = (1, 2, 4, 8, 16, 32, 64, 128)
+LOGS_DIR = os.path.join(os.path.dirname(__file__), "logs")
+CAB_FIXTURES = ("firmware.cab", "firmware-mszip.cab")
+CAB_ROUNDS = 200
+VERSION_DEVICES = (100, 1000, 5000)
+VERSION_RELEASES = 8
+VERSION_ROUNDS = 5
+MODEL_DEVICES = 5000
+MODEL_RELEASES = 4
+RENDER_DEVICES = 1000
+INDEX_COMPONENTS = (1000, 5000, 20000)
+INDEX_QUERIES = 100
+STREAM_DEVICES = (1000, 4000, 16000)
+
+
+def _measure(func, *args):
+    """Runs the function in a forked child and returns its run time in
+    seconds and the peak resident set size of the child in MB.
+
+    Keyword arguments:
+    func -- measured function
+    *args -- arguments of the measured function
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        os.write(write_fd, repr(elapsed).encode())
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as result:
+        elapsed = float(result.read())
+    __, status, rusage = os.wait4(pid, 0)
+    if status != 0:
+        raise Exception("Benchmark child failed")
+    return elapsed, rusage.ru_maxrss / 1024
+
+
+def _whole_file_digests(file_path):
+    """Reference implementation reading the whole file into memory.
+
+    Keyword argument:
+    file_path -- absolute path to the file
+    """
+    with open(file_path, "rb") as f:
+        data = f.read()
+    return hashlib.sha1(data).hexdigest(), hashlib.sha256(data).hexdigest()
+
+
+def _create_file(file_path, size_mb):
+    """Writes synthetic file of the given size.
+
+    Keyword arguments:
+    file_path -- absolute path to the file
+    size_mb -- size of the file in MB
+    """
+    chunk = os.urandom(MB)
+    with open(file_path, "wb") as f:
+        for __ in range(size_mb):
+            f.write(chunk)
+
+
+def benchmark_digest():
+    """Compares peak RSS and throughput of the streaming SHA1 + SHA256
+    digest with hashing the whole file read into memory."""
+    tmp_dir = tempfile.mkdtemp()
+    print(
+        f"{'size':>8} {'method':<10} {'MB/s':>10} {'peak RSS MB':>12}"
+    )
+    try:
+        for size_mb in DIGEST_SIZES_MB:
+            file_path = os.path.join(tmp_dir, f"{size_mb}.bin")
+            _create_file(file_path, size_mb)
+            for method, func in (
+                ("whole", _whole_file_digests),
+                ("streaming", file_digests),
+            ):
+                elapsed, peak_rss = _measure(func, file_path)
+                print(
+                    f"{size_mb:>6}MB {method:<10} "
+                    f"{size_mb / elapsed:>10.1f} {peak_rss:>12.1f}"
+                )
+            os.remove(file_path)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _cabextract(archive_path, output_path):
+    """Reference extraction with the cabextract subprocess.
+
+    Keyword arguments:
+    archive_path -- absolute path to the archive file
+    output_path -- absolute path to the output directory
+    """
+    cmd_extract = ["cabextract", "-q", "-d", output_path, archive_path]
+    p = subprocess.Popen(cmd_extract, stdout=subprocess.DEVNULL)
+    p.wait()
+    if p.returncode != 0:
+        raise Exception(f"cabextract: Error while extracting {archive_path}")
+
+
+def _cabinet_reader(archive_path, output_path):
+    """Extraction of the needed members with the in-process reader.
+
+    Keyword arguments:
+    archive_path -- absolute path to the archive file
+    output_path -- absolute path to the output directory
+    """
+    CabinetReader(archive_path).extract(output_path)
+
+
+def _extract_rounds(func, archive_path, output_path):
+    """Extracts the archive CAB_ROUNDS times into a fresh directory.
+
+    Keyword arguments:
+    func -- extraction function
+    archive_path -- absolute path to the archive file
+    output_path -- absolute path to the output directory
+    """
+    for __ in range(CAB_ROUNDS):
+        func(archive_path, output_path)
+        shutil.rmtree(output_path)
+
+
+def benchmark_cab():
+    """Compares extraction time of the test archives with the in-process
+    cabinet reader and the cabextract subprocess."""
+    methods = [("reader", _cabinet_reader)]
+    if shutil.which("cabextract"):
+        methods.append(("cabextract", _cabextract))
+    else:
+        print("cabextract is not installed, skipping the reference")
+    tmp_dir = tempfile.mkdtemp()
+    print(
+        f"{'archive':<20} {'method':<10} {'ms/archive':>10} "
+        f"{'peak RSS MB':>12}"
+    )
+    try:
+        for name in CAB_FIXTURES:
+            archive_path = os.path.join(LOGS_DIR, name)
+            output_path = os.path.join(tmp_dir, "out")
+            for method, func in methods:
+                elapsed, peak_rss = _measure(
+                    _extract_rounds,
+                    func,
+                    archive_path,
+                    output_path
+                )
+                print(
+                    f"{name:<20} {method:<10} "
+                    f"{elapsed * 1000 / CAB_ROUNDS:>10.2f} {peak_rss:>12.1f}"
+                )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _synthetic_devices(devices_num):
+    """Returns devices with random versions of the releases.
+
+    Keyword argument:
+    devices_num -- number of the devices
+    """
+    rnd = random.Random(devices_num)
+    devices = []
+    for __ in range(devices_num):
+        sections = rnd.choice((2, 3, 4))
+        versions = [
+            ".".join(str(rnd.randrange(20)) for __ in range(sections))
+            for __ in range(VERSION_RELEASES + 1)
+        ]
+        devices.append(
+            {
+                "Version": versions[0],
+                "Releases": [Release(v, "", "") for v in versions[1:]],
+            }
+        )
+    return devices
+
+
+def _loose_version_releases(devices):
+    """Reference implementation comparing LooseVersion objects pairwise,
+    which parses the versions again on every comparison.
+
+    Keyword argument:
+    devices -- list of the synthetic devices
+    """
+    from distutils.version import LooseVersion as l_ver
+    for __ in range(VERSION_ROUNDS):
+        for device in devices:
+            releases = device["Releases"]
+            latest = releases[0].version
+            for release in releases:
+                if l_ver(release.version) >= l_ver(latest):
+                    latest = release.version
+            [
+                release for release in releases
+                if l_ver(release.version) < l_ver(device["Version"])
+            ]
+
+
+def _version_key_releases(devices):
+    """Sorts the releases once with the cached version keys.
+
+    Keyword argument:
+    devices -- list of the synthetic devices
+    """
+    for __ in range(VERSION_ROUNDS):
+        for device in devices:
+            current = version_key(device["Version"])
+            releases = sort_releases(device["Releases"])
+            releases[0].version
+            [
+                release for release in releases
+                if version_key(release.version) < current
+            ]
+
+
+def benchmark_version():
+    """Compares choosing the latest release and the downgrades with
+    LooseVersion and with the cached version keys."""
+    methods = [("keys", _version_key_releases)]
+    try:
+        import distutils.version  # noqa: F401
+        methods.insert(0, ("loose", _loose_version_releases))
+    except ImportError:
+        print("distutils is not available, skipping the reference")
+    print(f"{'versions':>8} {'method':<10} {'ms':>10} {'peak RSS MB':>12}")
+    for devices_num in VERSION_DEVICES:
+        devices = _synthetic_devices(devices_num)
+        versions_num = devices_num * (VERSION_RELEASES + 1)
+        for method, func in methods:
+            elapsed, peak_rss = _measure(func, devices)
+            print(
+                f"{versions_num:>8} {method:<10} "
+                f"{elapsed * 1000:>10.1f} {peak_rss:>12.1f}"
+            )
+
+
+def _write_devices_json(file_path, devices_num):
+    """Writes fwupdagent `get-devices` output with the given number of
+    devices, each with all of the fields reported by fwupd.
+
+    Keyword arguments:
+    file_path -- absolute path to the output file
+    devices_num -- number of the devices
+    """
+    description = "<p>This release fixes a number of issues:</p><ul>" + (
+        "<li>Improves stability of the device under heavy load.</li>" * 8
+    ) + "</ul>"
+    devices = []
+    for i in range(devices_num):
+        sha = hashlib.sha1(str(i).encode()).hexdigest()
+        devices.append(
+            {
+                "Name": f"Device {i}",
+                "DeviceId": sha,
+                "Guid": [hashlib.md5(f"{i}{j}".encode()).hexdigest()
+                         for j in range(4)],
+                "Summary": "Synthetic device of the benchmark",
+                "Plugin": "synthetic",
+                "Protocol": "org.example.synthetic",
+                "Flags": ["updatable", "supported", "registered"],
+                "Vendor": "Example",
+                "VendorId": "USB:0x1234",
+                "Version": "1.0.0",
+                "VersionFormat": "triplet",
+                "Icons": ["computer", "audio-card", "input-gaming"],
+                "Created": 1600000000,
+                "Releases": [
+                    {
+                        "AppstreamId": f"org.example.device{i}.firmware",
+                        "Name": f"Device {i} firmware",
+                        "Summary": "Firmware of the synthetic device",
+                        "Version": f"1.0.{j + 1}",
+                        "Description": description,
+                        "Uri": f"https://fwupd.org/downloads/{sha}-{j}.cab",
+                        "Checksum": [sha, hashlib.sha256(sha.encode())
+                                     .hexdigest()],
+                        "Size": 1048576,
+                        "Homepage": "https://example.org",
+                        "License": "LicenseRef-proprietary",
+                        "Vendor": "Example",
+                        "Flags": ["is-upgrade"],
+                    } for j in range(MODEL_RELEASES)
+                ],
+            }
+        )
+    with open(file_path, "w") as f:
+        json.dump({"Devices": devices}, f)
+
+
+def _dict_devices(file_path):
+    """Reference implementation keeping the decoded JSON together with
+    the list of the trimmed release dictionaries.
+
+    Keyword argument:
+    file_path -- absolute path to the fwupdagent output
+    """
+    with open(file_path) as f:
+        devices_info = json.loads(f.read())
+    return devices_info, [
+        {
+            "Name": device["Name"],
+            "Version": device["Version"],
+            "Releases": [
+                {
+                    "Version": release["Version"],
+                    "Url": release["Uri"],
+                    "Checksum": release["Checksum"][0],
+                    "Description": release["Description"]
+                } for release in device["Releases"]
+            ]
+        } for device in devices_info["Devices"]
+    ]
+
+
+def _model_devices(file_path):
+    """Builds the slotted device model in one pass over the JSON.
+
+    Keyword argument:
+    file_path -- absolute path to the fwupdagent output
+    """
+    with open(file_path) as f:
+        return parse_devices(f.read())
+
+
+def benchmark_model():
+    """Compares peak RSS and parse time of the synthetic fwupdagent
+    output decoded into dictionaries and into the slotted model."""
+    tmp_dir = tempfile.mkdtemp()
+    file_path = os.path.join(tmp_dir, "devices.json")
+    print(f"{'devices':>8} {'method':<10} {'ms':>10} {'peak RSS MB':>12}")
+    try:
+        # The output is generated in a child, so the measured children
+        # do not inherit its memory.
+        _measure(_write_devices_json, file_path, MODEL_DEVICES)
+        for method, func in (
+            ("dicts", _dict_devices),
+            ("model", _model_devices),
+        ):
+            elapsed, peak_rss = _measure(func, file_path)
+            print(
+                f"{MODEL_DEVICES:>8} {method:<10} "
+                f"{elapsed * 1000:>10.1f} {peak_rss:>12.1f}"
+            )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _print_tree(updev_dict, level):
+    """Reference implementation printing the device tree line by line.
+
+    Keyword arguments:
+    updev_dict -- device information dictionary
+    level -- level of the tree
+    """
+    def _tabs(key_word):
+        return key_word + '\t'*(4 - int(len(key_word)/8))
+
+    decorator = "==================================="
+    print(2*decorator)
+    for updev_key in updev_dict:
+        style = '\t'*level
+        output = style + _tabs(updev_key + ":")
+        if len(updev_key) > 12 or updev_key in ("Icons", "Releases"):
+            continue
+        if updev_key == "Name":
+            print(style + updev_dict["Name"])
+            print(2*decorator)
+            continue
+        if isinstance(updev_dict[updev_key], str):
+            print(output + updev_dict[updev_key])
+        elif isinstance(updev_dict[updev_key], int):
+            print(output + str(updev_dict[updev_key]))
+        elif isinstance(updev_dict[updev_key][0], str):
+            for i, data in enumerate(updev_dict[updev_key]):
+                if i == 0:
+                    print(output + u'\u00B7' + data)
+                    continue
+                print(style + _tabs(' ') + u'\u00B7' + data)
+        elif isinstance(updev_dict[updev_key][0], dict):
+            if level == 0:
+                print(f"Dom0 {output}")
+            for nested_dict in updev_dict[updev_key]:
+                _print_tree(nested_dict, level+1)
+
+
+def _buffered_tree(devices_info):
+    """Renders the device tree into a single buffer.
+
+    Keyword argument:
+    devices_info -- device information dictionary
+    """
+    sys.stdout.write(TextRenderer().tree(devices_info, 0, "Dom0 "))
+
+
+def _render_to_pipe(func, devices_info):
+    """Renders the devices with stdout connected to a pipe, which is
+    drained by a child process.
+
+    Keyword arguments:
+    func -- rendering function
+    devices_info -- device information dictionary
+    """
+    drain = subprocess.Popen(
+        ["cat"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL
+    )
+    sys.stdout.flush()
+    os.dup2(drain.stdin.fileno(), 1)
+    func(devices_info)
+    sys.stdout.flush()
+    os.close(1)
+    drain.stdin.close()
+    drain.wait()
+
+
+def benchmark_render():
+    """Compares rendering the device listing to a pipe line by line and
+    into a single buffer."""
+    tmp_dir = tempfile.mkdtemp()
+    file_path = os.path.join(tmp_dir, "devices.json")
+    print(f"{'devices':>8} {'method':<10} {'ms':>10}")
+    try:
+        _measure(_write_devices_json, file_path, RENDER_DEVICES)
+        with open(file_path) as f:
+            devices_info = json.load(f)
+        for method, func in (
+            ("print", lambda info: _print_tree(info, 0)),
+            ("buffered", _buffered_tree),
+        ):
+            elapsed, __ = _measure(_render_to_pipe, func, devices_info)
+            print(f"{RENDER_DEVICES:>8} {method:<10} {elapsed * 1000:>10.1f}")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _guid(i):
+    """Returns synthetic GUID of the component.
+
+    Keyword argument:
+    i -- number of the component
+    """
+    return f"{i:08x}-0000-0000-0000-000000000000"
+
+
+def _write_metadata(file_path, components_num, changed=0):
+    """Writes synthetic LVFS metadata with the given number of components.
+
+    Keyword arguments:
+    file_path -- absolute path to the firmware.xml.gz file
+    components_num -- number of the components
+    changed -- number of the components with an extra release
+    """
+    description = "<p>Fixes:</p><ul>" + "<li>Stability fix.</li>" * 8 + \
+        "</ul>"
+    with gzip.open(file_path, "wt") as metadata:
+        metadata.write('<components origin="lvfs" version="0.9">')
+        for i in range(components_num):
+            versions = [f"1.0.{j}" for j in range(MODEL_RELEASES)]
+            if i < changed:
+                versions.append("2.0.0")
+            releases = "".join(
+                f'<release version="{version}">'
+                f"<location>https://fwupd.org/downloads/{i}-{version}.cab"
+                '</location><checksum type="sha1" target="container">'
+                f"{hashlib.sha1(f'{i}{version}'.encode()).hexdigest()}"
+                '</checksum><size type="download">1048576</size>'
+                f"<description>{description}</description></release>"
+                for version in versions
+            )
+            metadata.write(
+                f'<component type="firmware"><id>org.example.device{i}</id>'
+                f"<name>Device {i}</name><provides>"
+                f'<firmware type="flashed">{_guid(i)}</firmware></provides>'
+                f"<releases>{releases}</releases></component>"
+            )
+        metadata.write("</components>")
+
+
+def _index_queries(index_path, components_num):
+    """Queries releases of INDEX_QUERIES devices.
+
+    Keyword arguments:
+    index_path -- absolute path to the index
+    components_num -- number of the components
+    """
+    index = MetadataIndex(index_path)
+    for i in range(0, components_num, components_num // INDEX_QUERIES):
+        index.releases([_guid(i)])
+
+
+def _print_index_step(components_num, step, elapsed, peak_rss):
+    """Prints result of the index benchmark step.
+
+    Keyword arguments:
+    components_num -- number of the components
+    step -- name of the step
+    elapsed -- run time in seconds
+    peak_rss -- peak RSS in MB
+    """
+    print(
+        f"{components_num:>10} {step:<8} "
+        f"{elapsed * 1000:>10.2f} {peak_rss:>12.1f}"
+    )
+
+
+def benchmark_index():
+    """Measures build time and peak RSS of the metadata index, the update
+    after a few components changed, and the time of a single query."""
+    tmp_dir = tempfile.mkdtemp()
+    metadata_file = os.path.join(tmp_dir, "firmware.xml.gz")
+    print(f"{'components':>10} {'step':<8} {'ms':>10} {'peak RSS MB':>12}")
+    try:
+        for components_num in INDEX_COMPONENTS:
+            index = MetadataIndex(
+                os.path.join(tmp_dir, f"{components_num}.sqlite")
+            )
+            _measure(_write_metadata, metadata_file, components_num)
+            _print_index_step(
+                components_num,
+                "build",
+                *_measure(index.update, metadata_file)
+            )
+            _measure(_write_metadata, metadata_file, components_num, 10)
+            _print_index_step(
+                components_num,
+                "update",
+                *_measure(index.update, metadata_file)
+            )
+            elapsed, peak_rss = _measure(
+                _index_queries,
+                index.index_path,
+                components_num
+            )
+            _print_index_step(
+                components_num,
+                "query",
+                elapsed / INDEX_QUERIES,
+                peak_rss
+            )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _agent_process(file_path):
+    """Returns process writing the fwupdagent output to a pipe.
+
+    Keyword argument:
+    file_path -- absolute path to the fwupdagent output
+    """
+    return subprocess.Popen(
+        ["cat", file_path],
+        stdout=subprocess.PIPE,
+        encoding="utf-8"
+    )
+
+
+def _whole_devices(file_path, first=False):
+    """Reference implementation reading the whole output before parsing.
+
+    Keyword arguments:
+    file_path -- absolute path to the fwupdagent output
+    first -- stops at the first device
+    """
+    p = _agent_process(file_path)
+    devices = parse_devices(p.communicate()[0])
+    if first:
+        return devices[0]
+    return len(devices)
+
+
+def _streamed_devices(file_path, first=False):
+    """Parses the devices while the output is read from the pipe.
+
+    Keyword arguments:
+    file_path -- absolute path to the fwupdagent output
+    first -- stops at the first device
+    """
+    p = _agent_process(file_path)
+    devices = iter_devices(AgentOutput(p, "Getting devices failed"))
+    if first:
+        device = next(devices)
+        p.kill()
+        p.wait()
+        return device
+    return sum(1 for __ in devices)
+
+
+def benchmark_stream():
+    """Compares peak RSS and the time of the first device of the synthetic
+    fwupdagent output read at once and parsed while it is read."""
+    tmp_dir = tempfile.mkdtemp()
+    file_path = os.path.join(tmp_dir, "devices.json")
+    print(
+        f"{'devices':>8} {'method':<10} {'ms':>10} {'first ms':>10} "
+        f"{'peak RSS MB':>12}"
+    )
+    try:
+        for devices_num in STREAM_DEVICES:
+            _measure(_write_devices_json, file_path, devices_num)
+            for method, func in (
+                ("whole", _whole_devices),
+                ("streamed", _streamed_devices),
+            ):
+                elapsed, peak_rss = _measure(func, file_path)
+                first, __ = _measure(func, file_path, True)
+                print(
+                    f"{devices_num:>8} {method:<10} {elapsed * 1000:>10.1f} "
+                    f"{first * 1000:>10.1f} {peak_rss:>12.1f}"
+                )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+BENCHMARKS = {
+    "digest": benchmark_digest,
+    "cab": benchmark_cab,
+    "version": benchmark_version,
+    "model": benchmark_model,
+    "render": benchmark_render,
+    "index": benchmark_index,
+    "stream": benchmark_stream,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Benchmark {name} unknown. exiting...", file=sys.stderr)
+            exit(1)
+    for name in names:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,44 @@
 #!/usr/bin/python3
-import distutils.version as ver
 import json
 import unittest
 import os
 import src.qubes_fwupdmgr as qfwupd
+import fwupd_usbvm_validate
+from fwupd_download_metadata import MetadataDownloader
+from fwupd_receive_updates import FwupdReceiveUpdates
 import subprocess
 import sys
 import io
+import base64
+import gzip
+import hashlib
+import re
+import http.server
 import platform
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 from pathlib import Path
+from fwupd_cab import CabinetReader
+from fwupd_cache import FactsCache, FirmwareStore, SnapshotCache
+from fwupd_common import check_digest, file_digests
+from fwupd_gpg import GpgVerifier
+from fwupd_jcat import JcatFile
+from fwupd_metadata import MetadataIndex
+from fwupd_model import Device, Release, iter_devices, parse_devices
+from fwupd_output import JsonOutput, OUTPUT_NDJSON, TextRenderer
+from fwupd_output import strip_description
+from fwupd_version import sort_releases, version_key
 from test.fwupd_logs import UPDATE_INFO, GET_DEVICES, DMI_DECODE
 from test.fwupd_logs import GET_DEVICES_NO_UPDATES, GET_DEVICES_NO_VERSION
-from unittest.mock import patch
+from unittest.mock import DEFAULT, MagicMock, patch
 
 FWUPD_DOM0_DIR = "/root/.cache/fwupd"
 FWUPD_DOM0_UPDATES_DIR = os.path.join(FWUPD_DOM0_DIR, "updates")
 FWUPD_DOM0_UNTRUSTED_DIR = os.path.join(FWUPD_DOM0_UPDATES_DIR, "untrusted")
-FWUPD_USBVM_LOG = os.path.join(FWUPD_DOM0_DIR, "usbvm-devices.log")
+FWUPD_DOM0_STORE_DIR = os.path.join(FWUPD_DOM0_UPDATES_DIR, "store")
 FWUPD_DOM0_METADATA_DIR = os.path.join(FWUPD_DOM0_DIR, "metadata")
 FWUPD_DOM0_METADATA_SIGNATURE = os.path.join(
     FWUPD_DOM0_METADATA_DIR,
@@ -39,10 +61,58 @@ FWUPD_USBVM_METADATA_FILE = os.path.join(
 )
 REQUIRED_DEV = "Requires device not connected"
 REQUIRED_USBVM = "Requires sys-usb"
-XL_LIST_LOG = "Name                                        ID   Mem VCPUs	State	Time(s)"
+REFRESH_OUTPUTS = (
+    "Successfully refreshed metadata manually\n",
+    "Metadata unchanged\n",
+)
 USBVM_N = "sys-usb"
 FWUPDMGR = "/bin/fwupdmgr"
 BIOS_UPDATE_FLAG = os.path.join(FWUPD_DOM0_DIR, "bios_update")
+LOGS_DIR = os.path.join(os.path.dirname(__file__), "logs")
+CAB_MEMBERS = {
+    "firmware.bin": "11fe5f2d3d203d2ddd0d65f9b764fd59cac40230749af15627d06cd99b9b7400",
+    "firmware.bin.asc": "c02da64400abe5eef697defa5ab85511d5e1da681f91d2db48715b127299fef5",
+    "firmware.metainfo.xml": "a1e7624ba8038e1f10903c2695e9ee96916e8ddefdac3f1334ddc1eda812292e",
+}
+
+
+class LvfsStandInHandler(http.server.BaseHTTPRequestHandler):
+    """Serves metadata files over keep-alive connections."""
+    protocol_version = "HTTP/1.1"
+    files = {}
+    connections = []
+    requests = []
+
+    def setup(self):
+        super().setup()
+        self.connections.append(self.client_address)
+
+    def do_HEAD(self):
+        self.requests.append(
+            (self.path, self.headers.get("Proxy-Authorization"))
+        )
+        name = os.path.basename(self.path)
+        if name not in self.files:
+            self.send_error(404)
+            return False
+        etag = '"%s"' % hashlib.sha1(self.files[name]).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return False
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(self.files[name])))
+        self.end_headers()
+        return True
+
+    def do_GET(self):
+        if self.do_HEAD():
+            self.wfile.write(self.files[os.path.basename(self.path)])
+
+    def log_message(self, *args):
+        pass
 
 
 def check_usbvm():
@@ -50,8 +120,7 @@ def check_usbvm():
     if 'qubes' not in platform.release():
         return False
     q = qfwupd.QubesFwupdmgr()
-    q.check_usbvm()
-    return "sys-usb" in q.output
+    return q.check_usbvm()
 
 
 def device_connected_dom0():
@@ -61,7 +130,10 @@ def device_connected_dom0():
     q = qfwupd.QubesFwupdmgr()
     q.check_fwupd_version()
     q._get_dom0_devices()
-    return "ColorHug2" in q.dom0_devices_info
+    return any(
+        device.name == "ColorHug2"
+        for device in parse_devices(q.dom0_devices_info)
+    )
 
 
 def device_connected_usbvm():
@@ -74,8 +146,10 @@ def device_connected_usbvm():
     if not os.path.exists(FWUPD_DOM0_DIR):
         q.refresh_metadata()
     q._get_usbvm_devices()
-    with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-        return "ColorHug2" in usbvm_device_info.read()
+    return any(
+        device.name == "ColorHug2"
+        for device in parse_devices(q.usbvm_devices_info)
+    )
 
 
 def check_whonix_updatevm():
@@ -83,8 +157,7 @@ def check_whonix_updatevm():
     if 'qubes' not in platform.release():
         return False
     q = qfwupd.QubesFwupdmgr()
-    q.check_usbvm()
-    return "sys-whonix" in q.output
+    return q._domid("sys-whonix") is not None
 
 
 class TestQubesFwupdmgr(unittest.TestCase):
@@ -121,27 +194,27 @@ class TestQubesFwupdmgr(unittest.TestCase):
     @unittest.skipUnless('qubes' in platform.release(), "Requires Qubes OS")
     def test_refresh_metadata_dom0(self):
         self.q.refresh_metadata()
-        self.assertEqual(
+        self.assertIn(
             self.q.output,
-            'Successfully refreshed metadata manually\n',
+            REFRESH_OUTPUTS,
             msg="Metadata refresh failed."
         )
 
     @unittest.skipUnless(check_usbvm(), REQUIRED_USBVM)
     def test_refresh_metadata_usbvm(self):
         self.q.refresh_metadata(usbvm=True)
-        self.assertEqual(
+        self.assertIn(
             self.q.output,
-            'Successfully refreshed metadata manually\n',
+            REFRESH_OUTPUTS,
             msg="Metadata refresh failed."
         )
 
     @unittest.skipUnless(check_whonix_updatevm(), "Requires sys-whonix")
     def test_refresh_metadata_whonix(self):
         self.q.refresh_metadata(whonix=True)
-        self.assertEqual(
+        self.assertIn(
             self.q.output,
-            'Successfully refreshed metadata manually\n',
+            REFRESH_OUTPUTS,
             msg="Metadata refresh failed."
         )
 
@@ -149,30 +222,31 @@ class TestQubesFwupdmgr(unittest.TestCase):
     def test_get_dom0_updates(self):
         self.q.check_fwupd_version()
         self.q._get_dom0_updates()
-        self.assertTrue(
-            "Devices" in self.q.dom0_updates_info,
+        self.assertIsInstance(
+            parse_devices(self.q.dom0_updates_info),
+            list,
             msg="Getting available updates failed"
         )
 
     def test_parse_updates_info(self):
         self.q._parse_dom0_updates_info(UPDATE_INFO)
         self.assertEqual(
-            self.q.dom0_updates_list[0]["Name"],
+            self.q.dom0_updates_list[0].name,
             "ColorHug2",
             msg="Wrong device name"
         )
         self.assertEqual(
-            self.q.dom0_updates_list[0]["Version"],
+            self.q.dom0_updates_list[0].version,
             "2.0.6",
             msg="Wrong update version"
         )
         self.assertEqual(
-            self.q.dom0_updates_list[0]["Releases"][0]["Url"],
+            self.q.dom0_updates_list[0].releases[0].url,
             "https://fwupd.org/downloads/0a29848de74d26348bc5a6e24fc9f03778eddf0e-hughski-colorhug2-2.0.7.cab",
             msg="Wrong update URL"
         )
         self.assertEqual(
-            self.q.dom0_updates_list[0]["Releases"][0]["Checksum"],
+            self.q.dom0_updates_list[0].releases[0].checksum,
             "490be5c0b13ca4a3f169bf8bc682ba127b8f7b96",
             msg="Wrong checksum"
         )
@@ -184,8 +258,8 @@ class TestQubesFwupdmgr(unittest.TestCase):
             "490be5c0b13ca4a3f169bf8bc682ba127b8f7b96"
         )
         update_path = os.path.join(
-            FWUPD_DOM0_UPDATES_DIR,
-            "0a29848de74d26348bc5a6e24fc9f03778eddf0e-hughski-colorhug2-2.0.7"
+            FWUPD_DOM0_STORE_DIR,
+            "490be5c0b13ca4a3f169bf8bc682ba127b8f7b96"
         )
         self.assertTrue(os.path.exists(update_path))
 
@@ -196,8 +270,8 @@ class TestQubesFwupdmgr(unittest.TestCase):
             "ab33c392b0703946616181deadfd1cbb5b0c6cd4"
         )
         update_path = os.path.join(
-            FWUPD_DOM0_UPDATES_DIR,
-            "trusted"
+            FWUPD_DOM0_STORE_DIR,
+            "ab33c392b0703946616181deadfd1cbb5b0c6cd4"
         )
         self.assertTrue(os.path.exists(update_path))
 
@@ -209,8 +283,8 @@ class TestQubesFwupdmgr(unittest.TestCase):
             whonix=True,
         )
         update_path = os.path.join(
-            FWUPD_DOM0_UPDATES_DIR,
-            "0a29848de74d26348bc5a6e24fc9f03778eddf0e-hughski-colorhug2-2.0.7"
+            FWUPD_DOM0_STORE_DIR,
+            "490be5c0b13ca4a3f169bf8bc682ba127b8f7b96"
         )
         self.assertTrue(os.path.exists(update_path))
 
@@ -288,6 +362,203 @@ class TestQubesFwupdmgr(unittest.TestCase):
             "2.0.7"
         )
 
+    def _batch_update_dict(self):
+        """Returns updates of dom0 and usbvm for the batch mode tests."""
+        def _release(version, sha):
+            return Release(
+                version,
+                f"https://fwupd.org/downloads/{sha}.cab",
+                sha
+            )
+        return {
+            "dom0": [
+                Device(
+                    "System Firmware",
+                    "1.0",
+                    releases=[_release("1.1", "a" * 40)]
+                ),
+                Device(
+                    "ColorHug2",
+                    "2.0.5",
+                    releases=[
+                        _release("2.0.6", "b" * 40),
+                        _release("2.0.7", "c" * 40),
+                    ]
+                ),
+            ],
+            "usbvm": [
+                Device("Dock", "1.0", releases=[_release("1.2", "d" * 40)]),
+            ],
+        }
+
+    def test_plan_updates(self):
+        update_dict = self._batch_update_dict()
+        plan = self.q._plan_updates(update_dict)
+        self.assertListEqual(
+            [
+                (e["VM"], e["Device"].name, e["Release"].version)
+                for e in plan
+            ],
+            [
+                ("dom0", "ColorHug2", "2.0.7"),
+                ("usbvm", "Dock", "1.2"),
+                ("dom0", "System Firmware", "1.1"),
+            ]
+        )
+        plan = self.q._plan_updates(
+            update_dict,
+            device="ColorHug2",
+            version="2.0.6"
+        )
+        self.assertEqual(len(plan), 1)
+        self.assertEqual(plan[0]["Release"].checksum, "b" * 40)
+        self.assertListEqual(
+            self.q._plan_updates(update_dict, device="ColorHug2",
+                                 version="9.9"),
+            []
+        )
+
+    def test_update_firmware_batch(self):
+        update_dict = self._batch_update_dict()
+        installed = []
+        downloaded = []
+
+        def _fetch(url, sha, whonix=False, size=None):
+            downloaded.append(sha)
+            if sha == "d" * 40:
+                raise Exception("Firmware download failed")
+            return f"/store/{sha}.cab"
+
+        def _install(entry, arch_path):
+            installed.append(arch_path)
+
+        plan = [
+            entry for entry in self.q._plan_updates(update_dict)
+            if entry["Device"].name != "System Firmware"
+        ]
+        with patch.object(self.q, "_query_domains", return_value={}), \
+                patch.object(self.q, "_parse_dom0_updates_info"), \
+                patch.object(self.q, "_plan_updates", return_value=plan), \
+                patch.object(self.q, "_validate_usbvm_dirs"), \
+                patch.object(self.q, "_fetch_firmware_updates", _fetch), \
+                patch.object(self.q, "_install_planned_update", _install), \
+                patch.object(self.q.snapshots, "invalidate"):
+            self.q.dom0_updates_info = None
+            self.q.dom0_updates_list = []
+            ret = self.q.update_firmware_batch()
+        self.assertEqual(ret, qfwupd.EXIT_CODES["ERROR"])
+        self.assertListEqual(downloaded, ["c" * 40, "d" * 40])
+        self.assertListEqual(installed, [f"/store/{'c' * 40}.cab"])
+        summary = self.captured_output.getvalue()
+        self.assertIn("dom0   ColorHug2: 2.0.5 -> 2.0.7\tupdated", summary)
+        self.assertIn(
+            "usbvm  Dock: 1.0 -> 1.2\tfailed: Firmware download failed",
+            summary
+        )
+
+    def test_prefetch_updates(self):
+        update_dict = self._batch_update_dict()
+        update_dict["usbvm"][0].releases[0].checksum = "c" * 40
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def _fetch(url, sha, whonix=False, size=None):
+            with lock:
+                running.append(sha)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(sha)
+            if sha == "a" * 40:
+                raise Exception("Firmware download failed")
+            return f"/store/{sha}.cab"
+
+        with patch.object(self.q, "_gather_updates",
+                          return_value=update_dict), \
+                patch.object(self.q, "_fetch_firmware_updates",
+                             side_effect=_fetch) as fetch:
+            ret = self.q.prefetch_updates(jobs=2)
+        self.assertEqual(ret, qfwupd.EXIT_CODES["ERROR"])
+        self.assertEqual(fetch.call_count, 2)
+        self.assertLessEqual(max(peak), 2)
+        summary = self.captured_output.getvalue()
+        self.assertIn("Prefetch summary:", summary)
+        self.assertIn("usbvm  Dock: 1.0 -> 1.2\tprefetched", summary)
+        self.assertIn(
+            "System Firmware: 1.0 -> 1.1\tfailed: Firmware download failed",
+            summary
+        )
+
+    @patch('src.qubes_fwupdmgr.subprocess.Popen')
+    def test_spawn_prefetch(self, mock_popen):
+        tmp_dir = tempfile.mkdtemp()
+        log_path = os.path.join(tmp_dir, "prefetch.log")
+        with patch('src.qubes_fwupdmgr.FWUPD_DOM0_PREFETCH_LOG', log_path):
+            self.q.spawn_prefetch(whonix=True)
+        args, kwargs = mock_popen.call_args
+        self.assertListEqual(
+            args[0],
+            [qfwupd.QUBES_FWUPDMGR, "prefetch", "--whonix"]
+        )
+        self.assertTrue(kwargs["start_new_session"])
+        self.assertTrue(os.path.exists(log_path))
+        shutil.rmtree(tmp_dir)
+
+    def test_speculative_release(self):
+        update_dict = self._batch_update_dict()
+        self.assertIsNone(self.q._speculative_release(update_dict))
+        single = {"dom0": update_dict["dom0"][1:], "usbvm": []}
+        self.assertEqual(
+            self.q._speculative_release(single).version,
+            "2.0.7"
+        )
+        self.assertIsNone(
+            self.q._speculative_release(single, downgrade=True)
+        )
+        single = {"dom0": [], "usbvm": update_dict["usbvm"]}
+        self.assertEqual(
+            self.q._speculative_release(single, downgrade=True).version,
+            "1.2"
+        )
+
+    def test_speculative_download_cancel(self):
+        tmp_dir = tempfile.mkdtemp()
+        marker = os.path.join(tmp_dir, "finished")
+        script = os.path.join(tmp_dir, "fwupd-dom0-update")
+        with open(script, "w") as script_file:
+            script_file.write(f"#!/bin/sh\nsleep 30\ntouch {marker}\n")
+        os.chmod(script, 0o755)
+        self.q.firmware_store = FirmwareStore(os.path.join(tmp_dir, "store"))
+        release = self._batch_update_dict()["dom0"][0].releases[0]
+        with patch('src.qubes_fwupdmgr.FWUPD_DOM0_UPDATE', script):
+            speculative = self.q._start_speculative_download(release)
+            time.sleep(0.3)
+            start = time.monotonic()
+            self.q._finish_speculative_download(speculative, sha="b" * 40)
+        self.assertLess(time.monotonic() - start, 5)
+        with self.assertRaises(Exception) as cancelled:
+            speculative[1].result()
+        self.assertIn("cancelled", str(cancelled.exception))
+        self.assertFalse(os.path.exists(marker))
+        shutil.rmtree(tmp_dir)
+
+    def test_speculative_download_chosen(self):
+        release = self._batch_update_dict()["dom0"][0].releases[0]
+        with patch.object(self.q, "_fetch_firmware_updates",
+                          return_value="/store/a.cab") as fetch:
+            speculative = self.q._start_speculative_download(release)
+            self.q._finish_speculative_download(speculative, sha="a" * 40)
+        self.assertEqual(speculative[1].result(), "/store/a.cab")
+        self.assertFalse(speculative[2].is_set())
+        fetch.assert_called_once_with(
+            release.url,
+            release.checksum,
+            False,
+            speculative[2],
+            release.size
+        )
+
     @unittest.skipUnless('qubes' in platform.release(), "Requires Qubes OS")
     def test_clean_cache_dom0(self):
         self.q.clean_cache()
@@ -380,6 +651,21 @@ class TestQubesFwupdmgr(unittest.TestCase):
         self.assertNotEqual(get_updates_output.getvalue().strip(), "")
         sys.stdout = self.captured_output
 
+    def test_text_renderer(self):
+        self.assertEqual(
+            strip_description("<p>Fixes:</p><ul><li>a</li><li>b</li></ul>", "\t"),
+            "Fixes:\n\ta\n\tb\n\t"
+        )
+        renderer = TextRenderer()
+        devices = json.loads(GET_DEVICES)
+        tree = renderer.tree(devices, 0, "Dom0 ")
+        self.assertEqual(len(renderer.cache), len(devices["Devices"]))
+        with patch.object(renderer, "_tree_block") as render:
+            self.assertEqual(renderer.tree(devices, 0, "Dom0 "), tree)
+        render.assert_not_called()
+        devices["Devices"][0]["Version"] = "2.0.7"
+        self.assertNotEqual(renderer.tree(devices, 0, "Dom0 "), tree)
+
     def test_help(self):
         help_output = io.StringIO()
         sys.stdout = help_output
@@ -430,10 +716,8 @@ class TestQubesFwupdmgr(unittest.TestCase):
         self.q._get_dom0_devices()
         downgrades = self.q._parse_downgrades(self.q.dom0_devices_info)
         for number, device in enumerate(downgrades):
-            if "Name" not in device:
-                continue
-            if device["Name"] == "ColorHug2":
-                old_version = device["Version"]
+            if device.name == "ColorHug2":
+                old_version = device.version
                 break
         if old_version is None:
             self.fail("Test device not found")
@@ -442,9 +726,9 @@ class TestQubesFwupdmgr(unittest.TestCase):
             self.q.downgrade_firmware()
         self.q._get_dom0_devices()
         downgrades = self.q._parse_downgrades(self.q.dom0_devices_info)
-        new_version = downgrades[number]["Version"]
+        new_version = downgrades[number].version
         self.assertTrue(
-            ver.LooseVersion(old_version) > ver.LooseVersion(new_version)
+            version_key(old_version) > version_key(new_version)
         )
 
     @unittest.skipUnless(
@@ -457,25 +741,21 @@ class TestQubesFwupdmgr(unittest.TestCase):
         self.q._get_dom0_devices()
         dom0_downgrades = self.q._parse_downgrades(self.q.dom0_devices_info)
         self.q._get_usbvm_devices()
-        with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-            downgrades = self.q._parse_downgrades(usbvm_device_info.read())
-            for number, device in enumerate(downgrades):
-                if "Name" not in device:
-                    continue
-                if device["Name"] == "ColorHug2":
-                    old_version = device["Version"]
-                    break
+        downgrades = self.q._parse_downgrades(self.q.usbvm_devices_info)
+        for number, device in enumerate(downgrades):
+            if device.name == "ColorHug2":
+                old_version = device.version
+                break
         if old_version is None:
             self.fail("Test device not found")
         user_input = [str(number+1+len(dom0_downgrades)), '1']
         with patch('builtins.input', side_effect=user_input):
             self.q.downgrade_firmware(usbvm=True, whonix=True)
         self.q._get_usbvm_devices()
-        with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-            downgrades = self.q._parse_downgrades(usbvm_device_info.read())
-        new_version = downgrades[number]["Version"]
+        downgrades = self.q._parse_downgrades(self.q.usbvm_devices_info)
+        new_version = downgrades[number].version
         self.assertTrue(
-            ver.LooseVersion(old_version) > ver.LooseVersion(new_version)
+            version_key(old_version) > version_key(new_version)
         )
         old_version = None
         new_version = None
@@ -483,32 +763,25 @@ class TestQubesFwupdmgr(unittest.TestCase):
         self.q._get_dom0_updates()
         self.q._parse_dom0_updates_info(self.q.dom0_updates_info)
         self.q._get_usbvm_devices()
-        with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-            self.q._parse_usbvm_updates(usbvm_device_info.read())
-            for number, device in enumerate(self.q.usbvm_updates_list):
-                if "Name" not in device:
-                    continue
-                if device["Name"] == "ColorHug2":
-                    old_version = device["Version"]
-                    break
+        self.q._parse_usbvm_updates(self.q.usbvm_devices_info)
+        for number, device in enumerate(self.q.usbvm_updates_list):
+            if device.name == "ColorHug2":
+                old_version = device.version
+                break
         if old_version is None:
             self.fail("Test device not found")
         user_input = [str(number+1+len(self.q.dom0_updates_list)), '1']
         with patch('builtins.input', side_effect=user_input):
             self.q.update_firmware(usbvm=True, whonix=True)
         self.q._get_usbvm_devices()
-        with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-            usbvm_devices_info_dict = json.loads(usbvm_device_info.read())
-        for device in usbvm_devices_info_dict["Devices"]:
-            if "Name" not in device:
-                continue
-            if device["Name"] == "ColorHug2":
-                new_version = device["Version"]
+        for device in parse_devices(self.q.usbvm_devices_info):
+            if device.name == "ColorHug2":
+                new_version = device.version
                 break
         if new_version is None:
             self.fail("Test device not found")
         self.assertTrue(
-            ver.LooseVersion(old_version) < ver.LooseVersion(new_version)
+            version_key(old_version) < version_key(new_version)
         )
 
     @unittest.skipUnless(device_connected_usbvm(), REQUIRED_DEV)
@@ -518,70 +791,66 @@ class TestQubesFwupdmgr(unittest.TestCase):
         self.q._get_dom0_devices()
         dom0_downgrades = self.q._parse_downgrades(self.q.dom0_devices_info)
         self.q._get_usbvm_devices()
-        with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-            downgrades = self.q._parse_downgrades(usbvm_device_info.read())
-            for number, device in enumerate(downgrades):
-                if "Name" not in device:
-                    continue
-                if device["Name"] == "ColorHug2":
-                    old_version = device["Version"]
-                    break
+        downgrades = self.q._parse_downgrades(self.q.usbvm_devices_info)
+        for number, device in enumerate(downgrades):
+            if device.name == "ColorHug2":
+                old_version = device.version
+                break
         if old_version is None:
             self.fail("Test device not found")
         user_input = [str(number+1+len(dom0_downgrades)), '1']
         with patch('builtins.input', side_effect=user_input):
             self.q.downgrade_firmware(usbvm=True)
         self.q._get_usbvm_devices()
-        with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-            downgrades = self.q._parse_downgrades(usbvm_device_info.read())
-        new_version = downgrades[number]["Version"]
+        downgrades = self.q._parse_downgrades(self.q.usbvm_devices_info)
+        new_version = downgrades[number].version
         self.assertTrue(
-            ver.LooseVersion(old_version) > ver.LooseVersion(new_version)
+            version_key(old_version) > version_key(new_version)
         )
 
     def test_parse_downgrades(self):
         downgrades = self.q._parse_downgrades(GET_DEVICES)
         self.assertEqual(
-            downgrades[0]["Name"],
+            downgrades[0].name,
             "ColorHug2"
         )
         self.assertEqual(
-            downgrades[0]["Version"],
+            downgrades[0].version,
             "2.0.6"
         )
         self.assertEqual(
-            downgrades[0]["Releases"][0]["Version"],
+            downgrades[0].releases[0].version,
             "2.0.5"
         )
         self.assertEqual(
-            downgrades[0]["Releases"][0]["Url"],
+            downgrades[0].releases[0].url,
             "https://fwupd.org/downloads/f7dd4ab29fa610438571b8b62b26b0b0e57bb35b-hughski-colorhug2-2.0.5.cab"
         )
         self.assertEqual(
-            downgrades[0]["Releases"][0]["Checksum"],
+            downgrades[0].releases[0].checksum,
             "4ee9dfa38df3b810f739d8a19d13da1b3175fb87"
         )
 
     def test_parse_downgrades_no_version(self):
         downgrades = self.q._parse_downgrades(GET_DEVICES_NO_VERSION)
         self.assertEqual(
-            downgrades[0]["Name"],
+            downgrades[0].name,
             "ColorHug2"
         )
         self.assertEqual(
-            downgrades[0]["Version"],
+            downgrades[0].version,
             "2.0.6"
         )
         self.assertEqual(
-            downgrades[0]["Releases"][0]["Version"],
+            downgrades[0].releases[0].version,
             "2.0.5"
         )
         self.assertEqual(
-            downgrades[0]["Releases"][0]["Url"],
+            downgrades[0].releases[0].url,
             "https://fwupd.org/downloads/f7dd4ab29fa610438571b8b62b26b0b0e57bb35b-hughski-colorhug2-2.0.5.cab"
         )
         self.assertEqual(
-            downgrades[0]["Releases"][0]["Checksum"],
+            downgrades[0].releases[0].checksum,
             "4ee9dfa38df3b810f739d8a19d13da1b3175fb87"
         )
 
@@ -640,10 +909,8 @@ class TestQubesFwupdmgr(unittest.TestCase):
         self.q._get_dom0_updates()
         self.q._parse_dom0_updates_info(self.q.dom0_updates_info)
         for number, device in enumerate(self.q.dom0_updates_list):
-            if "Name" not in device:
-                continue
-            if device["Name"] == "ColorHug2":
-                old_version = device["Version"]
+            if device.name == "ColorHug2":
+                old_version = device.version
                 break
         if old_version is None:
             self.fail("Test device not found")
@@ -651,17 +918,14 @@ class TestQubesFwupdmgr(unittest.TestCase):
         with patch('builtins.input', side_effect=user_input):
             self.q.update_firmware()
         self.q._get_dom0_devices()
-        dom0_devices_info_dict = json.loads(self.q.dom0_devices_info)
-        for device in dom0_devices_info_dict["Devices"]:
-            if "Name" not in device:
-                continue
-            if device["Name"] == "ColorHug2":
-                new_version = device["Version"]
+        for device in parse_devices(self.q.dom0_devices_info):
+            if device.name == "ColorHug2":
+                new_version = device.version
                 break
         if new_version is None:
             self.fail("Test device not found")
         self.assertTrue(
-            ver.LooseVersion(old_version) < ver.LooseVersion(new_version)
+            version_key(old_version) < version_key(new_version)
         )
 
     @unittest.skipUnless(device_connected_usbvm(), REQUIRED_DEV)
@@ -672,54 +936,88 @@ class TestQubesFwupdmgr(unittest.TestCase):
         self.q._get_dom0_updates()
         self.q._parse_dom0_updates_info(self.q.dom0_updates_info)
         self.q._get_usbvm_devices()
-        with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-            self.q._parse_usbvm_updates(usbvm_device_info.read())
-            for number, device in enumerate(self.q.usbvm_updates_list):
-                if "Name" not in device:
-                    continue
-                if device["Name"] == "ColorHug2":
-                    old_version = device["Version"]
-                    break
+        self.q._parse_usbvm_updates(self.q.usbvm_devices_info)
+        for number, device in enumerate(self.q.usbvm_updates_list):
+            if device.name == "ColorHug2":
+                old_version = device.version
+                break
         if old_version is None:
             self.fail("Test device not found")
         user_input = [str(number+1+len(self.q.dom0_updates_list)), '1']
         with patch('builtins.input', side_effect=user_input):
             self.q.update_firmware(usbvm=True)
         self.q._get_usbvm_devices()
-        with open(FWUPD_USBVM_LOG) as usbvm_device_info:
-            usbvm_devices_info_dict = json.loads(usbvm_device_info.read())
-        for device in usbvm_devices_info_dict["Devices"]:
-            if "Name" not in device:
-                continue
-            if device["Name"] == "ColorHug2":
-                new_version = device["Version"]
+        for device in parse_devices(self.q.usbvm_devices_info):
+            if device.name == "ColorHug2":
+                new_version = device.version
                 break
         if new_version is None:
             self.fail("Test device not found")
         self.assertTrue(
-            ver.LooseVersion(old_version) < ver.LooseVersion(new_version)
+            version_key(old_version) < version_key(new_version)
         )
 
     @unittest.skipUnless(check_usbvm(), REQUIRED_USBVM)
     def test_get_usbvm_devices(self):
         self.q.check_fwupd_version(usbvm=True)
         self.q._get_usbvm_devices()
-        self.assertTrue(os.path.exists(FWUPD_USBVM_LOG))
+        self.assertIsInstance(
+            parse_devices(self.q.usbvm_devices_info),
+            list
+        )
+
+    def test_get_usbvm_devices_pipe(self):
+        tmp_dir = tempfile.mkdtemp()
+        log_path = os.path.join(tmp_dir, "usbvm-devices.log")
+        self.q.snapshots = SnapshotCache(
+            tmp_dir,
+            os.path.join(tmp_dir, "firmware.xml.gz")
+        )
+        self.q.fwupdagent_usbvm = qfwupd.FWUPDAGENT_NEW
+        process = MagicMock()
+        process.stdout = io.StringIO(GET_DEVICES)
+        process.wait.return_value = 0
+        with patch('subprocess.Popen', return_value=process) as popen, \
+                patch('src.qubes_fwupdmgr.FWUPD_USBVM_LOG', log_path), \
+                patch.dict(os.environ, {qfwupd.FWUPD_DEBUG_ENV: "1"}):
+            self.q._get_usbvm_devices()
+            self.q._parse_usbvm_updates(self.q.usbvm_devices_info)
+        args, kwargs = popen.call_args
+        self.assertListEqual(
+            args[0],
+            [
+                "qvm-run",
+                "--nogui",
+                "--pass-io",
+                "sys-usb",
+                f"{qfwupd.FWUPDAGENT_NEW} get-devices"
+            ]
+        )
+        self.assertNotIn("shell", kwargs)
+        self.assertEqual(self.q.usbvm_updates_list[0].name, "ColorHug2")
+        with open(log_path) as usbvm_log:
+            self.assertEqual(usbvm_log.read(), GET_DEVICES)
+        self.assertEqual(
+            self.q.snapshots.load("sys-usb", "get-devices"),
+            GET_DEVICES
+        )
+        shutil.rmtree(tmp_dir)
 
     def test_parse_usbvm_updates(self):
         self.q._parse_usbvm_updates(GET_DEVICES)
-        self.assertEqual(self.q.usbvm_updates_list[0]["Name"], "ColorHug2")
-        self.assertEqual(self.q.usbvm_updates_list[0]["Version"], "2.0.6")
+        self.assertEqual(self.q.usbvm_updates_list[0].name, "ColorHug2")
+        self.assertEqual(self.q.usbvm_updates_list[0].version, "2.0.6")
         self.assertListEqual(
-            self.q.usbvm_updates_list[0]["Releases"],
+            self.q.usbvm_updates_list[0].releases,
             [
-                {
-                    'Checksum': '490be5c0b13ca4a3f169bf8bc682ba127b8f7b96',
-                    'Description': '<p>This release fixes prevents the firmware returning an '
-                                   'error when the remote SHA1 hash was never sent.</p>',
-                    'Url': 'https://fwupd.org/downloads/0a29848de74d26348bc5a6e24fc9f03778eddf0e-hughski-colorhug2-2.0.7.cab',
-                    'Version': '2.0.7'
-                }
+                Release(
+                    '2.0.7',
+                    'https://fwupd.org/downloads/0a29848de74d26348bc5a6e24fc9f03778eddf0e-hughski-colorhug2-2.0.7.cab',
+                    '490be5c0b13ca4a3f169bf8bc682ba127b8f7b96',
+                    '<p>This release fixes prevents the firmware returning an '
+                    'error when the remote SHA1 hash was never sent.</p>',
+                    16384
+                )
             ]
         )
 
@@ -727,6 +1025,57 @@ class TestQubesFwupdmgr(unittest.TestCase):
         self.q._parse_usbvm_updates(GET_DEVICES_NO_UPDATES)
         self.assertListEqual(self.q.usbvm_updates_list, [])
 
+    def test_usbvm_list_devices(self):
+        def _list_devices(devices_filter):
+            process = MagicMock()
+            process.stdout = io.StringIO(GET_DEVICES)
+            process.wait.return_value = 0
+            output = io.StringIO()
+            with patch('subprocess.Popen', return_value=process):
+                usbvm.list_devices(
+                    devices_filter,
+                    qfwupd.FWUPDAGENT_NEW,
+                    output
+                )
+            return output.getvalue()
+
+        def _releases(devices):
+            return [(device.name, device.releases) for device in devices]
+
+        usbvm = fwupd_usbvm_validate.FwupdUsbvmUpdates()
+        updates_info = _list_devices("updates")
+        self.assertLess(len(updates_info), len(GET_DEVICES))
+        self.q._parse_usbvm_updates(GET_DEVICES)
+        expected = _releases(self.q.usbvm_updates_list)
+        self.q._parse_usbvm_updates(updates_info)
+        self.assertListEqual(_releases(self.q.usbvm_updates_list), expected)
+        self.assertListEqual(
+            _releases(
+                self.q._parse_downgrades(
+                    _list_devices("downgrades"),
+                    usbvm=True
+                )
+            ),
+            _releases(self.q._parse_downgrades(GET_DEVICES))
+        )
+        with self.assertRaises(Exception):
+            usbvm.list_devices("updates", "/tmp/fwupdagent", io.StringIO())
+
+    def test_parse_usbvm_updates_untrusted(self):
+        for field, value in (
+            ("Name", "ColorHug2\u001b[2J"),
+            ("Uri", "file:///etc/passwd"),
+            ("Checksum", ["490be5c0b13ca4a3f169bf8bc682ba127b8f7b9"]),
+        ):
+            untrusted = json.loads(GET_DEVICES)
+            device = untrusted["Devices"][0]
+            if field == "Name":
+                device[field] = value
+            else:
+                device["Releases"][0][field] = value
+            with self.assertRaises(ValueError):
+                self.q._parse_usbvm_updates(json.dumps(untrusted))
+
     def test_updates_crawler(self):
         crawler_output = io.StringIO()
         sys.stdout = crawler_output
@@ -851,7 +1200,7 @@ class TestQubesFwupdmgr(unittest.TestCase):
     def test_validate_usbvm_archive(self):
         url = "https://fwupd.org/downloads/0a29848de74d26348bc5a6e24fc9f03778eddf0e-hughski-colorhug2-2.0.7.cab"
         sha = "490be5c0b13ca4a3f169bf8bc682ba127b8f7b96"
-        name = url.replace("https://fwupd.org/downloads/", "")
+        name = f"{sha}.cab"
         self.q._clean_usbvm()
         self.q._validate_usbvm_dirs()
         self.q._download_firmware_updates(
@@ -882,8 +1231,8 @@ class TestQubesFwupdmgr(unittest.TestCase):
 
     @unittest.skipUnless('qubes' in platform.release(), "Requires Qubes OS")
     def test_check_usbvm(self):
-        self.q.check_usbvm()
-        self.assertTrue(XL_LIST_LOG in self.q.output)
+        sys_usb = self.q.check_usbvm()
+        self.assertEqual(sys_usb, self.q.usbvm_domid is not None)
 
     @unittest.skipUnless('qubes' in platform.release(), "Requires Qubes OS")
     def test_check_fwupd_version_dom0(self):
@@ -898,7 +1247,7 @@ class TestQubesFwupdmgr(unittest.TestCase):
             stdout=subprocess.PIPE
         )
         client_version = p.communicate()[0].decode().split("\n")[0]
-        if ver.LooseVersion(version_check) > ver.LooseVersion(client_version):
+        if version_key(version_check) > version_key(client_version):
             self.assertEqual(
                 self.q.fwupdagent_usbvm,
                 "/usr/libexec/fwupd/fwupdagent"
@@ -922,7 +1271,7 @@ class TestQubesFwupdmgr(unittest.TestCase):
             stdout=subprocess.PIPE
         )
         client_version = p.communicate()[0].decode().split("\n")[0]
-        if ver.LooseVersion(version_check) > ver.LooseVersion(client_version):
+        if version_key(version_check) > version_key(client_version):
             self.assertEqual(
                 self.q.fwupdagent_usbvm,
                 "/usr/libexec/fwupd/fwupdagent"
@@ -940,15 +1289,1207 @@ class TestQubesFwupdmgr(unittest.TestCase):
             msg="Metadata refresh failed."
         )
 
-    @unittest.skipUnless(check_usbvm(), REQUIRED_USBVM)
-    def test_trusted_cleanup(self):
-        trusted_path = os.path.join(FWUPD_DOM0_UPDATES_DIR, "trusted.cab")
-        if not os.path.exists(trusted_path):
-            Path(trusted_path).touch(mode=0o644, exist_ok=True)
-            os.mkdir(trusted_path.replace(".cab", ""))
-        self.q.trusted_cleanup(usbvm=True)
-        self.assertFalse(os.path.exists(trusted_path))
-        self.assertFalse(os.path.exists(trusted_path.replace(".cab", "")))
+    def test_untrusted_cleanup(self):
+        tmp_dir = tempfile.mkdtemp()
+        untrusted_dir = os.path.join(tmp_dir, "untrusted")
+        leftover_path = os.path.join(untrusted_dir, "a" * 40)
+        running_path = os.path.join(untrusted_dir, "b" * 40)
+        for dir_path in (leftover_path, running_path):
+            os.makedirs(dir_path)
+            Path(os.path.join(dir_path, "fw.cab")).touch()
+        self.q.firmware_store = FirmwareStore(os.path.join(tmp_dir, "store"))
+        with patch('src.qubes_fwupdmgr.FWUPD_DOM0_UNTRUSTED_DIR',
+                   untrusted_dir), \
+                self.q.firmware_store.locked("b" * 40):
+            self.q.untrusted_cleanup()
+        self.assertFalse(os.path.exists(leftover_path))
+        self.assertTrue(os.path.exists(running_path))
+        shutil.rmtree(tmp_dir)
+
+    def test_snapshot_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        metadata_file = os.path.join(tmp_dir, "firmware.xml.gz")
+        Path(metadata_file).touch()
+        cache = SnapshotCache(os.path.join(tmp_dir, "snapshots"), metadata_file)
+        self.assertIsNone(cache.load("dom0", "get-devices"))
+        cache.store("dom0", "get-devices", GET_DEVICES)
+        self.assertEqual(cache.load("dom0", "get-devices"), GET_DEVICES)
+        self.assertIsNone(cache.load("sys-usb", "get-devices"))
+        with open(metadata_file, "w") as metadata:
+            metadata.write("new metadata")
+        self.assertIsNone(cache.load("dom0", "get-devices"))
+        cache.store("dom0", "get-devices", GET_DEVICES)
+        cache.invalidate()
+        self.assertIsNone(cache.load("dom0", "get-devices"))
+        shutil.rmtree(tmp_dir)
+
+    def test_snapshot_cache_ttl(self):
+        tmp_dir = tempfile.mkdtemp()
+        metadata_file = os.path.join(tmp_dir, "firmware.xml.gz")
+        cache = SnapshotCache(
+            os.path.join(tmp_dir, "snapshots"),
+            metadata_file,
+            ttl=0
+        )
+        cache.store("dom0", "get-updates", UPDATE_INFO)
+        self.assertIsNone(cache.load("dom0", "get-updates"))
+        disabled_cache = SnapshotCache(
+            os.path.join(tmp_dir, "disabled"),
+            metadata_file,
+            enabled=False
+        )
+        disabled_cache.store("dom0", "get-updates", UPDATE_INFO)
+        self.assertFalse(os.path.exists(os.path.join(tmp_dir, "disabled")))
+        shutil.rmtree(tmp_dir)
+
+    def test_get_dom0_devices_cached(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.q.snapshots = SnapshotCache(
+            tmp_dir,
+            os.path.join(tmp_dir, "firmware.xml.gz")
+        )
+        self.q.snapshots.store("dom0", "get-devices", GET_DEVICES)
+        with patch('subprocess.Popen') as popen:
+            self.q._get_dom0_devices()
+        popen.assert_not_called()
+        with self.q.dom0_devices_info as devices_info:
+            self.assertEqual(devices_info.read(), GET_DEVICES)
+        shutil.rmtree(tmp_dir)
+
+    def test_facts_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        facts_path = os.path.join(tmp_dir, "facts.json")
+        gather = MagicMock(return_value={"Agent": "/bin/fwupdagent"})
+        facts = FactsCache(facts_path)
+        self.assertEqual(facts.get("fact", "1", gather)["Agent"],
+                         "/bin/fwupdagent")
+        self.assertEqual(
+            FactsCache(facts_path).get("fact", "1", gather),
+            gather.return_value
+        )
+        self.assertEqual(gather.call_count, 1)
+        FactsCache(facts_path).get("fact", "2", gather)
+        self.assertEqual(gather.call_count, 2)
+        FactsCache(facts_path, ttl=0).get("fact", "2", gather)
+        self.assertEqual(gather.call_count, 3)
+        FactsCache(facts_path, enabled=False).get("fact", "2", gather)
+        self.assertEqual(gather.call_count, 4)
+        facts.invalidate()
+        self.assertFalse(os.path.exists(facts_path))
+        shutil.rmtree(tmp_dir)
+
+    def test_check_fwupd_version_cached(self):
+        def _popen(cmd, **kwargs):
+            process = MagicMock()
+            process.returncode = 0
+            if cmd[:2] == ["xl", "domid"]:
+                output = f"{domid}\n"
+            elif cmd[0] == "qvm-run":
+                output = "client version:\t1.3.7\n"
+            else:
+                output = "client version:\t1.5.2\n"
+            process.communicate.return_value = (output.encode(), None)
+            commands.append(cmd[0])
+            return process
+
+        tmp_dir = tempfile.mkdtemp()
+        facts_path = os.path.join(tmp_dir, "facts.json")
+        commands = []
+        domid = 7
+        for __ in range(2):
+            q = qfwupd.QubesFwupdmgr()
+            q.facts = FactsCache(facts_path)
+            with patch('subprocess.Popen', side_effect=_popen):
+                self.assertTrue(q.check_usbvm())
+                q.check_fwupd_version(usbvm=True)
+            self.assertEqual(q.fwupdagent_dom0, qfwupd.FWUPDAGENT_NEW)
+            self.assertEqual(q.fwupdagent_usbvm, qfwupd.FWUPDAGENT_OLD)
+        self.assertEqual(commands.count("qvm-run"), 1)
+        domid = 8
+        with patch('subprocess.Popen', side_effect=_popen):
+            q.check_usbvm()
+            q.check_fwupd_version(usbvm=True)
+        self.assertEqual(commands.count("qvm-run"), 2)
+        shutil.rmtree(tmp_dir)
+
+    def test_command_facts(self):
+        for argv, facts in (
+            (["qubes-fwupdmgr"], ()),
+            (["qubes-fwupdmgr", "--help"], ()),
+            (["qubes-fwupdmgr", "clean"], ("usbvm",)),
+            (["qubes-fwupdmgr", "get-devices"], ("dom0-agent",)),
+            (
+                ["qubes-fwupdmgr", "get-devices", "--usbvm"],
+                ("dom0-agent", "usbvm-agent")
+            ),
+        ):
+            with patch.object(sys, "argv", argv):
+                self.assertEqual(qfwupd._command_facts(), facts)
+
+    def test_prepare_lazy(self):
+        with patch('subprocess.Popen') as popen:
+            self.assertFalse(self.q.prepare(()))
+        popen.assert_not_called()
+        with patch.object(self.q, "_check_dom0_agent") as dom0_agent, \
+                patch.object(self.q, "check_usbvm") as check_usbvm:
+            self.assertFalse(self.q.prepare(("dom0-agent",)))
+        dom0_agent.assert_called_once()
+        check_usbvm.assert_not_called()
+        with patch.object(self.q, "_check_dom0_agent"), \
+                patch.object(self.q, "_check_usbvm_agent") as usbvm_agent, \
+                patch.object(self.q, "_prepare_usbvm_side") as usbvm_side, \
+                patch.object(self.q, "check_usbvm", return_value=True):
+            facts = qfwupd.COMMAND_FACTS["update"]
+            self.assertTrue(self.q.prepare(facts))
+        usbvm_agent.assert_called_once()
+        usbvm_side.assert_called_once_with(facts, True)
+
+    def test_iter_devices_stream(self):
+        class _Stream(io.StringIO):
+            def read(self, size=-1):
+                data = super().read(size)
+                reads.append(len(data))
+                return data
+
+        reads = []
+        devices = iter_devices(_Stream(GET_DEVICES))
+        device = next(devices)
+        self.assertEqual(device.name, "ColorHug2")
+        self.assertEqual(device.releases[0].version, "2.0.7")
+        self.assertNotIn(0, reads)
+        self.assertListEqual(
+            [device.name for device in devices],
+            [device.name for device in parse_devices(GET_DEVICES)[1:]]
+        )
+        self.assertEqual(reads[-1], 0)
+        with self.assertRaises(ValueError):
+            parse_devices(GET_DEVICES[:-10])
+
+    def test_get_updates_qubes_stream(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.q.snapshots = SnapshotCache(
+            tmp_dir,
+            os.path.join(tmp_dir, "firmware.xml.gz")
+        )
+        process = MagicMock()
+        process.stdout = io.StringIO(UPDATE_INFO)
+        process.wait.return_value = 0
+        self.q.fwupdagent_dom0 = qfwupd.FWUPDAGENT_NEW
+        with patch('subprocess.Popen', return_value=process):
+            ret = self.q.get_updates_qubes()
+        self.assertEqual(ret, qfwupd.EXIT_CODES["SUCCESS"])
+        self.assertIn("1. Device: ColorHug2", self.captured_output.getvalue())
+        self.assertEqual(
+            self.q.snapshots.load("dom0", "get-updates"),
+            UPDATE_INFO
+        )
+        self.q.snapshots.invalidate()
+        process.stdout = io.StringIO(UPDATE_INFO)
+        process.wait.return_value = 1
+        with patch('subprocess.Popen', return_value=process), \
+                patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            with self.assertRaises(Exception) as failed:
+                self.q.get_updates_qubes()
+        self.assertIn("dom0", str(failed.exception))
+        self.assertIn("Getting available updates failed", stderr.getvalue())
+        self.assertIsNone(self.q.snapshots.load("dom0", "get-updates"))
+        shutil.rmtree(tmp_dir)
+
+    def _write_metadata(self, metadata_file, releases):
+        """Writes LVFS metadata with the ColorHug2 releases and a component
+        of another device.
+
+        Keyword arguments:
+        metadata_file -- absolute path to the firmware.xml.gz file
+        releases -- list of the ColorHug2 versions
+        """
+        release_xml = "".join(
+            f'<release version="{version}">'
+            f"<location>https://fwupd.org/downloads/{version}.cab</location>"
+            '<checksum type="sha1" target="container">'
+            f"{hashlib.sha1(version.encode()).hexdigest()}</checksum>"
+            '<size type="download">1024</size>'
+            f"<description><p>Release {version}</p></description>"
+            "</release>" for version in releases
+        )
+        with gzip.open(metadata_file, "wt") as metadata:
+            metadata.write(
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<components origin="lvfs" version="0.9">'
+                '<component type="firmware">'
+                "<id>com.hughski.ColorHug2.firmware</id>"
+                "<name>ColorHug2</name><provides>"
+                '<firmware type="flashed">'
+                "2082B5E0-7A64-478A-B1B2-E3404FAB6DAD</firmware>"
+                f"</provides><releases>{release_xml}</releases></component>"
+                '<component type="firmware"><id>org.example.Dock</id>'
+                '<provides><firmware type="flashed">'
+                "0f0f0f0f-0000-0000-0000-000000000000</firmware></provides>"
+                '<releases><release version="1.2">'
+                "<location>https://fwupd.org/downloads/dock.cab</location>"
+                '<checksum type="sha1" target="container">'
+                f"{'d' * 40}</checksum></release></releases></component>"
+                "</components>"
+            )
+
+    def test_metadata_index(self):
+        tmp_dir = tempfile.mkdtemp()
+        metadata_file = os.path.join(tmp_dir, "firmware.xml.gz")
+        index_path = os.path.join(tmp_dir, "index.sqlite")
+        index = MetadataIndex(index_path)
+        self._write_metadata(metadata_file, ["2.0.7", "2.0.5"])
+        self.assertTrue(index.update(metadata_file))
+        self.assertFalse(index.update(metadata_file))
+        releases = index.releases(["2082b5e0-7a64-478a-b1b2-e3404fab6dad"])
+        self.assertListEqual(
+            sorted(release["Version"] for release in releases),
+            ["2.0.5", "2.0.7"]
+        )
+        release = next(r for r in releases if r["Version"] == "2.0.7")
+        self.assertEqual(
+            release["Uri"],
+            "https://fwupd.org/downloads/2.0.7.cab"
+        )
+        self.assertEqual(
+            release["Checksum"],
+            [hashlib.sha1(b"2.0.7").hexdigest()]
+        )
+        self.assertEqual(release["Size"], 1024)
+        self.assertEqual(release["Description"], "<p>Release 2.0.7</p>")
+        db = sqlite3.connect(index_path)
+        dock_rowid = db.execute(
+            "SELECT rowid FROM releases WHERE version = '1.2'"
+        ).fetchone()
+        self._write_metadata(metadata_file, ["2.0.8"])
+        self.assertTrue(index.update(metadata_file))
+        self.assertEqual(
+            db.execute(
+                "SELECT rowid FROM releases WHERE version = '1.2'"
+            ).fetchone(),
+            dock_rowid
+        )
+        db.close()
+        self.assertListEqual(
+            [
+                r["Version"] for r in
+                index.releases(["2082B5E0-7A64-478A-B1B2-E3404FAB6DAD"])
+            ],
+            ["2.0.8"]
+        )
+        self.assertListEqual(index.releases(["unknown"]), [])
+        shutil.rmtree(tmp_dir)
+
+    def test_get_dom0_updates_offline(self):
+        tmp_dir = tempfile.mkdtemp()
+        metadata_file = os.path.join(tmp_dir, "firmware.xml.gz")
+        self._write_metadata(metadata_file, ["2.0.7", "2.0.5"])
+        self.q.snapshots = SnapshotCache(
+            os.path.join(tmp_dir, "snapshots"),
+            metadata_file
+        )
+        self.q.snapshots.store("dom0", "get-devices", GET_DEVICES)
+        self.q.snapshots.invalidate(commands=("get-updates",))
+        self._write_metadata(metadata_file, ["2.0.8", "2.0.7", "2.0.5"])
+        self.q.metadata_index = MetadataIndex(
+            os.path.join(tmp_dir, "index.sqlite")
+        )
+        self.q.offline = True
+        with patch('src.qubes_fwupdmgr.FWUPD_DOM0_METADATA_FILE',
+                   metadata_file), \
+                patch('subprocess.Popen') as popen:
+            self.q._get_dom0_updates()
+        popen.assert_not_called()
+        self.q._parse_dom0_updates_info(self.q.dom0_updates_info)
+        self.assertEqual(len(self.q.dom0_updates_list), 1)
+        self.assertEqual(self.q.dom0_updates_list[0].name, "ColorHug2")
+        self.assertListEqual(
+            [r.version for r in self.q.dom0_updates_list[0].releases],
+            ["2.0.8", "2.0.7"]
+        )
+        shutil.rmtree(tmp_dir)
+
+    def test_get_dom0_updates_offline_expired(self):
+        tmp_dir = tempfile.mkdtemp()
+        metadata_file = os.path.join(tmp_dir, "firmware.xml.gz")
+        self._write_metadata(metadata_file, ["2.0.8", "2.0.7", "2.0.5"])
+        self.q.snapshots = SnapshotCache(
+            os.path.join(tmp_dir, "snapshots"),
+            metadata_file,
+            enabled=False
+        )
+        self.q.metadata_index = MetadataIndex(
+            os.path.join(tmp_dir, "index.sqlite")
+        )
+        self.q.offline = True
+        with patch('src.qubes_fwupdmgr.FWUPD_DOM0_METADATA_FILE',
+                   metadata_file), \
+                patch('subprocess.Popen') as popen:
+            with self.assertRaises(Exception) as cm:
+                self.q._get_dom0_updates()
+            self.assertIn("get-devices", str(cm.exception))
+            self.q.snapshots.store(
+                "dom0",
+                "get-devices",
+                GET_DEVICES,
+                always=True
+            )
+            with patch('time.time', return_value=time.time() + 3600):
+                self.q._get_dom0_updates()
+        popen.assert_not_called()
+        self.q._parse_dom0_updates_info(self.q.dom0_updates_info)
+        self.assertListEqual(
+            [r.version for r in self.q.dom0_updates_list[0].releases],
+            ["2.0.8", "2.0.7"]
+        )
+        shutil.rmtree(tmp_dir)
+
+    def test_query_domains_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        errors = self.q._query_domains(
+            {
+                "dom0": barrier.wait,
+                "sys-usb": barrier.wait
+            }
+        )
+        self.assertDictEqual(errors, {})
+
+    def test_get_updates_qubes_domain_error(self):
+        def _usbvm_failed():
+            raise Exception("qvm-run failed")
+
+        def _dom0_updates():
+            self.q.dom0_updates_info = UPDATE_INFO
+
+        get_updates_output = io.StringIO()
+        sys.stdout = get_updates_output
+        with patch.object(self.q, "_get_dom0_updates", _dom0_updates), \
+                patch.object(self.q, "_get_usbvm_updates", _usbvm_failed), \
+                patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            with self.assertRaises(Exception) as failed:
+                self.q.get_updates_qubes(usbvm=True)
+        sys.stdout = self.captured_output
+        self.assertIn("sys-usb", str(failed.exception))
+        self.assertNotIn("dom0", str(failed.exception))
+        self.assertIn("sys-usb: qvm-run failed", stderr.getvalue())
+        self.assertIn("1. Device: ColorHug2", get_updates_output.getvalue())
+
+    def test_get_updates_qubes_json(self):
+        def _dom0_updates():
+            self.q.dom0_updates_info = UPDATE_INFO
+
+        self.q.json_output = JsonOutput("get-updates")
+        with patch.object(self.q, "_get_dom0_updates", _dom0_updates):
+            ret = self.q.get_updates_qubes()
+        self.assertEqual(ret, qfwupd.EXIT_CODES["SUCCESS"])
+        self.assertNotIn("Device:", self.captured_output.getvalue())
+        records = self.q.json_output.records
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["VM"], "dom0")
+        self.assertEqual(records[0]["Name"], "ColorHug2")
+        self.assertEqual(records[0]["Releases"][0]["Version"], "2.0.7")
+
+    def test_json_output_run(self):
+        def _command(output):
+            print("progress")
+            output.add({"Name": "ColorHug2"})
+            raise Exception("Firmware update failed")
+
+        output = JsonOutput("update")
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            ret = output.run(_command, output)
+        self.assertEqual(ret, qfwupd.EXIT_CODES["ERROR"])
+        self.assertEqual(stderr.getvalue(), "progress\n")
+        document = json.loads(self.captured_output.getvalue())
+        self.assertDictEqual(
+            document,
+            {
+                "Command": "update",
+                "Error": "Firmware update failed",
+                "ExitCode": 1,
+                "Records": [{"Name": "ColorHug2"}],
+            }
+        )
+        output = JsonOutput("update", OUTPUT_NDJSON)
+        output.add({"Name": "ColorHug2"})
+        self.assertEqual(
+            output.dumps(qfwupd.EXIT_CODES["NO_UPDATES"]),
+            '{"Name": "ColorHug2"}\n{"Command": "update", "ExitCode": 99}\n'
+        )
+
+    def _start_usbvm_server(self):
+        """Connects the dom0 client with the server running in a thread."""
+        request_r, request_w = os.pipe()
+        response_r, response_w = os.pipe()
+        server = threading.Thread(
+            target=fwupd_usbvm_validate.FwupdUsbvmUpdates().serve,
+            args=(os.fdopen(request_r, "rb"), os.fdopen(response_w, "wb"))
+        )
+        server.start()
+
+        class _Session:
+            stdin = os.fdopen(request_w, "wb")
+            stdout = os.fdopen(response_r, "rb")
+
+            def wait(self):
+                server.join()
+
+            def kill(self):
+                pass
+
+        self.q.usbvm_session = _Session()
+        return server
+
+    def test_usbvm_session(self):
+        tmp_dir = tempfile.mkdtemp()
+        usbvm_updates_dir = os.path.join(tmp_dir, "usbvm")
+        os.mkdir(usbvm_updates_dir)
+        arch_name = "0a29848de74d26348bc5a6e24fc9f03778eddf0e.cab"
+        with open(os.path.join(tmp_dir, arch_name), "wb") as archive:
+            archive.write(b"MSCF" * 100000)
+        server = self._start_usbvm_server()
+        with patch(
+            'fwupd_usbvm_validate.FWUPD_USBVM_UPDATES_DIR',
+            usbvm_updates_dir
+        ), patch('src.qubes_fwupdmgr.FWUPD_DOM0_STORE_DIR', tmp_dir):
+            self.q._copy_firmware_updates(arch_name)
+            with self.assertRaises(Exception) as unknown:
+                self.q._usbvm_request(["reboot"], "Request failed.")
+            self.assertIn("Unknown command: reboot", str(unknown.exception))
+            self.q._copy_firmware_updates(arch_name)
+            self.q.close_usbvm_session()
+        server.join()
+        with open(os.path.join(usbvm_updates_dir, arch_name), "rb") as copy:
+            self.assertEqual(copy.read(), b"MSCF" * 100000)
+        self.assertIsNone(self.q.usbvm_session)
+        shutil.rmtree(tmp_dir)
+
+    def test_usbvm_serve_quit_closed(self):
+        class _ClosedPipe(io.BytesIO):
+            def flush(self):
+                raise BrokenPipeError()
+
+        fwupd_usbvm_validate.FwupdUsbvmUpdates().serve(
+            io.BytesIO(b"quit 0\n"),
+            _ClosedPipe()
+        )
+
+    def test_usbvm_session_unexpected_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(tmp_dir, "firmware.bin"), "wb") as archive:
+            archive.write(b"firmware")
+        self._start_usbvm_server()
+        with patch('src.qubes_fwupdmgr.FWUPD_DOM0_STORE_DIR', tmp_dir):
+            with self.assertRaises(Exception) as unexpected:
+                self.q._copy_firmware_updates("firmware.bin")
+            self.assertIn(
+                "Unexpected file: updates firmware.bin",
+                str(unexpected.exception)
+            )
+            self.q.close_usbvm_session()
+        shutil.rmtree(tmp_dir)
+
+    def test_handle_fw_update_rejected(self):
+        tmp_dir = tempfile.mkdtemp()
+        untrusted_dir = os.path.join(tmp_dir, "untrusted")
+        sha = hashlib.sha1(b"firmware").hexdigest()
+        copy = MagicMock()
+        copy.stdout = io.BytesIO(b"tampered")
+        copy.returncode = 0
+        receive = FwupdReceiveUpdates()
+        receive.old_umask = os.umask(0o022)
+        os.umask(receive.old_umask)
+
+        def _create_dirs(*paths):
+            for dir_path in paths:
+                os.makedirs(dir_path, exist_ok=True)
+
+        with patch('fwupd_receive_updates.FWUPD_DOM0_UNTRUSTED_DIR',
+                   untrusted_dir), \
+                patch.object(receive, "_check_domain"), \
+                patch.object(receive, "_create_dirs",
+                             side_effect=_create_dirs), \
+                patch('subprocess.Popen', return_value=copy):
+            with self.assertRaises(ValueError):
+                receive.handle_fw_update("sys-firewall", sha, "fw.cab")
+        self.assertFalse(os.path.exists(os.path.join(untrusted_dir, sha)))
+        shutil.rmtree(tmp_dir)
+
+    def test_receive_firmware(self):
+        tmp_dir = tempfile.mkdtemp()
+        file_path = os.path.join(tmp_dir, "firmware.cab")
+        content = b"MSCF" * 100000
+        sha1 = hashlib.sha1(content).hexdigest()
+        sha256 = hashlib.sha256(content).hexdigest()
+        receive = FwupdReceiveUpdates()
+        receive._receive_firmware(io.BytesIO(content), file_path, sha1)
+        with open(file_path, "rb") as received:
+            self.assertEqual(received.read(), content)
+        receive._receive_firmware(
+            io.BytesIO(content),
+            file_path,
+            sha256,
+            len(content)
+        )
+        stream = io.BytesIO(content)
+        with self.assertRaises(ValueError) as oversized:
+            receive._receive_firmware(stream, file_path, sha1, 1000)
+        self.assertIn("exceeds limit", str(oversized.exception))
+        self.assertLess(stream.tell(), len(content))
+        with self.assertRaises(ValueError) as truncated:
+            receive._receive_firmware(
+                io.BytesIO(content[:-1]),
+                file_path,
+                sha1,
+                len(content)
+            )
+        self.assertIn("expected", str(truncated.exception))
+        with self.assertRaises(ValueError) as tampered:
+            receive._receive_firmware(
+                io.BytesIO(content[:-1] + b"X"),
+                file_path,
+                sha1
+            )
+        self.assertIn("did NOT match", str(tampered.exception))
+        shutil.rmtree(tmp_dir)
+
+    def test_check_domain_not_cached(self):
+        with patch('subprocess.check_output') as check_output:
+            check_output.return_value = b"sys-firewall\n"
+            FwupdReceiveUpdates()._check_domain("sys-firewall")
+            FwupdReceiveUpdates()._check_domain("sys-firewall")
+            self.assertEqual(check_output.call_count, 2)
+            check_output.return_value = b"sys-net\n"
+            with self.assertRaises(SystemExit):
+                FwupdReceiveUpdates()._check_domain("sys-firewall")
+            self.assertEqual(check_output.call_count, 3)
+
+    def test_usbvm_receive_file_digests(self):
+        tmp_dir = tempfile.mkdtemp()
+        arch_name = "0a29848de74d26348bc5a6e24fc9f03778eddf0e.cab"
+        arch_path = os.path.join(tmp_dir, arch_name)
+        content = b"MSCF" * 100000
+        usbvm = fwupd_usbvm_validate.FwupdUsbvmUpdates()
+        with patch('fwupd_usbvm_validate.FWUPD_USBVM_UPDATES_DIR', tmp_dir):
+            usbvm._receive_file(
+                io.BytesIO(content),
+                "updates",
+                arch_name,
+                len(content)
+            )
+        self.assertDictEqual(
+            usbvm.received_digests[arch_path],
+            {
+                "sha1": hashlib.sha1(content).hexdigest(),
+                "sha256": hashlib.sha256(content).hexdigest(),
+            }
+        )
+        with patch.object(usbvm, "_check_shasum") as check_shasum:
+            with self.assertRaises(ValueError):
+                usbvm.validate_updates(arch_path, "0" * 40)
+        check_shasum.assert_not_called()
+        self.assertNotIn(arch_path, usbvm.received_digests)
+        shutil.rmtree(tmp_dir)
+
+    def _metadata_bundle(self, files):
+        """Builds metadata bundle in the updateVM format."""
+        bundle = b""
+        for name, content in files:
+            digest = hashlib.sha256(content).hexdigest()
+            bundle += f"file {name} {digest} {len(content)}\n".encode()
+            bundle += content
+        return io.BytesIO(bundle + b"end 0\n")
+
+    def test_receive_metadata_bundle(self):
+        tmp_dir = tempfile.mkdtemp()
+        files = [
+            ("firmware.xml.gz", b"metadata" * 1000),
+            ("firmware.xml.gz.asc", b"signature"),
+            ("firmware.xml.gz.jcat", b"jcat"),
+        ]
+        FwupdReceiveUpdates()._receive_metadata_bundle(
+            self._metadata_bundle(files),
+            tmp_dir,
+            "sys-firewall"
+        )
+        for name, content in files:
+            with open(os.path.join(tmp_dir, name), "rb") as received:
+                self.assertEqual(received.read(), content)
+        shutil.rmtree(tmp_dir)
+
+    def test_receive_metadata_bundle_invalid(self):
+        tmp_dir = tempfile.mkdtemp()
+        receive = FwupdReceiveUpdates()
+        with self.assertRaises(Exception) as unexpected:
+            receive._receive_metadata_bundle(
+                self._metadata_bundle([("firmware.bin", b"bin")]),
+                tmp_dir,
+                "sys-firewall"
+            )
+        self.assertIn("sent unexpected file", str(unexpected.exception))
+        with self.assertRaises(Exception) as incomplete:
+            receive._receive_metadata_bundle(
+                self._metadata_bundle([("firmware.xml.gz", b"metadata")]),
+                tmp_dir,
+                "sys-firewall"
+            )
+        self.assertIn("sent incomplete bundle", str(incomplete.exception))
+        bundle = self._metadata_bundle([("firmware.xml.gz", b"metadata")])
+        bundle = io.BytesIO(bundle.getvalue().replace(b"metadata", b"tampered"))
+        with self.assertRaises(ValueError):
+            receive._receive_metadata_bundle(bundle, tmp_dir, "sys-firewall")
+        shutil.rmtree(tmp_dir)
+
+    def _start_lvfs_stand_in(self, files):
+        """Starts HTTP server serving the files on a local port."""
+        LvfsStandInHandler.files = files
+        LvfsStandInHandler.connections = []
+        LvfsStandInHandler.requests = []
+        server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0),
+            LvfsStandInHandler
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_address[1]}/downloads/"
+
+    def test_download_metadata_keep_alive(self):
+        tmp_dir = tempfile.mkdtemp()
+        files = {
+            "firmware.xml.gz": b"metadata" * 100000,
+            "firmware.xml.gz.jcat": b"jcat",
+            "firmware.xml.gz.asc": b"signature",
+        }
+        url = self._start_lvfs_stand_in(files)
+        downloader = MetadataDownloader(base_url=url, output_dir=tmp_dir)
+        with patch.object(downloader, "_gpg_verification") as gpg:
+            downloader.download()
+        gpg.assert_called_once_with(
+            os.path.join(tmp_dir, "firmware.xml.gz.part"),
+            os.path.join(tmp_dir, "firmware.xml.gz.asc.part")
+        )
+        for name, content in files.items():
+            with open(os.path.join(tmp_dir, name), "rb") as downloaded:
+                self.assertEqual(downloaded.read(), content)
+        self.assertLessEqual(len(LvfsStandInHandler.connections), 2)
+        self.assertListEqual(
+            sorted(os.listdir(tmp_dir)),
+            sorted(list(files) + ["validators.json"])
+        )
+        shutil.rmtree(tmp_dir)
+
+    def test_download_metadata_proxy(self):
+        tmp_dir = tempfile.mkdtemp()
+        files = {
+            "firmware.xml.gz": b"metadata",
+            "firmware.xml.gz.jcat": b"jcat",
+            "firmware.xml.gz.asc": b"signature",
+        }
+        proxy_url = self._start_lvfs_stand_in(files).replace(
+            "http://",
+            "http://user:secret@"
+        )
+        environ = {
+            key: value for key, value in os.environ.items()
+            if key.lower() not in ("http_proxy", "https_proxy", "no_proxy")
+        }
+        environ["http_proxy"] = proxy_url
+        with patch.dict(os.environ, environ, clear=True):
+            downloader = MetadataDownloader(
+                base_url="http://lvfs.invalid/downloads/",
+                output_dir=tmp_dir
+            )
+        with patch.object(downloader, "_gpg_verification"):
+            self.assertTrue(downloader.download())
+        token = base64.b64encode(b"user:secret").decode("ascii")
+        self.assertListEqual(
+            sorted(LvfsStandInHandler.requests),
+            sorted(
+                (f"http://lvfs.invalid/downloads/{name}", f"Basic {token}")
+                for name in files
+            )
+        )
+        shutil.rmtree(tmp_dir)
+
+    def test_download_metadata_unchanged(self):
+        tmp_dir = tempfile.mkdtemp()
+        files = {
+            "firmware.xml.gz": b"metadata",
+            "firmware.xml.gz.jcat": b"jcat",
+            "firmware.xml.gz.asc": b"signature",
+        }
+        url = self._start_lvfs_stand_in(files)
+        downloader = MetadataDownloader(base_url=url, output_dir=tmp_dir)
+        with patch.object(downloader, "_gpg_verification") as gpg:
+            self.assertTrue(downloader.download())
+            self.assertFalse(downloader.check())
+            self.assertFalse(downloader.download())
+            files["firmware.xml.gz"] = b"new metadata"
+            files["firmware.xml.gz.asc"] = b"new signature"
+            self.assertTrue(downloader.check())
+            self.assertTrue(downloader.download())
+        self.assertEqual(gpg.call_count, 2)
+        gpg.assert_called_with(
+            os.path.join(tmp_dir, "firmware.xml.gz.part"),
+            os.path.join(tmp_dir, "firmware.xml.gz.asc.part")
+        )
+        for name, content in files.items():
+            with open(os.path.join(tmp_dir, name), "rb") as downloaded:
+                self.assertEqual(downloaded.read(), content)
+        shutil.rmtree(tmp_dir)
+
+    @patch('src.qubes_fwupdmgr.subprocess.Popen')
+    def test_refresh_metadata_unchanged(self, mock_popen):
+        mock_popen.return_value.returncode = (
+            qfwupd.EXIT_CODES["METADATA_UNCHANGED"]
+        )
+        tmp_dir = tempfile.mkdtemp()
+        metadata_file = os.path.join(tmp_dir, "firmware.xml.gz")
+        Path(metadata_file).touch()
+        loaded_file = os.path.join(tmp_dir, "firmware.xml.gz.loaded")
+        with open(loaded_file, "w") as loaded:
+            loaded.write(hashlib.sha256(b"").hexdigest())
+        self.q.facts = FactsCache(os.path.join(tmp_dir, "facts.json"))
+        refreshed = []
+        with patch('src.qubes_fwupdmgr.FWUPD_DOM0_METADATA_FILE',
+                   metadata_file), \
+                patch('src.qubes_fwupdmgr.FWUPD_DOM0_METADATA_LOADED',
+                      loaded_file), \
+                patch.object(self.q.snapshots, "invalidate") as invalidate, \
+                patch.multiple(
+                    self.q,
+                    _validate_usbvm_dirs=DEFAULT,
+                    _copy_usbvm_metadata=DEFAULT,
+                    _validate_usbvm_metadata=DEFAULT
+                ), \
+                patch.object(self.q, "_refresh_usbvm_metadata",
+                             side_effect=lambda: refreshed.append(
+                                 self.q.usbvm_domid
+                             )):
+            for domid in (7, 7, 8):
+                self.q.usbvm_domid = domid
+                self.q.refresh_metadata(usbvm=True)
+            self.q.refresh_metadata()
+        self.assertEqual(self.q.output, "Metadata unchanged\n")
+        self.assertEqual(mock_popen.call_count, 4)
+        self.assertListEqual(refreshed, [7, 8])
+        invalidate.assert_not_called()
+        shutil.rmtree(tmp_dir)
+
+    def test_refresh_metadata_failed_reload(self):
+        tmp_dir = tempfile.mkdtemp()
+        metadata_file = os.path.join(tmp_dir, "firmware.xml.gz")
+        with open(metadata_file, "wb") as metadata:
+            metadata.write(b"new metadata")
+        loaded_file = os.path.join(tmp_dir, "firmware.xml.gz.loaded")
+        refresh = MagicMock()
+        refresh.returncode = 1
+        refresh.communicate.return_value = (b"Refresh failed\n", None)
+        with patch('src.qubes_fwupdmgr.FWUPD_DOM0_METADATA_FILE',
+                   metadata_file), \
+                patch('src.qubes_fwupdmgr.FWUPD_DOM0_METADATA_LOADED',
+                      loaded_file), \
+                patch.object(self.q, "_download_metadata",
+                             side_effect=[True, False, False, False]), \
+                patch.object(self.q, "_update_metadata_index"), \
+                patch('subprocess.Popen', return_value=refresh) as popen:
+            with self.assertRaises(Exception):
+                self.q.refresh_metadata()
+            refresh.returncode = 0
+            refresh.communicate.return_value = (
+                b"Successfully refreshed metadata manually\n",
+                None
+            )
+            self.assertEqual(
+                self.q.refresh_metadata(),
+                qfwupd.EXIT_CODES["SUCCESS"]
+            )
+            self.assertEqual(
+                self.q.refresh_metadata(),
+                qfwupd.EXIT_CODES["METADATA_UNCHANGED"]
+            )
+            self.assertEqual(
+                self.q.refresh_metadata(force=True),
+                qfwupd.EXIT_CODES["SUCCESS"]
+            )
+        self.assertEqual(popen.call_count, 3)
+        with open(loaded_file) as loaded:
+            self.assertEqual(
+                loaded.read(),
+                hashlib.sha256(b"new metadata").hexdigest()
+            )
+        shutil.rmtree(tmp_dir)
+
+    def test_download_metadata_failed(self):
+        tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(tmp_dir, "firmware.xml.gz"), "wb") as old:
+            old.write(b"old metadata")
+        url = self._start_lvfs_stand_in({"firmware.xml.gz": b"metadata"})
+        downloader = MetadataDownloader(base_url=url, output_dir=tmp_dir)
+        with self.assertRaises(Exception) as failed:
+            downloader.download()
+        self.assertIn("404", str(failed.exception))
+        with open(os.path.join(tmp_dir, "firmware.xml.gz"), "rb") as old:
+            self.assertEqual(old.read(), b"old metadata")
+        self.assertListEqual(os.listdir(tmp_dir), ["firmware.xml.gz"])
+        shutil.rmtree(tmp_dir)
+
+    def _store_entry(self, tmp_dir, name, size):
+        """Creates archive and extracted directory to be stored."""
+        archive_path = os.path.join(tmp_dir, f"{name}.cab")
+        extracted_path = os.path.join(tmp_dir, name)
+        with open(archive_path, "wb") as archive:
+            archive.write(b"M" * size)
+        os.mkdir(extracted_path)
+        with open(os.path.join(extracted_path, "firmware.bin"), "wb") as f:
+            f.write(b"F" * size)
+        return archive_path, extracted_path
+
+    def test_firmware_store(self):
+        tmp_dir = tempfile.mkdtemp()
+        store_dir = os.path.join(tmp_dir, "store")
+        store = FirmwareStore(store_dir, budget=5000)
+        first, second, third = "a" * 40, "b" * 40, "c" * 64
+        self.assertIsNone(store.lookup(first))
+        stored = store.add(first, *self._store_entry(tmp_dir, "x", 1000))
+        self.assertEqual(stored, os.path.join(store_dir, f"{first}.cab"))
+        self.assertTrue(os.path.isdir(os.path.join(store_dir, first)))
+        store.add(second, *self._store_entry(tmp_dir, "y", 1000))
+        self.assertEqual(store.lookup(first), stored)
+        store.add(third, *self._store_entry(tmp_dir, "z", 1000))
+        self.assertIsNone(store.lookup(second))
+        self.assertFalse(os.path.exists(os.path.join(store_dir, second)))
+        self.assertEqual(store.lookup(first), stored)
+        self.assertIsNotNone(FirmwareStore(store_dir).lookup(third))
+        shutil.rmtree(os.path.join(store_dir, third))
+        self.assertIsNone(store.lookup(third))
+        with self.assertRaises(ValueError):
+            store.lookup("../updates")
+        shutil.rmtree(tmp_dir)
+
+    def test_firmware_store_oversized(self):
+        tmp_dir = tempfile.mkdtemp()
+        store = FirmwareStore(os.path.join(tmp_dir, "store"), budget=100)
+        store.add("a" * 40, *self._store_entry(tmp_dir, "x", 1000))
+        self.assertIsNotNone(store.lookup("a" * 40))
+        store.add("b" * 40, *self._store_entry(tmp_dir, "y", 1000))
+        self.assertIsNone(store.lookup("a" * 40))
+        self.assertIsNotNone(store.lookup("b" * 40))
+        shutil.rmtree(tmp_dir)
+
+    @patch('src.qubes_fwupdmgr.subprocess.Popen')
+    def test_download_firmware_updates_cached(self, mock_popen):
+        tmp_dir = tempfile.mkdtemp()
+        sha = "490be5c0b13ca4a3f169bf8bc682ba127b8f7b96"
+        self.q.firmware_store = FirmwareStore(tmp_dir)
+        self.q.firmware_store.add(
+            sha,
+            *self._store_entry(tmp_dir, "untrusted", 10)
+        )
+        self.q._download_firmware_updates(
+            "https://fwupd.org/downloads/untrusted%20name.cab",
+            sha
+        )
+        mock_popen.assert_not_called()
+        self.assertEqual(self.q.arch_path, os.path.join(tmp_dir, f"{sha}.cab"))
+        self.assertEqual(self.q.arch_name, f"{sha}.cab")
+        shutil.rmtree(tmp_dir)
+
+    @patch('src.qubes_fwupdmgr.subprocess.Popen')
+    def test_fetch_firmware_updates_size(self, mock_popen):
+        tmp_dir = tempfile.mkdtemp()
+        self.q.firmware_store = FirmwareStore(tmp_dir)
+        mock_popen.return_value.returncode = 0
+        self.q._parse_dom0_updates_info(UPDATE_INFO)
+        release = self.q.dom0_updates_list[0].releases[0]
+        self.assertEqual(release.size, 16384)
+        with self.assertRaisesRegex(Exception, "files do not exist"):
+            self.q._fetch_firmware_updates(
+                release.url,
+                release.checksum,
+                size=release.size
+            )
+        self.assertIn("--size=16384", mock_popen.call_args[0][0])
+        shutil.rmtree(tmp_dir)
+
+    def test_file_digests(self):
+        tmp_dir = tempfile.mkdtemp()
+        file_path = os.path.join(tmp_dir, "firmware.cab")
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        with open(file_path, "wb") as cab:
+            cab.write(content)
+        sha1 = hashlib.sha1(content).hexdigest()
+        sha256 = hashlib.sha256(content).hexdigest()
+        self.assertDictEqual(
+            file_digests(file_path),
+            {"sha1": sha1, "sha256": sha256}
+        )
+        check_digest(file_path, sha1)
+        check_digest(file_path, sha256)
+        with self.assertRaises(ValueError):
+            check_digest(file_path, "0" * 40)
+        with self.assertRaises(ValueError):
+            check_digest(file_path, "0" * 32)
+        shutil.rmtree(tmp_dir)
+
+    def test_cabinet_reader(self):
+        for name in ("firmware.cab", "firmware-mszip.cab"):
+            tmp_dir = tempfile.mkdtemp()
+            output_path = os.path.join(tmp_dir, "firmware")
+            cab = CabinetReader(os.path.join(LOGS_DIR, name))
+            self.assertCountEqual(
+                cab.list(),
+                list(CAB_MEMBERS) + ["README.txt"]
+            )
+            extracted = cab.extract(output_path)
+            self.assertCountEqual(
+                extracted,
+                [os.path.join(output_path, f) for f in CAB_MEMBERS]
+            )
+            self.assertCountEqual(os.listdir(output_path), CAB_MEMBERS)
+            for member, sha in CAB_MEMBERS.items():
+                check_digest(os.path.join(output_path, member), sha)
+            shutil.rmtree(tmp_dir)
+
+    def test_cabinet_reader_invalid(self):
+        tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(LOGS_DIR, "firmware.cab"), "rb") as cab:
+            content = cab.read()
+        archive_path = os.path.join(tmp_dir, "firmware.cab")
+        output_path = os.path.join(tmp_dir, "firmware")
+        with open(archive_path, "wb") as cab:
+            cab.write(content.replace(b"README.txt", b"../evil.sh"))
+        with self.assertRaises(ValueError):
+            CabinetReader(archive_path).extract(
+                output_path,
+                members_regex=re.compile(".*")
+            )
+        with self.assertRaises(ValueError):
+            CabinetReader(archive_path).extract(output_path, max_size=1000)
+        self.assertFalse(os.path.exists(output_path))
+        os.mkdir(output_path)
+        os.symlink(archive_path, os.path.join(output_path, "firmware.bin"))
+        with self.assertRaises(OSError):
+            CabinetReader(archive_path).extract(output_path)
+        self.assertEqual(os.listdir(output_path), ["firmware.bin"])
+        for broken in (b"MSCX" + content[4:], content[:-100]):
+            with open(archive_path, "wb") as cab:
+                cab.write(broken)
+            with self.assertRaises(ValueError):
+                CabinetReader(archive_path)
+        shutil.rmtree(tmp_dir)
+
+    def _gpg_home(self, tmp_dir):
+        """Creates keyring with a signing key in the temporary directory."""
+        gpg_home = os.path.join(tmp_dir, "gnupg")
+        os.mkdir(gpg_home, 0o700)
+        cmd_key = [
+            "gpg",
+            "--homedir",
+            gpg_home,
+            "--batch",
+            "--passphrase",
+            "",
+            "--quick-gen-key",
+            "Test <test@example.com>",
+            "ed25519",
+            "sign",
+            "never",
+        ]
+        subprocess.run(cmd_key, check=True, capture_output=True)
+        return gpg_home
+
+    def _gpg_sign(self, gpg_home, file_path, content):
+        """Writes the file and its detached signature."""
+        with open(file_path, "wb") as f:
+            f.write(content)
+        cmd_sign = [
+            "gpg",
+            "--homedir",
+            gpg_home,
+            "--batch",
+            "--armor",
+            "--detach-sign",
+            file_path,
+        ]
+        subprocess.run(cmd_sign, check=True, capture_output=True)
+
+    @unittest.skipUnless(shutil.which("gpg"), "Requires gpg")
+    def test_gpg_verifier(self):
+        tmp_dir = tempfile.mkdtemp()
+        gpg_home = self._gpg_home(tmp_dir)
+        files = [os.path.join(tmp_dir, n) for n in ("a.xml.gz", "b.bin")]
+        for file_path in files:
+            self._gpg_sign(gpg_home, file_path, file_path.encode())
+        pairs = [(f, f"{f}.asc") for f in files]
+        cache_path = os.path.join(tmp_dir, "gpg-cache.json")
+        verifier = GpgVerifier(cache_path)
+        with patch.dict(os.environ, {"GNUPGHOME": gpg_home}):
+            fingerprints = verifier.verify_many(pairs)
+            self.assertEqual(len(set(fingerprints)), 1)
+            with patch("fwupd_gpg.subprocess.Popen") as mock_popen:
+                self.assertEqual(verifier.verify(files[0]), fingerprints[0])
+                mock_popen.assert_not_called()
+            with open(files[1], "ab") as f:
+                f.write(b"tampered")
+            with self.assertRaises(Exception):
+                verifier.verify_many(pairs)
+            os.utime(os.path.join(gpg_home, "pubring.kbx"), (0, 0))
+            with patch.object(
+                verifier,
+                "_run_gpg",
+                return_value=fingerprints[0]
+            ) as mock_gpg:
+                verifier.verify(files[0])
+                mock_gpg.assert_called_once()
+        shutil.rmtree(tmp_dir)
+
+    def test_gpg_parse_status(self):
+        verifier = GpgVerifier()
+        good = (
+            "[GNUPG:] NEWSIG\n"
+            "[GNUPG:] GOODSIG 0123456789ABCDEF LVFS <sign@fwupd.org>\n"
+            "[GNUPG:] VALIDSIG F0E1D2C3 2020-01-01 1577836800 0 4 0 1 8 00\n"
+        )
+        self.assertEqual(verifier._parse_status(good), "F0E1D2C3")
+        self.assertIsNone(
+            verifier._parse_status(
+                good + "[GNUPG:] BADSIG 0123456789ABCDEF LVFS\n"
+            )
+        )
+        self.assertIsNone(
+            verifier._parse_status("[GNUPG:] VALIDSIG F0E1D2C3\n")
+        )
+
+    def _write_jcat(self, jcat_path, blobs):
+        """Writes jcat file with a single firmware.xml.gz item."""
+        catalog = {
+            "JcatVersionMajor": 0,
+            "JcatVersionMinor": 1,
+            "Items": [{"Id": "firmware.xml.gz", "Blobs": blobs}],
+        }
+        with gzip.open(jcat_path, "wt") as jcat_file:
+            json.dump(catalog, jcat_file)
+
+    def test_jcat_verify(self):
+        tmp_dir = tempfile.mkdtemp()
+        metadata_file = os.path.join(tmp_dir, "firmware.xml.gz")
+        jcat_path = f"{metadata_file}.jcat"
+        content = b"<components/>"
+        signature = b"-----BEGIN PGP SIGNATURE-----\nAAAA\n"
+        with open(metadata_file, "wb") as f:
+            f.write(content)
+        with open(f"{metadata_file}.asc", "wb") as f:
+            f.write(signature)
+        sha256 = hashlib.sha256(content).hexdigest()
+        self._write_jcat(
+            jcat_path,
+            [
+                {"Kind": 1, "Flags": 1, "Data": sha256},
+                {
+                    "Kind": 4,
+                    "Flags": 0,
+                    "Data": base64.b64encode(
+                        hashlib.sha1(content).hexdigest().encode()
+                    ).decode()
+                },
+                {"Kind": 2, "Flags": 1, "Data": signature.decode()},
+                {"Kind": 2, "Flags": 1, "Data": "other", "Target": 1},
+            ]
+        )
+        jcat = JcatFile(jcat_path)
+        self.assertEqual(jcat.blobs("firmware.xml.gz", 2), [signature])
+        verifier = MagicMock()
+        jcat.verify(metadata_file, verifier)
+        verifier.verify_many.assert_called_once_with(
+            [(metadata_file, f"{metadata_file}.asc")],
+            digests={metadata_file: sha256}
+        )
+        self._write_jcat(
+            jcat_path,
+            [
+                {"Kind": 1, "Flags": 1, "Data": "0" * 64},
+                {"Kind": 2, "Flags": 1, "Data": signature.decode()},
+            ]
+        )
+        verifier = MagicMock()
+        with self.assertRaises(ValueError):
+            JcatFile(jcat_path).verify(metadata_file, verifier)
+        verifier.verify_many.assert_not_called()
+        self._write_jcat(jcat_path, [{"Kind": 4, "Flags": 1, "Data": "0"}])
+        with self.assertRaises(ValueError):
+            JcatFile(jcat_path).verify_checksums(metadata_file)
+        with open(jcat_path, "wb") as f:
+            f.write(b"not gzip")
+        with self.assertRaises(ValueError):
+            JcatFile(jcat_path)
+        shutil.rmtree(tmp_dir)
+
+    def test_version_key(self):
+        self.assertLess(version_key("2.0.6"), version_key("2.0.10"))
+        self.assertLess(version_key("1.2"), version_key("1.2.1"))
+        self.assertLess(version_key("2.0.7"), version_key("2.0.7a"))
+        self.assertLess(version_key("0xd6"), version_key("0x100"))
+        self.assertLess(
+            version_key("0xd6", "hex"),
+            version_key("0x100", "hex")
+        )
+        self.assertLess(version_key("a1", "plain"), version_key("b0", "plain"))
+        self.assertEqual(
+            version_key("16908291", "triplet"),
+            version_key("1.2.3")
+        )
+        self.assertEqual(version_key("65538", "pair"), version_key("1.2"))
+        self.assertEqual(
+            version_key("0x12345678", "bcd"),
+            version_key("12.34.56.78")
+        )
+        self.assertEqual(
+            version_key(str(3 << 29 | 8 << 24 | 50 << 16 | 3425), "intel-me"),
+            version_key("14.8.50.3425")
+        )
+        self.assertEqual(version_key("1.2.3\n"), version_key("1.2.3"))
+        releases = [
+            Release(v, "", "") for v in ("1.9", "1.10", "1.2", "1.10a")
+        ]
+        self.assertListEqual(
+            [r.version for r in sort_releases(releases)],
+            ["1.10a", "1.10", "1.9", "1.2"]
+        )
+
+    def test_parse_devices(self):
+        devices = json.loads(GET_DEVICES)
+        for device in devices["Devices"]:
+            device["Icons"] = ["computer"]
+            if device.get("Releases"):
+                device["Releases"].reverse()
+        devices = parse_devices(json.dumps(devices))
+        self.assertTrue(all(isinstance(dev, Device) for dev in devices))
+        colorhug = next(dev for dev in devices if dev.releases)
+        self.assertEqual(colorhug.name, "ColorHug2")
+        self.assertEqual(colorhug.version, "2.0.6")
+        self.assertEqual(colorhug.releases[0].version, "2.0.7")
+        self.assertFalse(hasattr(colorhug, "__dict__"))
+        self.assertFalse(hasattr(colorhug, "icons"))
+        devices = parse_devices(GET_DEVICES_NO_VERSION)
+        self.assertIsNone(
+            next(dev for dev in devices if not dev.releases).version
+        )
+
+    def test_parse_downgrades_sorted(self):
+        devices = json.loads(GET_DEVICES)
+        for device in devices["Devices"]:
+            if device.get("Releases"):
+                device["Version"] = "2.0.10"
+                device["Releases"] = [
+                    dict(device["Releases"][0], Version=version)
+                    for version in ("2.0.7", "2.0.9", "2.0.11", "2.0.8")
+                ]
+        downgrades = self.q._parse_downgrades(json.dumps(devices))
+        self.assertListEqual(
+            [r.version for r in downgrades[0].releases],
+            ["2.0.9", "2.0.8", "2.0.7"]
+        )
 
 
 if __name__ == '__main__':